@@ -0,0 +1,317 @@
+"""Benchmarks the upscale.py pipeline on synthetic images.
+
+Generates images over a matrix of sizes and content types and times each stage
+(decode, enhance, resize, save) separately for the photo (23-block) and anime
+(6-block) models, across tiling budgets, batch sizes and worker counts.
+
+By default the models are small randomly initialised RRDBNets with the real block
+counts, so the benchmark runs offline without the release weights; absolute times
+are then only comparable between runs with the same --weights. --weights release
+uses the real models (downloaded on first use).
+
+Results are written as JSON (--output) and printed as a table. With --compare, each
+row is compared against a previous results file and the script exits with status 1
+if any row got slower than --threshold.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+from types import SimpleNamespace
+from pathlib import Path
+from PIL import Image
+import numpy as np
+import torch
+from basicsr.archs.rrdbnet_arch import RRDBNet
+
+import upscale
+
+CONTENT_KINDS = ['noise', 'gradient', 'edges', 'flat']
+MODELS = {'photo': upscale.MODEL_PHOTO, 'anime': upscale.MODEL_ANIME}
+DEFAULT_SIZES = ['64x64', '256x256', '640x480']
+
+# Width of the randomly initialised models; block counts come from the real models
+TINY_NUM_FEAT = 16
+TINY_NUM_GROW_CH = 8
+
+STAGES = ['decode', 'enhance', 'resize', 'save']
+
+def parse_size(value):
+    """Parses 'WIDTHxHEIGHT' into (width, height) (argparse type)."""
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid size: '{value}' (e.g. 640x480)")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f"Size must be positive: '{value}'")
+    return width, height
+
+def parse_budget(value):
+    """'none' or a memory size for --max-memory (argparse type)."""
+    if value.lower() == 'none':
+        return None
+    return upscale.parse_memory_size(value)
+
+def synthetic_image(kind, width, height, seed=0):
+    """HxWx3 uint8 RGB test image.
+
+    'noise' is the worst case for PNG compression, 'flat' the best; 'gradient' and
+    'edges' stand in for smooth photos and line art.
+    """
+    rng = np.random.default_rng(seed)
+    if kind == 'noise':
+        return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    if kind == 'flat':
+        return np.full((height, width, 3), rng.integers(0, 256, 3), dtype=np.uint8)
+    y, x = np.mgrid[0:height, 0:width]
+    if kind == 'gradient':
+        channels = [x * 255 / max(width - 1, 1), y * 255 / max(height - 1, 1), (x + y) * 255 / max(width + height - 2, 1)]
+        return np.stack(channels, axis=-1).astype(np.uint8)
+    if kind == 'edges':
+        # Checkerboard with thin diagonal lines
+        checker = ((x // 16 + y // 16) % 2) * 200 + 30
+        lines = ((x + y) % 23 < 2) * 255
+        return np.stack([np.maximum(checker, lines)] * 3, axis=-1).astype(np.uint8)
+    raise ValueError(f"Unknown content kind: {kind}")
+
+def random_upsampler(spec, seed=0):
+    """Randomly initialised RRDBNet with spec's block count, shaped like create_upsampler's result."""
+    torch.manual_seed(seed)
+    half = torch.cuda.is_available()
+    device = torch.device('cuda' if half else 'cpu')
+    arch = {'num_feat': TINY_NUM_FEAT, 'num_block': spec.num_blocks, 'num_grow_ch': TINY_NUM_GROW_CH}
+    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=arch['num_feat'], num_block=arch['num_block'],
+                    num_grow_ch=arch['num_grow_ch'], scale=spec.scale)
+    model.eval()
+    model = model.to(device)
+    if half:
+        model = model.half()
+    return SimpleNamespace(model=model, device=device, half=half, scale=spec.scale, arch=arch)
+
+def load_upsampler(spec, weights, seed=0):
+    if weights == 'release':
+        return upscale.create_upsampler(spec.url, spec.name, spec.scale, num_blocks=spec.num_blocks, backend=spec.backend, precision=spec.precision)
+    upsampler = upscale.apply_backend(random_upsampler(spec, seed), spec.name, spec.backend)
+    return upscale.apply_precision(upsampler, spec.name, spec.precision)
+
+def _timed(function, *args, **kwargs):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return result, (time.perf_counter() - started) * 1000
+
+def bench_stages(upsampler, source_path, work_dir, max_memory, options, repeat):
+    """Median milliseconds of each stage for one image, plus the output size in bytes."""
+    image_format, save_params = upscale.encoder_settings(options)
+    output_path = work_dir / f"out{upscale.OUTPUT_FORMATS[options.format][1]}"
+    timings = {stage: [] for stage in STAGES}
+    output_bytes = 0
+    for _ in range(repeat):
+        img_np, ms = _timed(upscale.decode_image, source_path)
+        timings['decode'].append(ms)
+        input_size = (img_np.shape[1], img_np.shape[0])
+
+        ai_np, ms = _timed(upscale.enhance_image, upsampler, img_np, max_memory)
+        timings['enhance'].append(ms)
+
+        target_size = upscale.target_size_for(input_size, options.upscale)
+        final_img, ms = _timed(Image.fromarray(ai_np).resize, target_size, Image.Resampling.LANCZOS)
+        timings['resize'].append(ms)
+
+        output_bytes, ms = _timed(upscale._atomic_save, final_img, output_path, image_format, **save_params)
+        timings['save'].append(ms)
+        del img_np, ai_np, final_img
+    return {f"{stage}_ms": statistics.median(values) for stage, values in timings.items()}, output_bytes
+
+def bench_batch(upsampler, source_path, batch_size, max_memory, repeat):
+    """Median enhance milliseconds per image when batch_size copies of the image run together."""
+    images = [upscale.decode_image(source_path) for _ in range(batch_size)]
+    per_image = []
+    for _ in range(repeat):
+        _, ms = _timed(upscale.enhance_batch, upsampler, images, max_memory)
+        per_image.append(ms / batch_size)
+    return statistics.median(per_image)
+
+def bench_directory(upsampler, spec, input_dir, work_dir, workers, options):
+    """Wall-clock milliseconds per image for an end-to-end process_images_in_directory run."""
+    output_dir = work_dir / f"out_workers{workers}"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    job_options = upscale.default_options(**{**vars(options), 'workers': workers})
+    num_images = sum(1 for _ in input_dir.iterdir())
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        _, ms = _timed(upscale.process_images_in_directory, input_dir, output_dir, upsampler, spec.scale,
+                       f"-{spec.name}", options.upscale, options=job_options, model_spec=spec)
+    return ms / num_images
+
+def run_benchmarks(args, work_dir):
+    # upscale.py options for the stages under test
+    options = upscale.default_options(upscale=args.upscale, format=args.format, max_memory=args.max_memory[0], backend=args.backend,
+                                      precision=args.precision)
+    results = []
+    for model_name in args.models:
+        spec = MODELS[model_name]._replace(backend=args.backend, precision=args.precision)
+        print(f"Loading {model_name} model ({spec.num_blocks} blocks, {args.weights} weights, {args.backend} backend, {args.precision})...")
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            upsampler = load_upsampler(spec, args.weights, args.seed)
+
+        for width, height in args.sizes:
+            size = f"{width}x{height}"
+            input_dir = work_dir / f"input_{size}"
+            input_dir.mkdir(exist_ok=True)
+            for kind in args.content:
+                source_path = input_dir / f"{kind}.png"
+                if not source_path.exists():
+                    Image.fromarray(synthetic_image(kind, width, height, args.seed)).save(source_path)
+                row = {'scenario': 'stages', 'model': model_name, 'content': kind, 'size': size}
+
+                for max_memory in args.max_memory:
+                    config = f"max_memory={max_memory or 'none'}"
+                    print(f"  {model_name} {size} {kind} {config}")
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        stage_ms, output_bytes = bench_stages(upsampler, source_path, work_dir, max_memory, options, args.repeat)
+                    results.append({**row, 'config': config, **stage_ms,
+                                    'total_ms': sum(stage_ms.values()), 'bytes': output_bytes})
+
+                for batch_size in args.batch_sizes:
+                    if batch_size == 1:
+                        continue # same as the stages scenario's enhance time
+                    config = f"batch_size={batch_size}"
+                    print(f"  {model_name} {size} {kind} {config}")
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        enhance_ms = bench_batch(upsampler, source_path, batch_size, args.max_memory[0], args.repeat)
+                    results.append({**row, 'scenario': 'batch', 'config': config, 'enhance_ms': enhance_ms, 'total_ms': enhance_ms})
+
+            for workers in args.workers:
+                if workers > 1 and args.weights != 'release':
+                    # Worker processes build their models from the release weights
+                    print(f"  Skipping workers={workers}: needs --weights release.")
+                    continue
+                config = f"workers={workers}"
+                print(f"  {model_name} {size} directory {config}")
+                per_image_ms = bench_directory(upsampler, spec, input_dir, work_dir, workers, options)
+                results.append({'scenario': 'directory', 'model': model_name, 'content': 'all', 'size': size,
+                                'config': config, 'total_ms': per_image_ms})
+
+        del upsampler
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return results
+
+def row_key(row):
+    return (row['scenario'], row['model'], row['content'], row['size'], row['config'])
+
+def print_table(results, baseline=None, threshold=0.1):
+    """Prints the results; with a baseline, adds the change in total time. Returns the regressed rows."""
+    baseline_rows = {row_key(row): row for row in (baseline or [])}
+    header = f"{'scenario':<10} {'model':<6} {'content':<9} {'size':<10} {'config':<20}"
+    header += "".join(f" {stage + ' ms':>11}" for stage in STAGES) + f" {'total ms':>11}"
+    if baseline is not None:
+        header += f" {'vs base':>9}"
+    print(header)
+    print("-" * len(header))
+
+    regressions = []
+    for row in results:
+        line = f"{row['scenario']:<10} {row['model']:<6} {row['content']:<9} {row['size']:<10} {row['config']:<20}"
+        for stage in STAGES + ['total']:
+            value = row.get(f"{stage}_ms")
+            line += f" {value:>11.1f}" if value is not None else f" {'-':>11}"
+        base = baseline_rows.get(row_key(row))
+        if baseline is not None:
+            if base is None:
+                line += f" {'new':>9}"
+            else:
+                change = row['total_ms'] / base['total_ms'] - 1 if base['total_ms'] else 0.0
+                line += f" {change:>+8.0%}" + ("!" if change > threshold else " ")
+                if change > threshold:
+                    regressions.append(row)
+        print(line)
+    return regressions
+
+def environment_info(args):
+    return {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'device': torch.cuda.get_device_name(0) if torch.cuda.is_available() else platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'weights': args.weights,
+        'backend': args.backend,
+        'precision': args.precision,
+        'format': args.format,
+        'upscale': args.upscale,
+        'repeat': args.repeat,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmark upscale.py on synthetic images.")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[parse_size(size) for size in DEFAULT_SIZES],
+                        help=f"Input sizes as WIDTHxHEIGHT. Default: {' '.join(DEFAULT_SIZES)}")
+    parser.add_argument("--content", nargs="+", choices=CONTENT_KINDS, default=CONTENT_KINDS,
+                        help="Synthetic content types. Default: all")
+    parser.add_argument("--models", nargs="+", choices=sorted(MODELS), default=['photo', 'anime'],
+                        help="Models to benchmark. Default: photo anime")
+    parser.add_argument("--weights", choices=['random', 'release'], default='random',
+                        help="'random' uses tiny randomly initialised models and runs offline; 'release' uses the real models. Default: random")
+    parser.add_argument("--backend", choices=upscale.BACKENDS, default="eager",
+                        help="Inference backend to benchmark (see upscale.py --backend). Default: eager")
+    parser.add_argument("--precision", choices=upscale.PRECISIONS, default="fp32",
+                        help="CPU precision to benchmark (see upscale.py --precision); int8 calibrates on synthetic images. Default: fp32")
+    parser.add_argument("--max-memory", nargs="+", type=parse_budget, default=[None],
+                        help="Tiling budgets to compare, e.g. none 256M. Default: none")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8],
+                        help="Batch sizes to compare. Default: 1 8")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1],
+                        help="Worker counts for the end-to-end directory run (above 1 needs --weights release). Default: 1")
+    parser.add_argument("-u", "--upscale", type=float, default=2.0,
+                        help="Target scale for the resize stage. Default: 2.0")
+    parser.add_argument("--format", choices=sorted(upscale.OUTPUT_FORMATS), default="png",
+                        help="Output format for the save stage. Default: png")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per measurement; the median is reported. Default: 3")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic images and random models.")
+    parser.add_argument("--output", type=str, default="benchmark_results.json",
+                        help="Where to write the JSON results. Default: benchmark_results.json")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Previous results file to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Slowdown of a row's total time that counts as a regression. Default: 0.10 (10%%)")
+    return parser
+
+def main():
+    args = build_arg_parser().parse_args()
+    if args.repeat < 1 or min(args.batch_sizes) < 1 or min(args.workers) < 1:
+        print("Error: --repeat, --batch-sizes and --workers must be at least 1.")
+        return 2
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    work_dir = Path(tempfile.mkdtemp(prefix="upscale_bench_"))
+    try:
+        results = run_benchmarks(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment_info(args), 'results': results}, f, indent=2)
+    print(f"\nWrote {len(results)} result(s) to {args.output}\n")
+
+    regressions = print_table(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} row(s) slower than the baseline by more than {args.threshold:.0%}.")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,10 +7,17 @@ except ImportError:
     import ImageTk
 
 import os
+import json
+import time
+import hashlib
 import shutil
+import socket
 import subprocess
 import threading
 import queue
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tkinterdnd2 import DND_FILES, TkinterDnD
 import sys
 import platform # For opening files cross-platform
@@ -23,6 +30,459 @@ OUTPUT_PHOTO_DIR = "output_photo"
 OUTPUT_ANIME_DIR = "output_anime"
 PYTHON_EXECUTABLE = sys.executable
 
+# Thumbnails are decoded on a thread pool and cached on disk, keyed by path, mtime and size
+THUMBNAIL_CACHE_DIR = ".thumbnail_cache"
+THUMBNAIL_CACHE_MAX_ENTRIES = 20000 # least recently used thumbnails beyond this are pruned at startup
+THUMBNAIL_WORKERS = max(2, min(8, os.cpu_count() or 2))
+THUMBNAIL_BATCH = 50 # finished thumbnails handed to Tk per poll
+THUMBNAIL_POLL_MS = 50
+# Only the visible rows of a thumbnail list have widgets; decoded images are kept for this many items per list
+THUMBNAIL_ROW_HEIGHT = THUMBNAIL_SIZE[1] + 40
+THUMBNAIL_MEMORY_ENTRIES = 500
+SCAN_CHUNK = 2000 # files added per UI update while a directory is being scanned
+
+# Jobs go to a long-lived upscale_server.py that keeps the models loaded between runs.
+# The GUI starts it on first use; if it can't be reached, upscale.py is run directly instead.
+# It listens on a Unix socket only this user can open; without Unix sockets (Windows) it uses
+# localhost TCP and requests carry a token from a file in the same per-user directory.
+USE_UPSCALE_SERVER = True
+UPSCALE_SERVER_UNIX_SOCKET = hasattr(socket, "AF_UNIX") and os.name != "nt" # must match upscale_server.USE_UNIX_SOCKET
+UPSCALE_SERVER_HOST = "127.0.0.1"
+UPSCALE_SERVER_PORT = 8765
+UPSCALE_SERVER_IDLE_TIMEOUT = 1800 # seconds before a server started by the GUI exits on its own
+UPSCALE_SERVER_START_TIMEOUT = 60
+
+# Inputs are passed to upscale.py as file lists and processed where they are. Set STAGE_INPUTS to
+# mirror them into input_photo/input_anime first instead (linked, only copied when linking fails).
+STAGE_INPUTS = False
+JOB_LIST_DIR = ".gui_job" # where the file lists for a run are written
+
+EVENT_PREFIX = "@@EVENT " # progress lines from upscale.py --events (must match upscale.EVENT_PREFIX)
+LOG_MAX_LINES = 2000 # older log lines are dropped so the textbox stays fast on long runs
+
+INPUT_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp', '.gif', '.tif', '.tiff')
+
+def upscale_server_dir():
+    """Per-user directory holding the server's socket or token (must match upscale_server.server_dir)."""
+    if os.name == 'nt':
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "batch_image_upscale")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+def open_server_connection(timeout):
+    if not UPSCALE_SERVER_UNIX_SOCKET:
+        return socket.create_connection((UPSCALE_SERVER_HOST, UPSCALE_SERVER_PORT), timeout=timeout)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(os.path.join(upscale_server_dir(), "server.sock"))
+    except OSError:
+        conn.close()
+        raise
+    return conn
+
+def encode_server_request(request):
+    """One JSON line, with the server's token added when it listens on TCP."""
+    if not UPSCALE_SERVER_UNIX_SOCKET:
+        # Re-read each time: a restarted server writes a new token
+        with open(os.path.join(upscale_server_dir(), "server.token"), encoding="utf-8") as f:
+            request = dict(request, token=f.read().strip())
+    return (json.dumps(request) + "\n").encode("utf-8")
+
+def thumbnail_cache_path(file_path):
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}|{stat.st_mtime_ns}|{stat.st_size}|{THUMBNAIL_SIZE}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(THUMBNAIL_CACHE_DIR, digest[:2], digest + ".png")
+
+def make_thumbnail(file_path):
+    """Returns a THUMBNAIL_SIZE thumbnail of file_path, from the on-disk cache when possible."""
+    cache_path = thumbnail_cache_path(file_path)
+    try:
+        with Image.open(cache_path) as cached:
+            cached.load()
+            os.utime(cache_path) # mark as recently used
+            return cached
+    except (OSError, ValueError):
+        pass
+
+    with Image.open(file_path) as img:
+        # JPEGs decode straight at 1/2, 1/4 or 1/8 scale; other formats ignore the draft request
+        img.draft("RGB", (THUMBNAIL_SIZE[0] * 2, THUMBNAIL_SIZE[1] * 2))
+        # reducing_gap shrinks by an integer factor with reduce() before the final resample
+        img.thumbnail(THUMBNAIL_SIZE, reducing_gap=2.0)
+        thumb = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        thumb.save(temp_path, format="PNG")
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass # the cache only saves time; the thumbnail is still shown
+    return thumb
+
+def prune_thumbnail_cache():
+    entries = []
+    for root, _, files in os.walk(THUMBNAIL_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+    entries.sort()
+    for _, path in entries[:max(0, len(entries) - THUMBNAIL_CACHE_MAX_ENTRIES)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def stage_file(source, destination):
+    """Makes source available at destination without copying its data where possible: a
+    hardlink, or a symlink across filesystems; copies only when neither can be made."""
+    temp_path = f"{destination}.{os.getpid()}.tmp"
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), temp_path)
+        except OSError: # e.g. no symlink privilege on Windows
+            shutil.copy2(source, temp_path)
+    os.replace(temp_path, destination)
+
+def write_file_list(paths, list_path):
+    temp_path = f"{list_path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as list_file:
+        for path in paths:
+            list_file.write(path + "\n")
+    os.replace(temp_path, list_path)
+
+class ThumbnailLoader:
+    """Builds thumbnails on a thread pool. Tk widgets must only be touched on the main
+    thread, so finished thumbnails are queued and picked up with take_results()."""
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        self._results = queue.Queue()
+
+    def request(self, file_path, target):
+        self._executor.submit(self._load, file_path, target)
+
+    def submit(self, function, *args):
+        self._executor.submit(function, *args)
+
+    def _load(self, file_path, target):
+        try:
+            self._results.put((target, file_path, make_thumbnail(file_path), None))
+        except Exception as e:
+            self._results.put((target, file_path, None, e))
+
+    def take_results(self, limit):
+        results = []
+        try:
+            while len(results) < limit:
+                results.append(self._results.get_nowait())
+        except queue.Empty:
+            pass
+        return results
+
+class ThumbnailList(ctk.CTkFrame):
+    """Scrolling list of thumbnails that only has widgets for the rows in view.
+
+    Items are (display_key, file_path) pairs. A pool of row labels, one per visible
+    row, is placed over the viewport and rebound to other items as the list scrolls,
+    so the widget count stays the same at 50 or 50,000 items. Images are requested
+    from the loader when their row comes into view and the most recently shown
+    THUMBNAIL_MEMORY_ENTRIES are kept. Each row label carries original_path,
+    display_key and parent_frame_ref (this list) for the click handlers.
+    """
+
+    def __init__(self, master, label_text, loader, on_double_click, on_context_menu):
+        super().__init__(master)
+        self.loader = loader
+        self.on_double_click = on_double_click
+        self.on_context_menu = on_context_menu
+        self.keys = [] # display order
+        self.paths = {} # display_key -> file path
+        self.statuses = {} # display_key -> (status text, is_error)
+        self.images = OrderedDict() # display_key -> CTkImage, least recently shown first
+        self.pending = set() # display_keys with a thumbnail on the way
+        self.failed = set() # display_keys whose thumbnail could not be made
+        self.offset = 0 # pixels scrolled from the top
+        self.rows = []
+        self._render_scheduled = False
+        # Rows waiting for their thumbnail show a blank image, which also clears a recycled row's old one
+        blank = Image.new("RGBA", THUMBNAIL_SIZE, (0, 0, 0, 0))
+        self.placeholder = ctk.CTkImage(light_image=blank, dark_image=blank, size=THUMBNAIL_SIZE)
+
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+        ctk.CTkLabel(self, text=label_text).grid(row=0, column=0, columnspan=2, pady=(2, 0))
+        self.viewport = ctk.CTkFrame(self, fg_color="transparent")
+        self.viewport.grid(row=1, column=0, sticky="nsew")
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.yview)
+        self.scrollbar.grid(row=1, column=1, sticky="ns")
+        self.viewport.bind("<Configure>", lambda event: self.schedule_render())
+        self._bind_scroll_wheel(self.viewport)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, display_key, file_path):
+        self.add_many([(display_key, file_path)])
+
+    def add_many(self, items):
+        for display_key, file_path in items:
+            if display_key not in self.paths:
+                self.keys.append(display_key)
+            self.paths[display_key] = file_path
+        self.schedule_render()
+
+    def remove(self, display_key):
+        self.remove_many([display_key])
+
+    def remove_many(self, display_keys):
+        removed = {key for key in display_keys if self.paths.pop(key, None) is not None}
+        if removed:
+            self.keys = [key for key in self.keys if key not in removed]
+        for display_key in display_keys:
+            self.statuses.pop(display_key, None)
+            self.images.pop(display_key, None)
+            self.failed.discard(display_key)
+        self.schedule_render()
+
+    def clear(self):
+        self.keys = []
+        self.paths.clear()
+        self.statuses.clear()
+        self.images.clear()
+        self.pending.clear()
+        self.failed.clear()
+        self.offset = 0
+        self.schedule_render()
+
+    def set_status(self, display_key, status, is_error=False):
+        if status is None:
+            self.statuses.pop(display_key, None)
+        else:
+            self.statuses[display_key] = (status, is_error)
+        self.schedule_render()
+
+    def set_thumbnail(self, display_key, ctk_image):
+        self.pending.discard(display_key)
+        if display_key not in self.paths:
+            return # removed while its thumbnail was loading
+        self.images[display_key] = ctk_image
+        while len(self.images) > THUMBNAIL_MEMORY_ENTRIES:
+            self.images.popitem(last=False)
+        self.schedule_render()
+
+    def thumbnail_failed(self, display_key):
+        self.pending.discard(display_key)
+        if display_key in self.paths:
+            self.failed.add(display_key)
+
+    # --- Scrolling ---
+    def yview(self, *args):
+        """Scrollbar command: ('moveto', fraction) or ('scroll', count, 'units'|'pages')."""
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.keys) * THUMBNAIL_ROW_HEIGHT)
+        elif args[0] == "scroll":
+            step = self.viewport.winfo_height() if args[2] == "pages" else THUMBNAIL_ROW_HEIGHT
+            self.offset += int(args[1]) * step
+        self.schedule_render()
+
+    def _bind_scroll_wheel(self, widget):
+        widget.bind("<MouseWheel>", self._on_scroll_wheel)
+        widget.bind("<Button-4>", self._on_scroll_wheel) # X11 wheel up
+        widget.bind("<Button-5>", self._on_scroll_wheel) # X11 wheel down
+
+    def _on_scroll_wheel(self, event):
+        if event.num == 4 or getattr(event, "delta", 0) > 0:
+            self.yview("scroll", -1, "units")
+        else:
+            self.yview("scroll", 1, "units")
+
+    # --- Rendering ---
+    def schedule_render(self):
+        # Coalesces the many changes of a bulk add or a fast scroll into one redraw
+        if not self._render_scheduled:
+            self._render_scheduled = True
+            self.after_idle(self.render)
+
+    def _make_row(self):
+        row = ctk.CTkLabel(self.viewport, text="", compound="top", height=THUMBNAIL_ROW_HEIGHT - 4)
+        row.display_key = None
+        row.original_path = None
+        row.parent_frame_ref = self
+        row.bind("<Double-1>", lambda event, lbl=row: lbl.display_key and self.on_double_click(event, lbl))
+        row.bind("<Button-3>", lambda event, lbl=row: lbl.display_key and self.on_context_menu(event, lbl))
+        self._bind_scroll_wheel(row)
+        return row
+
+    def render(self):
+        self._render_scheduled = False
+        viewport_height = self.viewport.winfo_height()
+        total_height = len(self.keys) * THUMBNAIL_ROW_HEIGHT
+        self.offset = max(0, min(self.offset, total_height - viewport_height))
+        if total_height > 0:
+            self.scrollbar.set(self.offset / total_height, min(1.0, (self.offset + viewport_height) / total_height))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+        first = self.offset // THUMBNAIL_ROW_HEIGHT
+        visible = viewport_height // THUMBNAIL_ROW_HEIGHT + 2
+        while len(self.rows) < visible:
+            self.rows.append(self._make_row())
+
+        for slot, row in enumerate(self.rows):
+            index = first + slot
+            if slot >= visible or index >= len(self.keys):
+                row.place_forget()
+                row.display_key = row.original_path = None
+                continue
+            display_key = self.keys[index]
+            row.place(x=0, y=index * THUMBNAIL_ROW_HEIGHT - self.offset, relwidth=1.0)
+            self._bind_row(row, display_key)
+
+    def _bind_row(self, row, display_key):
+        file_path = self.paths[display_key]
+        row.display_key = display_key
+        row.original_path = file_path
+
+        image = self.images.get(display_key)
+        if image is not None:
+            self.images.move_to_end(display_key)
+        else:
+            image = self.placeholder
+            if display_key not in self.pending and display_key not in self.failed:
+                self.pending.add(display_key)
+                self.loader.request(file_path, (self, display_key))
+
+        text = os.path.basename(file_path)
+        status, is_error = self.statuses.get(display_key, (None, False))
+        if status is not None:
+            text = f"{text}\n{status}"
+        text_color = "red" if is_error else ctk.ThemeManager.theme["CTkLabel"]["text_color"]
+        if (row.cget("text"), row.cget("image"), row.cget("text_color")) != (text, image, text_color):
+            row.configure(text=text, image=image, text_color=text_color)
+
+def file_identity(path, stat=None):
+    """(st_dev, st_ino) of path, which is the same for every path that names the file."""
+    stat = stat if stat is not None else os.stat(path)
+    if stat.st_ino:
+        return (stat.st_dev, stat.st_ino)
+    # Some filesystems (FAT, a few network shares) report no inode numbers
+    return (stat.st_dev, os.path.normcase(os.path.abspath(path)))
+
+def scan_image_files(dir_path, recursive=False):
+    """Yields (abs_path, identity) for the images in dir_path (and with recursive=True its
+    subdirectories) as os.scandir finds them. Symlinked directories are not followed."""
+    pending_dirs = [os.path.abspath(dir_path)]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            dir_device = os.stat(current_dir).st_dev
+            with os.scandir(current_dir) as scanner:
+                entries = sorted(scanner, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        subdirs.append(entry.path)
+                    continue
+                if not entry.name.lower().endswith(INPUT_IMAGE_EXTENSIONS) or not entry.is_file():
+                    continue
+                if entry.is_symlink():
+                    identity = file_identity(entry.path) # identify the target, not the link
+                else:
+                    # Files share their directory's device, and readdir already returned the inode
+                    # (DirEntry.stat() has no st_dev/st_ino on Windows, inode() does)
+                    inode = entry.inode()
+                    identity = (dir_device, inode) if inode else file_identity(entry.path)
+            except OSError:
+                continue
+            yield entry.path, identity
+        pending_dirs.extend(reversed(subdirs))
+
+class InputRegistry:
+    """The input files of one category, indexed by file identity.
+
+    Each file gets a display key built from its (st_dev, st_ino), so it stays the same
+    between runs and a second path to an already added file (another spelling, a link)
+    is spotted with one lookup instead of comparing against every entry. Supports the
+    read-only dict interface the App uses (items, values, in, [key], len).
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._paths = {} # display_key -> abs path, in the order added
+        self._keys_by_identity = {} # identity -> display_key
+        self._identities = {} # display_key -> identity
+
+    def key_for(self, identity):
+        device, inode = identity
+        if isinstance(inode, int):
+            return f"{self.prefix}{device:x}-{inode:x}"
+        return f"{self.prefix}{device:x}-{hashlib.sha1(inode.encode('utf-8')).hexdigest()[:16]}"
+
+    def add_many(self, entries):
+        """Adds (path, identity) pairs, identity may be None to stat the path here.
+        Returns the (display_key, abs_path) pairs that were new."""
+        added = []
+        for path, identity in entries:
+            abs_path = os.path.abspath(path)
+            try:
+                identity = identity if identity is not None else file_identity(abs_path)
+            except OSError:
+                continue
+            if identity in self._keys_by_identity:
+                continue
+            display_key = self.key_for(identity)
+            self._keys_by_identity[identity] = display_key
+            self._identities[display_key] = identity
+            self._paths[display_key] = abs_path
+            added.append((display_key, abs_path))
+        return added
+
+    def remove_many(self, display_keys):
+        """Removes entries by display key and returns the paths that were removed."""
+        removed = []
+        for display_key in display_keys:
+            path = self._paths.pop(display_key, None)
+            if path is None:
+                continue
+            del self._keys_by_identity[self._identities.pop(display_key)]
+            removed.append(path)
+        return removed
+
+    def clear(self):
+        self._paths.clear()
+        self._keys_by_identity.clear()
+        self._identities.clear()
+
+    def __contains__(self, display_key):
+        return display_key in self._paths
+
+    def __getitem__(self, display_key):
+        return self._paths[display_key]
+
+    def __len__(self):
+        return len(self._paths)
+
+    def items(self):
+        return self._paths.items()
+
+    def values(self):
+        return self._paths.values()
+
 ctk.set_appearance_mode("System")
 ctk.set_default_color_theme("blue")
 
@@ -32,15 +492,22 @@ class App(TkinterDnD.Tk):
         self.title("Real-ESRGAN Upscaler GUI")
         self.geometry("1200x750")
 
-        self.photo_input_paths = {}
-        self.anime_input_paths = {}
+        self.photo_input_paths = InputRegistry("P-")
+        self.anime_input_paths = InputRegistry("A-")
         # Store references to CTkImage objects for thumbnails to prevent GC issues if passed to Menu
-        self.thumbnail_image_refs = {} # {display_key: ctk_image_object}
+        self.thumb_keys_by_input_path = {} # {path upscale.py reads: display_key} for the current run
+        self.thumbnail_loader = ThumbnailLoader(THUMBNAIL_WORKERS)
+        self.thumbnail_loader.submit(prune_thumbnail_cache)
 
         self.processing_thread = None
         self.process = None
+        self.server_job_id = None
         self.is_processing = False
+        self.is_stopping = False # Stop was pressed; the run ends when its thread posts __PROCESSING_COMPLETE__
         self.output_queue = queue.Queue()
+        self.progress_total = 0
+        self.progress_skipped = 0
+        self.progress_started_at = None
 
         for dir_path in [INPUT_PHOTO_DIR, INPUT_ANIME_DIR, OUTPUT_PHOTO_DIR, OUTPUT_ANIME_DIR]:
             os.makedirs(dir_path, exist_ok=True)
@@ -64,11 +531,13 @@ class App(TkinterDnD.Tk):
         self.input_tabview.add("Photos")
         self.input_tabview.add("Illustrations")
 
-        self.input_photos_scrollable_frame = ctk.CTkScrollableFrame(self.input_tabview.tab("Photos"), label_text="Input Photos")
-        self.input_photos_scrollable_frame.pack(expand=True, fill="both", padx=5, pady=5)
+        self.input_photos_list = ThumbnailList(self.input_tabview.tab("Photos"), "Input Photos", self.thumbnail_loader,
+                                               self.open_image_event, self.show_input_context_menu)
+        self.input_photos_list.pack(expand=True, fill="both", padx=5, pady=5)
 
-        self.input_anime_scrollable_frame = ctk.CTkScrollableFrame(self.input_tabview.tab("Illustrations"), label_text="Input Illustrations")
-        self.input_anime_scrollable_frame.pack(expand=True, fill="both", padx=5, pady=5)
+        self.input_anime_list = ThumbnailList(self.input_tabview.tab("Illustrations"), "Input Illustrations", self.thumbnail_loader,
+                                              self.open_image_event, self.show_input_context_menu)
+        self.input_anime_list.pack(expand=True, fill="both", padx=5, pady=5)
 
         self.input_tabview.tab("Photos").drop_target_register(DND_FILES)
         self.input_tabview.tab("Photos").dnd_bind('<<Drop>>', lambda e: self.handle_drop(e, "Photos"))
@@ -85,6 +554,8 @@ class App(TkinterDnD.Tk):
         self.center_pane.grid_rowconfigure(4, weight=0)
         self.center_pane.grid_rowconfigure(5, weight=0)
         self.center_pane.grid_rowconfigure(6, weight=0)
+        self.center_pane.grid_rowconfigure(7, weight=0)
+        self.center_pane.grid_rowconfigure(8, weight=0)
         self.center_pane.grid_columnconfigure(0, weight=1)
         self.center_pane.grid_columnconfigure(1, weight=0)
 
@@ -100,10 +571,19 @@ class App(TkinterDnD.Tk):
         self.status_display = ctk.CTkTextbox(self.center_pane, wrap="word", state="disabled", height=200)
         self.status_display.grid(row=3, column=0, columnspan=2, padx=10, pady=5, sticky="nsew")
 
-        ctk.CTkLabel(self.center_pane, text="Upscale:").grid(row=4, column=0, padx=(10,0), pady=(10,0), sticky="w")
+        self.progress_frame = ctk.CTkFrame(self.center_pane, fg_color="transparent")
+        self.progress_frame.grid(row=4, column=0, columnspan=2, padx=0, pady=0, sticky="ew")
+        self.progress_frame.grid_columnconfigure(0, weight=1)
+        self.progress_bar = ctk.CTkProgressBar(self.progress_frame)
+        self.progress_bar.set(0)
+        self.progress_bar.grid(row=0, column=0, padx=10, pady=(5,0), sticky="ew")
+        self.progress_label = ctk.CTkLabel(self.progress_frame, text="")
+        self.progress_label.grid(row=1, column=0, padx=10, pady=0, sticky="w")
+
+        ctk.CTkLabel(self.center_pane, text="Upscale:").grid(row=5, column=0, padx=(10,0), pady=(10,0), sticky="w")
         
         self.upscale_slider_frame = ctk.CTkFrame(self.center_pane, fg_color="transparent")
-        self.upscale_slider_frame.grid(row=5, column=0, columnspan=2, padx=0, pady=5, sticky="ew")
+        self.upscale_slider_frame.grid(row=6, column=0, columnspan=2, padx=0, pady=5, sticky="ew")
         self.upscale_slider_frame.grid_columnconfigure(0, weight=1)
 
         self.upscale_slider = ctk.CTkSlider(self.upscale_slider_frame, from_=1, to=8, number_of_steps=28, command=self.update_upscale_label)
@@ -113,8 +593,13 @@ class App(TkinterDnD.Tk):
         self.upscale_value_label = ctk.CTkLabel(self.upscale_slider_frame, text="x 4.0", width=40)
         self.upscale_value_label.grid(row=0, column=1, padx=(0,10), pady=5, sticky="e")
 
+        # Off by default: the cache hashes every input in full before any inference starts,
+        # which for large inputs doubles the reading and delays the first result
+        self.use_cache_checkbox = ctk.CTkCheckBox(self.center_pane, text="Reuse cached results")
+        self.use_cache_checkbox.grid(row=7, column=0, columnspan=2, padx=10, pady=(0,5), sticky="w")
+
         self.start_stop_button = ctk.CTkButton(self.center_pane, text="Start Upscaling", command=self.toggle_processing)
-        self.start_stop_button.grid(row=6, column=0, columnspan=2, padx=10, pady=(5,10), sticky="ew")
+        self.start_stop_button.grid(row=8, column=0, columnspan=2, padx=10, pady=(5,10), sticky="ew")
 
         # --- Output Pane ---
         self.output_pane = ctk.CTkFrame(self.main_frame)
@@ -127,87 +612,39 @@ class App(TkinterDnD.Tk):
         self.output_tabview.add("Photos")
         self.output_tabview.add("Illustrations")
 
-        self.output_photos_scrollable_frame = ctk.CTkScrollableFrame(self.output_tabview.tab("Photos"), label_text="Output Photos")
-        self.output_photos_scrollable_frame.pack(expand=True, fill="both", padx=5, pady=5)
+        self.output_photos_list = ThumbnailList(self.output_tabview.tab("Photos"), "Output Photos", self.thumbnail_loader,
+                                                self.open_image_event, self.show_output_context_menu)
+        self.output_photos_list.pack(expand=True, fill="both", padx=5, pady=5)
 
-        self.output_anime_scrollable_frame = ctk.CTkScrollableFrame(self.output_tabview.tab("Illustrations"), label_text="Output Illustrations")
-        self.output_anime_scrollable_frame.pack(expand=True, fill="both", padx=5, pady=5)
-        
-        # Bind double-click for output panes
-        #self.output_photos_scrollable_frame.bind_class("CTkLabel", "<Double-1>", self.open_image_from_output_event)
-        #self.output_anime_scrollable_frame.bind_class("CTkLabel", "<Double-1>", self.open_image_from_output_event)
+        self.output_anime_list = ThumbnailList(self.output_tabview.tab("Illustrations"), "Output Illustrations", self.thumbnail_loader,
+                                               self.open_image_event, self.show_output_context_menu)
+        self.output_anime_list.pack(expand=True, fill="both", padx=5, pady=5)
 
 
         self.refresh_all_inputs()
         self.after(100, self.check_output_queue)
+        self.after(THUMBNAIL_POLL_MS, self.apply_loaded_thumbnails)
 
     # --- Event Handlers and UI Actions ---
 
 
-    # Modify display_thumbnail slightly:
-    def display_thumbnail(self, file_path, parent_frame, display_key, is_input_thumb=True):
+    def apply_loaded_thumbnails(self):
+        """Hands thumbnails decoded by the loader to their lists, a batch per call."""
         try:
-            img = Image.open(file_path)
-            img.thumbnail(THUMBNAIL_SIZE)
-            ctk_img = ctk.CTkImage(light_image=img, dark_image=img, size=(img.width, img.height))
-            
-            self.thumbnail_image_refs[display_key] = ctk_img
-
-            thumb_frame = ctk.CTkFrame(parent_frame) 
-            thumb_frame.pack(pady=2, padx=2, fill="x") 
-
-            ctk_label_widget = ctk.CTkLabel(thumb_frame, image=ctk_img, text=os.path.basename(file_path), compound="top")
-            # Label now takes the full width of the thumb_frame as there's no X button
-            ctk_label_widget.pack(side="left", pady=2, padx=2, expand=True, fill="both") 
-            
-            ctk_label_widget.original_path = file_path
-            ctk_label_widget.display_key = display_key
-            ctk_label_widget.parent_frame_ref = parent_frame 
-            ctk_label_widget.thumb_widget_frame_ref = thumb_frame
-
-            ctk_label_widget.bind("<Double-1>", lambda event, lbl=ctk_label_widget: self.open_image_event(event, custom_widget=lbl))
-
-            if is_input_thumb:
-                # --- REMOVE X BUTTON CREATION AND PACKING ---
-                # remove_button = ctk.CTkButton(thumb_frame, text="X", width=20, height=20,
-                #                             command=lambda k=display_key, pf=parent_frame, tf=thumb_frame: self.remove_input_item(k, pf, tf))
-                # remove_button.pack(side="right", padx=(0, 2), pady=2) 
-                # --- END OF REMOVAL ---
-                
-                ctk_label_widget.bind("<Button-3>", lambda event, lbl=ctk_label_widget: self.show_input_context_menu(event, custom_widget=lbl))
-            else: 
-                ctk_label_widget.bind("<Button-3>", lambda event, lbl=ctk_label_widget: self.show_output_context_menu(event, custom_widget=lbl))
-            
-        except FileNotFoundError:
-            self.update_status(f"Thumbnail Error: File not found at {file_path}")
-            thumb_frame = ctk.CTkFrame(parent_frame) 
-            thumb_frame.pack(pady=2, padx=2, fill="x")
-            error_display_label = ctk.CTkLabel(thumb_frame, text=f"Not Found: {os.path.basename(file_path)}", text_color="red")
-            error_display_label.pack(side="left", pady=2, padx=2, expand=True, fill="both")
-            
-            # Store necessary attributes on error label if it might be interactive later
-            error_display_label.display_key = display_key
-            error_display_label.parent_frame_ref = parent_frame
-            error_display_label.thumb_widget_frame_ref = thumb_frame
-            # No X button for error items either now
-            # if is_input_thumb:
-                # Context menu could still be bound to error_display_label if desired
-                # error_display_label.bind("<Button-3>", lambda event, lbl=error_display_label: self.show_input_context_menu(event, custom_widget=lbl))
-
-
-        except Exception as e:
-            self.update_status(f"Error loading thumbnail for {file_path}: {e}")
-            thumb_frame = ctk.CTkFrame(parent_frame)
-            thumb_frame.pack(pady=2, padx=2, fill="x")
-            error_display_label = ctk.CTkLabel(thumb_frame, text=f"Error: {os.path.basename(file_path)}", text_color="red")
-            error_display_label.pack(side="left", pady=2, padx=2, expand=True, fill="both")
-
-            error_display_label.display_key = display_key
-            error_display_label.parent_frame_ref = parent_frame
-            error_display_label.thumb_widget_frame_ref = thumb_frame
-            # No X button for error items either now
-            # if is_input_thumb:
-                # error_display_label.bind("<Button-3>", lambda event, lbl=error_display_label: self.show_input_context_menu(event, custom_widget=lbl))
+            for (thumbnail_list, display_key), file_path, thumb, error in self.thumbnail_loader.take_results(THUMBNAIL_BATCH):
+                if isinstance(error, FileNotFoundError):
+                    self.update_status(f"Thumbnail Error: File not found at {file_path}")
+                    thumbnail_list.thumbnail_failed(display_key)
+                    thumbnail_list.set_status(display_key, "Not Found", is_error=True)
+                elif error is not None:
+                    self.update_status(f"Error loading thumbnail for {file_path}: {error}")
+                    thumbnail_list.thumbnail_failed(display_key)
+                    thumbnail_list.set_status(display_key, "Error", is_error=True)
+                else:
+                    ctk_img = ctk.CTkImage(light_image=thumb, dark_image=thumb, size=(thumb.width, thumb.height))
+                    thumbnail_list.set_thumbnail(display_key, ctk_img)
+        finally:
+            self.after(THUMBNAIL_POLL_MS, self.apply_loaded_thumbnails)
 
     def open_image_event(self, event, custom_widget=None): # Added custom_widget
         # event.widget might be an internal part, custom_widget is our actual CTkLabel
@@ -255,7 +692,6 @@ class App(TkinterDnD.Tk):
         display_key = target_widget.display_key
         original_path = target_widget.original_path
         parent_frame_ref = target_widget.parent_frame_ref 
-        thumb_widget_frame_ref = target_widget.thumb_widget_frame_ref
 
         context_menu = Menu(self, tearoff=0)
         context_menu.add_command(label="Open Image", 
@@ -269,9 +705,9 @@ class App(TkinterDnD.Tk):
 
         context_menu.add_separator() # Keep separator before destructive actions
         context_menu.add_command(label="Remove from List", 
-                                 command=lambda k=display_key, pf=parent_frame_ref, tf=thumb_widget_frame_ref: self.remove_input_item(k, pf, tf))
+                                 command=lambda k=display_key, pf=parent_frame_ref: self.remove_input_item(k, pf))
         context_menu.add_command(label="Delete from Disk...", 
-                                 command=lambda k=display_key, p=original_path, pf=parent_frame_ref, tf=thumb_widget_frame_ref: self.delete_file_from_disk(k, p, pf, tf))
+                                 command=lambda k=display_key, p=original_path, pf=parent_frame_ref: self.delete_file_from_disk(k, p, pf))
         
         try:
             context_menu.tk_popup(event.x_root, event.y_root)
@@ -298,7 +734,7 @@ class App(TkinterDnD.Tk):
                                  command=lambda d=output_dir: self.open_image_with_default_viewer(d)) # Re-use viewer for dirs
 
         # Optionally, add "Delete from Disk" for output files too
-        # For this, we'd need a display_key and reference to the thumb_widget_frame if we want UI removal
+        # For this, we'd need a display_key and reference to the thumbnail list if we want UI removal
         # For now, let's keep it simple. If delete is needed, it would mirror input's delete logic.
         
         try:
@@ -306,39 +742,34 @@ class App(TkinterDnD.Tk):
         finally:
             context_menu.grab_release()            
 
-    def remove_input_item(self, display_key, parent_frame, thumb_widget_frame, from_disk_deletion=False):
+    def remove_input_item(self, display_key, parent_frame, from_disk_deletion=False):
         item_removed = False
         path_to_remove = None
 
         if display_key in self.photo_input_paths:
-            path_to_remove = self.photo_input_paths[display_key]
-            del self.photo_input_paths[display_key]
+            path_to_remove, = self.photo_input_paths.remove_many([display_key])
             item_removed = True
             category = "Photos"
         elif display_key in self.anime_input_paths:
-            path_to_remove = self.anime_input_paths[display_key]
-            del self.anime_input_paths[display_key]
+            path_to_remove, = self.anime_input_paths.remove_many([display_key])
             item_removed = True
             category = "Illustrations"
         
-        if display_key in self.thumbnail_image_refs: # Clean up image ref
-            del self.thumbnail_image_refs[display_key]
-
         if item_removed:
             if not from_disk_deletion: # Avoid double message if called from delete_file_from_disk
                  self.update_status(f"Removed {os.path.basename(path_to_remove)} from {category} input list.")
-            thumb_widget_frame.destroy()
+            parent_frame.remove(display_key)
         else:
             self.update_status(f"Item {display_key} not found in input lists for removal.")
         
         return path_to_remove # Return path if needed by caller (e.g., delete_from_disk)
 
 
-    def delete_file_from_disk(self, display_key, file_path, parent_frame, thumb_widget_frame):
+    def delete_file_from_disk(self, display_key, file_path, parent_frame):
         if not os.path.exists(file_path):
             messagebox.showerror("Error", f"File no longer exists on disk:\n{file_path}")
             # Still remove from list if it's there
-            self.remove_input_item(display_key, parent_frame, thumb_widget_frame, from_disk_deletion=True)
+            self.remove_input_item(display_key, parent_frame, from_disk_deletion=True)
             return
 
         confirm = messagebox.askyesno("Confirm Delete", 
@@ -348,7 +779,7 @@ class App(TkinterDnD.Tk):
                 os.remove(file_path)
                 self.update_status(f"Successfully deleted from disk: {file_path}")
                 # Now remove from the UI list (passing from_disk_deletion=True to suppress redundant message)
-                self.remove_input_item(display_key, parent_frame, thumb_widget_frame, from_disk_deletion=True)
+                self.remove_input_item(display_key, parent_frame, from_disk_deletion=True)
             except Exception as e:
                 self.update_status(f"Error deleting file {file_path} from disk: {e}")
                 messagebox.showerror("Delete Error", f"Could not delete file:\n{e}")
@@ -359,7 +790,7 @@ class App(TkinterDnD.Tk):
     # (This is slightly adjusted in _load_output_category)
 
     # ... (handle_drop, update_status, get_active_input_tab_name, add_files, add_directory, _add_paths_to_list - mostly same)
-    # Minor change in _add_paths_to_list to call the modified display_thumbnail
+    # Inputs are shown through the ThumbnailList of their tab
 
     def handle_drop(self, event, target_tab_name):
         if self.is_processing: return
@@ -390,8 +821,17 @@ class App(TkinterDnD.Tk):
 
 
     def update_status(self, message):
+        self.append_log([str(message)])
+
+    def append_log(self, lines):
+        """Adds lines to the log in one widget update, keeping only the last LOG_MAX_LINES."""
+        if not lines:
+            return
         self.status_display.configure(state="normal")
-        self.status_display.insert("end", str(message) + "\n")
+        self.status_display.insert("end", "\n".join(lines) + "\n")
+        line_count = int(self.status_display.index("end-1c").split(".")[0]) - 1
+        if line_count > LOG_MAX_LINES:
+            self.status_display.delete("1.0", f"{line_count - LOG_MAX_LINES + 1}.0")
         self.status_display.see("end")
         self.status_display.configure(state="disabled")
 
@@ -406,7 +846,7 @@ class App(TkinterDnD.Tk):
         active_input_tab_name = self.get_active_input_tab_name()
         filepaths = filedialog.askopenfilenames(
             title=f"Select {active_input_tab_name} Files",
-            filetypes=(("Image files", "*.png *.jpg *.jpeg *.bmp *.webp"), ("All files", "*.*"))
+            filetypes=(("Image files", "*.png *.jpg *.jpeg *.bmp *.webp *.gif *.tif *.tiff"), ("All files", "*.*"))
         )
         if filepaths:
             self._add_paths_to_list(filepaths, active_input_tab_name)
@@ -416,98 +856,68 @@ class App(TkinterDnD.Tk):
         active_input_tab_name = self.get_active_input_tab_name()
         dirpath = filedialog.askdirectory(title=f"Select {active_input_tab_name} Directory")
         if dirpath:
-            filepaths = []
-            for item in os.listdir(dirpath):
-                full_path = os.path.join(dirpath, item)
-                if os.path.isfile(full_path) and full_path.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.webp')):
-                    filepaths.append(full_path)
-            if filepaths:
-                self._add_paths_to_list(filepaths, active_input_tab_name)
-
-    def _add_paths_to_list(self, filepaths, tab_name):
+            self.update_status(f"Scanning {dirpath} and its subfolders...")
+            self._add_scanned_files(scan_image_files(dirpath, recursive=True), active_input_tab_name, 0, 0)
+
+    def _add_scanned_files(self, entries, tab_name, found, added):
+        """Adds files from a scan_image_files generator SCAN_CHUNK at a time, so the lists fill
+        in while a large tree is still being walked and the window stays responsive."""
+        if self.is_processing:
+            self.update_status(f"Directory scan stopped: processing started. Added {added} of {found} file(s) found so far.")
+            return
+        chunk = list(itertools.islice(entries, SCAN_CHUNK))
+        found += len(chunk)
+        added += self._add_paths_to_list(chunk, tab_name, report=False)
+        if len(chunk) == SCAN_CHUNK:
+            self.after(1, self._add_scanned_files, entries, tab_name, found, added)
+        elif added:
+            self.update_status(f"Added {added} new file(s) to {tab_name} input ({found} found).")
+        elif found:
+            self.update_status(f"All {found} file(s) found are already in {tab_name} input.")
+        else:
+            self.update_status("No supported images found.")
+
+    def _add_paths_to_list(self, entries, tab_name, report=True):
+        """Adds files to an input tab and returns how many were new. entries are paths or
+        (path, identity) pairs from scan_image_files."""
         if tab_name == "Photos":
             target_map = self.photo_input_paths
-            target_frame = self.input_photos_scrollable_frame
-            display_name_prefix = "P-" 
+            target_frame = self.input_photos_list
         else: 
             target_map = self.anime_input_paths
-            target_frame = self.input_anime_scrollable_frame
-            display_name_prefix = "A-"
-        
-        new_files_added_count = 0
-        for fp_raw in filepaths:
-            abs_path = os.path.abspath(fp_raw)
-            # Use filename as part of key, prefix ensures uniqueness across categories
-            display_key = display_name_prefix + os.path.basename(abs_path) + "_" + str(hash(abs_path)) # Add hash for more uniqueness if same name different dir
-
-            # Check if this specific absolute path is already represented, even if key differs due to hash
-            path_already_exists = False
-            for existing_abs_path in target_map.values():
-                if os.path.samefile(existing_abs_path, abs_path): # Check if paths point to same file
-                    path_already_exists = True
-                    # Update display_key if a different key for the same file exists
-                    # (This part can be complex if multiple identical files from different source paths were added)
-                    # For simplicity, we'll just prevent adding the same actual file twice.
-                    break
-            
-            if not path_already_exists:
-                target_map[display_key] = abs_path
-                self.display_thumbnail(abs_path, target_frame, display_key, is_input_thumb=True) # Pass True
-                new_files_added_count += 1
-            elif display_key not in target_map: # Same file, but maybe the display key changed (e.g. after refresh)
-                # Find old key and update it, or just ensure it's in target_map
-                # For simplicity, if path exists, assume it's handled
-                pass
+            target_frame = self.input_anime_list
 
+        entries = [entry if isinstance(entry, tuple) else (entry, None) for entry in entries]
+        # Files already in the list (under any path) are dropped by the registry
+        added = target_map.add_many(entries)
+        target_frame.add_many(added)
 
-        if new_files_added_count > 0:
-            self.update_status(f"Added {new_files_added_count} new file(s) to {tab_name} input.")
-        elif filepaths: 
+        if report and added:
+            self.update_status(f"Added {len(added)} new file(s) to {tab_name} input.")
+        elif report and entries: 
             self.update_status(f"All selected files already in {tab_name} input or are duplicates of existing files.")
+        return len(added)
 
     # --- refresh_all_inputs, update_upscale_label - mostly same ---
 
     def refresh_all_inputs(self):
         if self.is_processing: return
         self.update_status("Refreshing all input lists...")
-        
-        # Store current user selections to re-add them after clearing and scanning default dirs
-        # This ensures files added from arbitrary locations are not lost on refresh.
-        # We store absolute paths to avoid issues with relative paths.
-        
-        # 1. Get all unique absolute paths currently in the lists
-        all_current_abs_paths_photos = set(os.path.abspath(p) for p in self.photo_input_paths.values())
-        all_current_abs_paths_anime = set(os.path.abspath(p) for p in self.anime_input_paths.values())
-
-        # 2. Clear visual displays and internal path maps
-        for sf in [self.input_photos_scrollable_frame, self.input_anime_scrollable_frame]:
-            for w in sf.winfo_children(): w.destroy()
-        self.photo_input_paths.clear()
-        self.anime_input_paths.clear()
-        self.thumbnail_image_refs.clear()
-
-
-        # 3. Scan default input directories and add their contents
-        # These will be added first. _add_paths_to_list handles duplicates.
-        def scan_and_add(default_dir, category_name):
-            if os.path.exists(default_dir):
-                dir_files = [os.path.abspath(os.path.join(default_dir, f))
-                                   for f in os.listdir(default_dir)
-                                   if os.path.isfile(os.path.join(default_dir, f))
-                                   and f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.webp'))]
-                if dir_files:
-                    self._add_paths_to_list(dir_files, category_name)
-
-        scan_and_add(INPUT_PHOTO_DIR, "Photos")
-        scan_and_add(INPUT_ANIME_DIR, "Illustrations")
-
-        # 4. Re-add the user's original selections (which might be from outside default dirs)
-        # _add_paths_to_list will ensure that if a file was already added from default dir scan,
-        # it won't be added again visually, but its original path source is maintained.
-        if all_current_abs_paths_photos:
-            self._add_paths_to_list(list(all_current_abs_paths_photos), "Photos")
-        if all_current_abs_paths_anime:
-            self._add_paths_to_list(list(all_current_abs_paths_anime), "Illustrations")
+
+        # Files added from other locations stay; entries whose file is gone are dropped in one go
+        # and new files in the default input directories are added.
+        for category_name, default_dir, target_map, target_frame in [
+                ("Photos", INPUT_PHOTO_DIR, self.photo_input_paths, self.input_photos_list),
+                ("Illustrations", INPUT_ANIME_DIR, self.anime_input_paths, self.input_anime_list)]:
+            missing_keys = [display_key for display_key, path in target_map.items() if not os.path.isfile(path)]
+            if missing_keys:
+                target_map.remove_many(missing_keys)
+                target_frame.remove_many(missing_keys)
+                self.update_status(f"Removed {len(missing_keys)} missing file(s) from {category_name} input.")
+            if os.path.isdir(default_dir):
+                entries = list(scan_image_files(default_dir))
+                if entries:
+                    self._add_paths_to_list(entries, category_name)
             
         self.update_status("Input lists refreshed.")
 
@@ -515,128 +925,52 @@ class App(TkinterDnD.Tk):
         self.upscale_value_label.configure(text=f"x {float(value):.1f}")
     
     # --- prepare_input_staging, toggle_processing, start_processing, run_script, check_output_queue, stop_processing, finish_processing - same ---
-    # (No changes needed in these core processing functions for these UI features)
+    def write_input_lists(self):
+        """Writes the input lists for --photo-list/--anime-list and returns the upscale.py arguments."""
+        list_dir = os.path.abspath(JOB_LIST_DIR)
+        os.makedirs(list_dir, exist_ok=True)
+        upscale_args = []
+        for option, list_name, input_paths in [("--photo-list", "photos.txt", self.photo_input_paths),
+                                               ("--anime-list", "illustrations.txt", self.anime_input_paths)]:
+            if input_paths:
+                list_path = os.path.join(list_dir, list_name)
+                write_file_list(input_paths.values(), list_path)
+                upscale_args += [option, list_path]
+        return upscale_args
+
     def prepare_input_staging(self):
-        staging_photo_dir = os.path.abspath(INPUT_PHOTO_DIR)
-        staging_anime_dir = os.path.abspath(INPUT_ANIME_DIR)
-        
+        """Mirrors the input lists into the input folders (only used with STAGE_INPUTS)."""
         anything_staged_successfully = False
-        any_source_files_were_selected = bool(self.photo_input_paths or self.anime_input_paths)
-
-        # --- Process Photos ---
-        desired_photo_sources = {}  # {basename: original_abs_path}
-        if self.photo_input_paths:
-            for original_abs_path in self.photo_input_paths.values():
-                if not os.path.exists(original_abs_path):
-                    self.update_status(f"Warning: Source photo not found: {original_abs_path}. Skipping.")
-                    continue
-                desired_photo_sources[os.path.basename(original_abs_path)] = original_abs_path
-        
-        if desired_photo_sources: 
-            os.makedirs(staging_photo_dir, exist_ok=True)
-            current_files_in_staging_photo = {f for f in os.listdir(staging_photo_dir) if os.path.isfile(os.path.join(staging_photo_dir, f))}
-            
-            for basename, source_path in desired_photo_sources.items():
-                dest_path_in_staging = os.path.join(staging_photo_dir, basename)
-                copy_needed = True
+        for staging_dir, input_paths, category in [(INPUT_PHOTO_DIR, self.photo_input_paths, "photo"),
+                                                   (INPUT_ANIME_DIR, self.anime_input_paths, "illustration")]:
+            if not input_paths:
+                continue
+            staging_dir = os.path.abspath(staging_dir)
+            os.makedirs(staging_dir, exist_ok=True)
+            stale_files = {f for f in os.listdir(staging_dir) if os.path.isfile(os.path.join(staging_dir, f))}
+
+            for source_path in input_paths.values():
+                basename = os.path.basename(source_path)
+                dest_path_in_staging = os.path.join(staging_dir, basename)
                 try:
-                    if os.path.exists(dest_path_in_staging):
-                        if os.path.samefile(source_path, dest_path_in_staging):
-                            copy_needed = False  
-                    
-                    if copy_needed:
-                        shutil.copy2(source_path, dest_path_in_staging) 
-                    
-                    anything_staged_successfully = True 
-                    if basename in current_files_in_staging_photo:
-                        current_files_in_staging_photo.remove(basename) 
-
-                except OSError as e: 
-                    if not os.path.exists(source_path): 
-                        self.update_status(f"Source photo vanished: {source_path}. Cannot stage.")
-                    elif not os.path.exists(dest_path_in_staging) and os.path.exists(source_path): 
-                        try:
-                            shutil.copy2(source_path, dest_path_in_staging)
-                            anything_staged_successfully = True
-                            if basename in current_files_in_staging_photo:
-                                current_files_in_staging_photo.remove(basename)
-                        except Exception as copy_e:
-                            self.update_status(f"Error copying photo {source_path} to {dest_path_in_staging}: {copy_e}")
-                    else: 
-                        self.update_status(f"OS error processing photo {source_path} for staging: {e}")
-                except Exception as e:
-                    self.update_status(f"Error copying photo {source_path} to {dest_path_in_staging}: {e}")
-
-            for basename_to_delete in current_files_in_staging_photo:
-                try:
-                    os.remove(os.path.join(staging_photo_dir, basename_to_delete))
-                except Exception as e:
-                    self.update_status(f"Error deleting old staged photo {basename_to_delete} from {staging_photo_dir}: {e}")
-        elif self.photo_input_paths: 
-             self.update_status("All selected photos were not found on disk.")
-
-
-        # --- Process Anime (similar logic) ---
-        desired_anime_sources = {}
-        if self.anime_input_paths:
-            for original_abs_path in self.anime_input_paths.values():
-                if not os.path.exists(original_abs_path):
-                    self.update_status(f"Warning: Source illustration not found: {original_abs_path}. Skipping.")
-                    continue
-                desired_anime_sources[os.path.basename(original_abs_path)] = original_abs_path
-
-        if desired_anime_sources:
-            os.makedirs(staging_anime_dir, exist_ok=True)
-            current_files_in_staging_anime = {f for f in os.listdir(staging_anime_dir) if os.path.isfile(os.path.join(staging_anime_dir, f))}
-
-            for basename, source_path in desired_anime_sources.items():
-                dest_path_in_staging = os.path.join(staging_anime_dir, basename)
-                copy_needed = True
-                try:
-                    if os.path.exists(dest_path_in_staging):
-                        if os.path.samefile(source_path, dest_path_in_staging):
-                            copy_needed = False
-                    
-                    if copy_needed:
-                        shutil.copy2(source_path, dest_path_in_staging)
-                    
+                    if not (os.path.exists(dest_path_in_staging) and os.path.samefile(source_path, dest_path_in_staging)):
+                        stage_file(source_path, dest_path_in_staging)
                     anything_staged_successfully = True
-                    if basename in current_files_in_staging_anime:
-                        current_files_in_staging_anime.remove(basename)
+                    stale_files.discard(basename)
                 except OSError as e:
-                    if not os.path.exists(source_path):
-                        self.update_status(f"Source illustration vanished: {source_path}. Cannot stage.")
-                    elif not os.path.exists(dest_path_in_staging) and os.path.exists(source_path):
-                        try:
-                            shutil.copy2(source_path, dest_path_in_staging)
-                            anything_staged_successfully = True
-                            if basename in current_files_in_staging_anime:
-                                current_files_in_staging_anime.remove(basename)
-                        except Exception as copy_e:
-                            self.update_status(f"Error copying illustration {source_path} to {dest_path_in_staging}: {copy_e}")
-                    else:
-                        self.update_status(f"OS error processing illustration {source_path} for staging: {e}")
-                except Exception as e:
-                    self.update_status(f"Error copying illustration {source_path} to {dest_path_in_staging}: {e}")
-            
-            for basename_to_delete in current_files_in_staging_anime:
+                    self.update_status(f"Error staging {category} {source_path}: {e}")
+
+            for basename_to_delete in stale_files:
                 try:
-                    os.remove(os.path.join(staging_anime_dir, basename_to_delete))
+                    os.remove(os.path.join(staging_dir, basename_to_delete))
                 except Exception as e:
-                    self.update_status(f"Error deleting old staged illustration {basename_to_delete} from {staging_anime_dir}: {e}")
-        elif self.anime_input_paths: 
-            self.update_status("All selected illustrations were not found on disk.")
-
-        if not any_source_files_were_selected: 
-            self.update_status("No files selected for input. Staging not required.")
-            return True 
+                    self.update_status(f"Error deleting old staged {category} {basename_to_delete} from {staging_dir}: {e}")
 
         if anything_staged_successfully:
             self.update_status("Input file staging synchronized.")
-            return True
         else:
             self.update_status("Failed to stage any files. Check source file paths and permissions.")
-            return False
+        return anything_staged_successfully
 
     def toggle_processing(self):
         if self.is_processing:
@@ -651,9 +985,17 @@ class App(TkinterDnD.Tk):
             self.update_status("Processing aborted: No input files have been added to the lists.")
             return
 
-        if not self.prepare_input_staging():
-            self.update_status("Processing aborted due to staging issues.")
-            return
+        if STAGE_INPUTS:
+            if not self.prepare_input_staging():
+                self.update_status("Processing aborted due to staging issues.")
+                return
+            input_args = []
+        else:
+            try:
+                input_args = self.write_input_lists()
+            except OSError as e:
+                self.update_status(f"Processing aborted: could not write the input file lists: {e}")
+                return
 
         self.is_processing = True
         self.start_stop_button.configure(text="Stop Processing", state="normal")
@@ -672,27 +1014,108 @@ class App(TkinterDnD.Tk):
 
 
         self.upscale_slider.configure(state="disabled")
+        self.use_cache_checkbox.configure(state="disabled")
         self.status_display.configure(state="normal")
         self.status_display.delete("1.0", "end")
         self.status_display.configure(state="disabled")
         self.update_status("Starting upscaling process...")
 
+        self.reset_progress()
+
         upscale_factor = self.upscale_slider.get()
-        command = [PYTHON_EXECUTABLE, "upscale.py", "-u", str(upscale_factor)]
+        upscale_args = ["-u", str(upscale_factor), "--events"] + input_args
+        if self.use_cache_checkbox.get():
+            # The cache skips re-upscaling inputs that were already done with the same settings
+            upscale_args.append("--cache-dir")
 
-        self.processing_thread = threading.Thread(target=self.run_script, args=(command,), daemon=True)
+        self.processing_thread = threading.Thread(target=self.run_script, args=(upscale_args,), daemon=True)
         self.processing_thread.start()
 
-    def run_script(self, command):
+    def connect_to_server(self):
+        """Connects to the upscale server, starting it first if it isn't running yet."""
         try:
+            return open_server_connection(timeout=2)
+        except OSError:
+            pass
+
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        server_script_path = os.path.join(script_dir, "upscale_server.py")
+        self.output_queue.put("Starting upscale server (models are loaded once and kept for later runs)...")
+        server_args = [] if UPSCALE_SERVER_UNIX_SOCKET else ["--host", UPSCALE_SERVER_HOST, "--port", str(UPSCALE_SERVER_PORT)]
+        server_process = subprocess.Popen(
+            [PYTHON_EXECUTABLE, server_script_path, "--idle-timeout", str(UPSCALE_SERVER_IDLE_TIMEOUT)] + server_args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=script_dir,
+            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0)
+
+        deadline = time.monotonic() + UPSCALE_SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if server_process.poll() is not None:
+                raise ConnectionError("upscale server exited during startup")
+            try:
+                conn = open_server_connection(timeout=2)
+            except OSError:
+                time.sleep(0.2)
+                continue
+            if UPSCALE_SERVER_UNIX_SOCKET or os.path.exists(os.path.join(upscale_server_dir(), "server.token")):
+                return conn
+            conn.close() # listening, but the token isn't written yet
+            time.sleep(0.2)
+        raise ConnectionError("timed out waiting for the upscale server")
+
+    def send_server_command(self, request):
+        """Sends a single request to the upscale server and returns its reply."""
+        with open_server_connection(timeout=5) as conn:
+            conn.sendall(encode_server_request(request))
+            with conn.makefile("r", encoding="utf-8") as reader:
+                return json.loads(reader.readline() or "{}")
+
+    def run_on_server(self, upscale_args):
+        conn = self.connect_to_server()
+        conn.settimeout(None)
+        with conn, conn.makefile("r", encoding="utf-8") as reader:
+            conn.sendall(encode_server_request({"cmd": "submit", "args": upscale_args}))
+            for line in reader:
+                message = json.loads(line)
+                event = message.get("event")
+                if event == "accepted":
+                    self.server_job_id = message["job"]
+                    if self.is_stopping:
+                        # Stop was pressed before the job had an id to cancel
+                        self.send_server_command({"cmd": "cancel", "job": self.server_job_id})
+                elif event == "log":
+                    self.output_queue.put(message["line"])
+                elif event == "finished":
+                    if message.get("status") != "done":
+                        self.output_queue.put(f"Job {message.get('status')}.")
+                    break
+                elif message.get("ok") is False:
+                    self.output_queue.put(f"Upscale server error: {message.get('error')}")
+                    break
+        self.server_job_id = None
+
+    def run_script(self, upscale_args):
+        try:
+            if USE_UPSCALE_SERVER:
+                try:
+                    self.run_on_server(upscale_args)
+                    return
+                except (OSError, ValueError) as e:
+                    if self.server_job_id is not None:
+                        # The job was already accepted; don't run it a second time
+                        self.server_job_id = None
+                        self.output_queue.put(f"Lost connection to the upscale server: {e}")
+                        return
+                    self.output_queue.put(f"Upscale server unavailable ({e}), running upscale.py directly.")
+
             script_dir = os.path.dirname(os.path.abspath(__file__))
             upscale_script_path = os.path.join(script_dir, "upscale.py")
             if not os.path.exists(upscale_script_path):
                 self.output_queue.put(f"ERROR: upscale.py not found at {upscale_script_path}")
-                self.output_queue.put("__PROCESSING_COMPLETE__")
                 return
             
-            command[1] = upscale_script_path 
+            command = [PYTHON_EXECUTABLE, upscale_script_path] + upscale_args
+            if self.is_stopping:
+                return
 
             self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
                                             text=True, bufsize=1, 
@@ -717,20 +1140,103 @@ class App(TkinterDnD.Tk):
 
 
     def check_output_queue(self):
+        log_lines = []
         try:
             while True:
                 line = self.output_queue.get_nowait()
                 if line == "__PROCESSING_COMPLETE__":
-                    self.finish_processing()
+                    self.append_log(log_lines)
+                    log_lines = []
+                    self.finish_processing(stopped_manually=self.is_stopping)
+                elif line.startswith(EVENT_PREFIX):
+                    try:
+                        self.handle_progress_event(json.loads(line[len(EVENT_PREFIX):]))
+                    except (ValueError, KeyError) as e:
+                        log_lines.append(f"Bad progress event ({e}): {line.strip()}")
                 else:
-                    self.update_status(line.strip())
+                    log_lines.append(line.strip())
         except queue.Empty:
             pass
         finally:
+            self.append_log(log_lines)
             self.after(100, self.check_output_queue)
 
+    # --- Progress ---
+    def reset_progress(self):
+        self.progress_total = 0
+        self.progress_skipped = 0
+        self.progress_started_at = time.monotonic()
+        self.progress_bar.set(0)
+        self.progress_label.configure(text="")
+
+        # upscale.py reads inputs where they are, or from the input folder they were staged to
+        self.thumb_keys_by_input_path = {}
+        for staging_dir, input_paths in [(INPUT_PHOTO_DIR, self.photo_input_paths), (INPUT_ANIME_DIR, self.anime_input_paths)]:
+            for display_key, original_path in input_paths.items():
+                input_path = original_path
+                if STAGE_INPUTS:
+                    input_path = os.path.join(os.path.abspath(staging_dir), os.path.basename(original_path))
+                self.thumb_keys_by_input_path[os.path.normcase(input_path)] = display_key
+                self.set_thumbnail_status(display_key, None)
+
+    def set_thumbnail_status(self, display_key, status, is_error=False):
+        if display_key in self.photo_input_paths:
+            self.input_photos_list.set_status(display_key, status, is_error)
+        elif display_key in self.anime_input_paths:
+            self.input_anime_list.set_status(display_key, status, is_error)
+
+    def handle_progress_event(self, event):
+        kind = event["event"]
+        if kind == "start":
+            self.progress_total = event["total"]
+            self.progress_started_at = time.monotonic()
+        elif kind in ("progress", "done", "error"):
+            display_key = self.thumb_keys_by_input_path.get(os.path.normcase(os.path.abspath(event["input"])))
+            if kind == "progress":
+                self.set_thumbnail_status(display_key, "Upscaling...")
+                return
+            if kind == "error":
+                self.set_thumbnail_status(display_key, "Failed", is_error=True)
+            elif event.get("skipped"):
+                self.progress_skipped += 1
+                self.set_thumbnail_status(display_key, "Already done")
+            elif event.get("cache_hit"):
+                self.set_thumbnail_status(display_key, "Cached")
+            else:
+                self.set_thumbnail_status(display_key, f"Done in {event.get('seconds', 0):.1f}s")
+            self.update_progress(event["completed"], event["total"])
+        elif kind == "finish":
+            self.update_progress(event["completed"], event["total"], finished=True)
+
+    def update_progress(self, completed, total, finished=False):
+        self.progress_bar.set(completed / total if total else 1)
+        elapsed = time.monotonic() - self.progress_started_at
+        # Images skipped by --resume finish instantly and would inflate the rate
+        processed = completed - self.progress_skipped
+        rate = processed / elapsed if elapsed > 0 else 0
+        text = f"{completed}/{total} images"
+        if rate > 0:
+            text += f" | {rate:.2f} img/s" if rate >= 1 else f" | {1 / rate:.1f} s/img"
+        if finished:
+            text += f" | took {self.format_duration(elapsed)}"
+        elif rate > 0 and completed < total:
+            text += f" | ETA {self.format_duration((total - completed) / rate)}"
+        self.progress_label.configure(text=text)
+
+    @staticmethod
+    def format_duration(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
     def stop_processing(self):
-        if self.process and self.process.poll() is None:
+        if self.server_job_id is not None:
+            self.update_status("Cancelling job on the upscale server (stops after the current image)...")
+            try:
+                self.send_server_command({"cmd": "cancel", "job": self.server_job_id})
+            except (OSError, ValueError) as e:
+                self.update_status(f"Error during stop: {e}")
+        elif self.process and self.process.poll() is None:
             self.update_status("Attempting to stop processing...")
             self.process.terminate()
             try:
@@ -742,11 +1248,15 @@ class App(TkinterDnD.Tk):
                 self.update_status("Process killed.")
             except Exception as e:
                 self.update_status(f"Error during stop: {e}")
-        
-        self.finish_processing(stopped_manually=True)
+
+        # The run only ends once its thread is done (for a server job, once the job's "finished"
+        # event arrives), so a new run can't be started while the old one is still winding down
+        self.is_stopping = True
+        self.start_stop_button.configure(text="Stopping...", state="disabled")
 
     def finish_processing(self, stopped_manually=False):
         self.is_processing = False
+        self.is_stopping = False
         self.start_stop_button.configure(text="Start Upscaling", state="normal")
         self.add_files_button.configure(state="normal")
         self.add_directory_button.configure(state="normal")
@@ -772,6 +1282,7 @@ class App(TkinterDnD.Tk):
 
 
         self.upscale_slider.configure(state="normal")
+        self.use_cache_checkbox.configure(state="normal")
         if not stopped_manually:
             self.update_status("Upscaling process finished.")
             self.load_output_thumbnails() # This is where the issue might be triggered
@@ -780,32 +1291,29 @@ class App(TkinterDnD.Tk):
         self.process = None
 
     def clear_output_displays(self): # Added to avoid confusion with clear_staging_dirs
-        for frame in [self.output_photos_scrollable_frame, self.output_anime_scrollable_frame]:
-            for widget in frame.winfo_children():
-                widget.destroy()
+        for thumbnail_list in [self.output_photos_list, self.output_anime_list]:
+            thumbnail_list.clear()
         self.update_status("Cleared output display.")
 
     def load_output_thumbnails(self):
         self.update_status("Loading output thumbnails...")
-        self._load_output_category(OUTPUT_PHOTO_DIR, self.output_photos_scrollable_frame)
-        self._load_output_category(OUTPUT_ANIME_DIR, self.output_anime_scrollable_frame)
+        self._load_output_category(OUTPUT_PHOTO_DIR, self.output_photos_list)
+        self._load_output_category(OUTPUT_ANIME_DIR, self.output_anime_list)
         self.update_status("Output thumbnails loaded.")
 
-    def _load_output_category(self, output_dir, scroll_frame):
+    def _load_output_category(self, output_dir, thumbnail_list):
         if not os.path.exists(output_dir):
             self.update_status(f"Output directory not found: {output_dir}")
             return
             
-        for widget in scroll_frame.winfo_children():
-            widget.destroy()
-
-        for filename in os.listdir(output_dir):
-            filepath = os.path.join(output_dir, filename)
-            if os.path.isfile(filepath) and filepath.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.webp')):
-                # For output thumbnails, display_key is not strictly needed for removal in same way,
-                # but good for consistency if we ever add context menus there.
-                display_key = "OUT-" + filename 
-                self.display_thumbnail(filepath, scroll_frame, display_key, is_input_thumb=False)
+        thumbnail_list.clear()
+
+        # Recursive, since runs over folder trees (and lists of files from several folders) mirror
+        # their subfolders in the output directory. Keyed by relative path, as names repeat across them.
+        output_root = os.path.abspath(output_dir)
+        thumbnail_list.add_many(
+            ("OUT-" + os.path.relpath(filepath, output_root).replace(os.sep, "/"), filepath)
+            for filepath, _ in scan_image_files(output_root, recursive=True))
 
 
 if __name__ == "__main__":
@@ -1,6 +1,28 @@
 import os
+import gc
+import copy
+import csv
+import sys
+import json
+import math
+import ctypes
+import ctypes.util
+import select
+import struct
+import hashlib
+import fnmatch
+import itertools
+import time
+import queue
 import shutil
 import argparse
+import threading
+import traceback
+import contextlib
+import cProfile
+import pstats
+import multiprocessing
+from collections import namedtuple, OrderedDict
 from pathlib import Path
 from PIL import Image # Ensure Pillow (or Pillow-SIMD) is installed
 import numpy as np
@@ -8,6 +30,26 @@ import torch
 # Assuming imports from realesrgan and basicsr are correct after basicsr-fixed
 from realesrgan import RealESRGANer
 from basicsr.archs.rrdbnet_arch import RRDBNet
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows; process peak RSS is then not reported
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows; reflinks are then not attempted
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None # only needed for --backend onnx
+try:
+    import tifffile
+except ImportError:
+    tifffile = None # only needed for --stream with TIFF inputs or BigTIFF outputs
+try:
+    import zarr
+except ImportError:
+    zarr = None # lets --stream read compressed or tiled TIFFs by region
 
 # --- Configuration ---
 MODEL_PHOTO_URL = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth'
@@ -20,10 +62,67 @@ SUFFIX_ANIME = f'-{MODEL_ANIME_NAME_FOR_SUFFIX}'
 
 MODEL_NATIVE_SCALE = 4
 
-SUPPORTED_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif'] # not setup for animated GIFs
+# calibration is an input folder or file list that --precision int8 draws its calibration images from
+ModelSpec = namedtuple('ModelSpec', ['name', 'url', 'scale', 'num_blocks', 'backend', 'precision', 'calibration'],
+                       defaults=['eager', 'fp32', None])
+MODEL_PHOTO = ModelSpec(MODEL_PHOTO_NAME_FOR_SUFFIX, MODEL_PHOTO_URL, MODEL_NATIVE_SCALE, 23)
+MODEL_ANIME = ModelSpec(MODEL_ANIME_NAME_FOR_SUFFIX, MODEL_ANIME_URL, MODEL_NATIVE_SCALE, 6)
 
-def create_upsampler(model_url, model_name_for_log_and_device, model_inherent_scale, num_blocks):
-    """Initializes and returns a RealESRGANer instance."""
+SUPPORTED_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif', '.tif', '.tiff', '.npy']
+ANIMATED_EXTENSIONS = ['.gif', '.png', '.webp'] # checked for several frames (GIF, APNG, animated WebP)
+
+# --- Tiling ---
+MIN_TILE_SIZE = 32
+TILE_SIZE_MULTIPLE = 8
+TILE_PAD_BASE = 10
+TILE_PAD_PER_BLOCK = 2 # deeper models see further, so tiles need more surrounding context
+TILE_MEMORY_HEADROOM = 1.5 # allocator overhead and fragmentation on top of the activation estimate
+
+# --- Output encoding ---
+# --format name -> (Pillow format, file extension)
+OUTPUT_FORMATS = {
+    'png': ('PNG', '.png'),
+    'webp': ('WEBP', '.webp'),
+    'jpeg': ('JPEG', '.jpg'),
+    'tiff': ('TIFF', '.tiff'),
+    'gif': ('GIF', '.gif'),
+}
+DEFAULT_COMPRESS_LEVEL = 6 # zlib's default; lower is faster and larger
+DEFAULT_QUALITY = 95
+
+# --- Fused resize ---
+LANCZOS_SUPPORT = 3.0 # Pillow's Lanczos filter radius, in source pixels at 1:1
+FUSED_TILE_SIZE = 2048 # largest input side fused resizing runs in one pass when there is no memory budget
+FUSED_MIN_PSNR = 40.0 # --check-fused flags outputs below this PSNR against the unfused path
+
+# --- Out-of-core streaming ---
+STREAM_TILE_SIZE = 512 # tile size used by --stream when no memory budget asks for one
+
+# --- Alpha ---
+ALPHA_MODES = ['lanczos', 'bicubic', 'model', 'drop']
+ALPHA_TILE_SIZE = 256 # tile size tried for skipping fully transparent regions
+
+def parse_memory_size(value):
+    """Parses a size such as '8G', '512M' or '1073741824' into bytes (argparse type)."""
+    text = str(value).strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    multiplier = 1
+    if text and text[-1] in units:
+        multiplier = units[text[-1]]
+        text = text[:-1]
+    try:
+        number = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid memory size: '{value}' (e.g. 8G, 512M)")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"Memory size must be positive: '{value}'")
+    return int(number * multiplier)
+
+def create_upsampler(model_url, model_name_for_log_and_device, model_inherent_scale, num_blocks, backend='eager', precision='fp32', calibration=None):
+    """Initializes and returns a RealESRGANer instance, running its model on backend (see
+    apply_backend()) at precision (see apply_precision())."""
     if torch.cuda.is_available():
         device = torch.device('cuda')
         half_precision = True
@@ -33,10 +132,11 @@ def create_upsampler(model_url, model_name_for_log_and_device, model_inherent_sc
         half_precision = False
         print(f"Warning: Using CPU for {model_name_for_log_and_device}, this will be very slow.")
 
+    arch = {'num_feat': 64, 'num_block': num_blocks, 'num_grow_ch': 32}
     model_arch = RRDBNet(
-        num_in_ch=3, num_out_ch=3, num_feat=64,
-        num_block=num_blocks,
-        num_grow_ch=32, scale=model_inherent_scale
+        num_in_ch=3, num_out_ch=3, num_feat=arch['num_feat'],
+        num_block=arch['num_block'],
+        num_grow_ch=arch['num_grow_ch'], scale=model_inherent_scale
     )
 
     print(f"Attempting to initialize RealESRGANer with model_url: '{model_url}' (num_blocks: {num_blocks}, model_scale: {model_inherent_scale})")
@@ -51,72 +151,2559 @@ def create_upsampler(model_url, model_name_for_log_and_device, model_inherent_sc
             pre_pad=0,
             half=half_precision,
         )
+        upsampler.arch = arch # read by the tiling code to size tiles for this model
         print(f"RealESRGANer initialized successfully for {model_name_for_log_and_device}.")
-        return upsampler
     except Exception as e:
         print(f"Unexpected error during RealESRGANer init for {model_name_for_log_and_device} using URL {model_url}: {type(e).__name__} - {e}")
-        import traceback
         traceback.print_exc()
         raise
+    upsampler = apply_backend(upsampler, model_name_for_log_and_device, backend)
+    return apply_precision(upsampler, model_name_for_log_and_device, precision, calibration)
 
-def process_images_in_directory(input_dir_path, output_dir_path, upsampler, model_native_scale, filename_suffix, target_output_scale_factor):
-    """Processes all images in a given directory."""
-    processed_files = []
+# --- Inference backends ---
+# The eager RRDBNet is swapped for a graph-optimized version of it. Exported models are
+# cached next to the release weights, keyed by a fingerprint of the weights.
+BACKENDS = ['eager', 'torchscript', 'compile', 'onnx']
+ONNX_OPSET = 17
+BACKEND_MIN_PSNR = 45.0 # a backend whose output is further than this from eager is not used
+BACKEND_PARITY_SIZES = [(48, 64), (37, 53)] # odd sizes catch exports that baked in the example's shape
+
+def backend_cache_dir():
+    """Where RealESRGANer keeps the downloaded weights; exported models go next to them."""
+    try:
+        from realesrgan.utils import ROOT_DIR
+    except ImportError:
+        ROOT_DIR = Path(__file__).resolve().parent
+    return Path(ROOT_DIR) / 'weights'
+
+def weights_fingerprint(model):
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode('utf-8'))
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+class OnnxModel:
+    """An exported model run by onnxruntime's CPU provider, called like the torch module it replaces."""
+
+    def __init__(self, path):
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(str(path), session_options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, tensor):
+        output = self.session.run(None, {self.input_name: tensor.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+def _export_model(model, backend, example, path):
+    temp_path = _temp_path_for(path)
+    with torch.no_grad():
+        if backend == 'torchscript':
+            traced = torch.jit.freeze(torch.jit.trace(model, example))
+            traced.save(str(temp_path))
+        else:
+            dynamic_axes = {'input': {0: 'batch', 2: 'height', 3: 'width'}, 'output': {0: 'batch', 2: 'height', 3: 'width'}}
+            torch.onnx.export(model, example, str(temp_path), input_names=['input'], output_names=['output'],
+                              dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET)
+    os.replace(temp_path, path)
+
+def _load_backend_model(model, model_name, backend, device, dtype):
+    if backend == 'compile':
+        # Compiled in-process on first use; dynamic shapes so every tile size doesn't recompile
+        return torch.compile(model, dynamic=True)
+    if backend == 'onnx' and onnxruntime is None:
+        raise RuntimeError("onnxruntime is not installed (pip install onnxruntime)")
+
+    cache_dir = backend_cache_dir()
+    variant = f"{device.type}-{str(dtype).replace('torch.', '')}-torch{torch.__version__.split('+')[0]}"
+    extension = '.onnx' if backend == 'onnx' else '.ts'
+    path = cache_dir / f"{model_name}-{weights_fingerprint(model)}-{variant}{extension}"
+    if not path.exists():
+        print(f"Exporting {model_name} for the {backend} backend (once; cached as {path.name})...")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        _export_model(model, backend, torch.rand(1, 3, 64, 64, device=device, dtype=dtype), path)
+    if backend == 'onnx':
+        return OnnxModel(path)
+    return torch.jit.optimize_for_inference(torch.jit.load(str(path), map_location=device))
+
+def check_backend_parity(reference_model, model, device, dtype):
+    """Runs both models on a few seeded random inputs and returns the worst compare_images() stats."""
+    generator = torch.Generator().manual_seed(0)
+    worst = None
+    with torch.no_grad():
+        for height, width in BACKEND_PARITY_SIZES:
+            example = torch.rand(1, 3, height, width, generator=generator).to(device=device, dtype=dtype)
+            stats = compare_images(_to_uint8_image(reference_model(example)[0]), _to_uint8_image(model(example)[0]))
+            if worst is None or stats['psnr'] < worst['psnr']:
+                worst = stats
+    return worst
+
+def apply_backend(upsampler, model_name, backend):
+    """Replaces upsampler.model with its backend version after checking it against eager output.
+
+    'torchscript' traces and freezes the model, 'compile' uses torch.compile and 'onnx'
+    exports it for onnxruntime's CPU provider (moving the upsampler to the CPU in fp32).
+    If the export fails or the outputs don't match, the eager model is kept.
+    """
+    if backend == 'eager':
+        return upsampler
+    eager_model = upsampler.model
+    if backend == 'onnx' and upsampler.device.type != 'cpu':
+        print(f"The onnx backend runs on the CPU; moving {model_name} there.")
+        eager_model = eager_model.float().cpu()
+        upsampler.model, upsampler.device, upsampler.half = eager_model, torch.device('cpu'), False
+    dtype = torch.float16 if upsampler.half else torch.float32
+    try:
+        model = _load_backend_model(eager_model, model_name, backend, upsampler.device, dtype)
+        stats = check_backend_parity(eager_model, model, upsampler.device, dtype)
+    except Exception as e:
+        print(f"Warning: the {backend} backend failed for {model_name} ({type(e).__name__}: {e}); using eager PyTorch.")
+        traceback.print_exc()
+        return upsampler
+    if stats['psnr'] < BACKEND_MIN_PSNR:
+        print(f"Warning: {backend} output differs from eager for {model_name} (PSNR {stats['psnr']:.1f} dB, max diff {stats['max_abs_diff']}); using eager PyTorch.")
+        return upsampler
+    print(f"Using the {backend} backend for {model_name} (parity with eager: PSNR {stats['psnr']:.1f} dB, max diff {stats['max_abs_diff']}).")
+    upsampler.model = model
+    return upsampler
+
+# --- Reduced precision (CPU) ---
+PRECISIONS = ['fp32', 'bf16', 'int8']
+CALIBRATION_IMAGES = 8 # images from the input folder used to calibrate (and report on) int8
+CALIBRATION_CROP = 96 # side of the crop taken from the middle of each calibration image
+
+def cpu_supports_bf16():
+    """True if oneDNN has native bfloat16 kernels for this CPU (AVX512-BF16 or AMX); emulated bf16 is slower than fp32."""
+    is_supported = getattr(torch.ops.mkldnn, '_is_mkldnn_bf16_supported', None)
+    try:
+        return bool(is_supported and torch.backends.mkldnn.is_available() and is_supported())
+    except RuntimeError:
+        return False
+
+class AutocastModel:
+    """Runs a model under CPU bfloat16 autocast and hands back fp32 outputs."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, tensor):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return self.model(tensor).float()
+
+def calibration_samples(calibration):
+    """Center crops of the first CALIBRATION_IMAGES images of an input folder or file list, as model inputs.
+
+    Falls back to seeded synthetic images (gradients plus noise) when there are none.
+    """
+    samples = []
+    if calibration is not None and Path(calibration).exists():
+        source = Path(calibration)
+        image_files = read_file_list(source) if source.is_file() else iter_images(source, recursive=True)
+        for img_path in itertools.islice(image_files, CALIBRATION_IMAGES):
+            try:
+                img_np = decode_image(img_path)
+            except Exception as e:
+                print(f"  Skipping calibration image {img_path.name}: {e}")
+                continue
+            height, width = img_np.shape[:2]
+            top, left = max(0, (height - CALIBRATION_CROP) // 2), max(0, (width - CALIBRATION_CROP) // 2)
+            crop = np.ascontiguousarray(img_np[top:top + CALIBRATION_CROP, left:left + CALIBRATION_CROP])
+            samples.append(torch.from_numpy(crop).permute(2, 0, 1).unsqueeze(0).float().div_(255.0))
+    if not samples:
+        print("  No calibration images found; calibrating on synthetic images.")
+        generator = torch.Generator().manual_seed(0)
+        ramp = torch.linspace(0, 1, CALIBRATION_CROP)
+        for _ in range(CALIBRATION_IMAGES):
+            gradient = (ramp[None, :] * torch.rand(3, 1, 1, generator=generator) + ramp[:, None] * torch.rand(3, 1, 1, generator=generator)) / 2
+            noise = torch.randn(3, CALIBRATION_CROP, CALIBRATION_CROP, generator=generator) * 0.05
+            samples.append((gradient + noise).clamp_(0, 1).unsqueeze(0))
+    return samples
+
+def calibration_digest(samples):
+    """Short hash of the calibration crops, so an int8 model is only reused for the same calibration set."""
+    digest = hashlib.sha256()
+    for sample in samples:
+        digest.update(sample.numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+def _box_mean(values, size):
+    """Means over every size x size window that fits inside values (a 2-D float array)."""
+    sums = np.pad(values, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+    return (sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]) / (size * size)
+
+def ssim(reference, candidate, window=7):
+    """Mean structural similarity of two same-sized uint8 RGB images, on luma with
+    uniform 7x7 windows like scikit-image's default."""
+    luma = np.array([0.299, 0.587, 0.114])
+    x = reference.astype(np.float64) @ luma
+    y = candidate.astype(np.float64) @ luma
+    if min(x.shape) < window:
+        return 1.0 if np.array_equal(reference, candidate) else 0.0
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mean_x, mean_y = _box_mean(x, window), _box_mean(y, window)
+    var_x = _box_mean(x * x, window) - mean_x ** 2
+    var_y = _box_mean(y * y, window) - mean_y ** 2
+    covariance = _box_mean(x * y, window) - mean_x * mean_y
+    ssim_map = ((2 * mean_x * mean_y + c1) * (2 * covariance + c2)) / ((mean_x ** 2 + mean_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+def precision_report(reference_model, model, samples):
+    """PSNR/SSIM of model's outputs against fp32 reference_model's on samples, and the speedup."""
+    psnrs, ssims = [], []
+    reference_seconds = seconds = 0.0
+    with torch.no_grad():
+        for sample in samples:
+            started = time.perf_counter()
+            reference = _to_uint8_image(reference_model(sample)[0])
+            reference_seconds += time.perf_counter() - started
+            started = time.perf_counter()
+            output = _to_uint8_image(model(sample)[0])
+            seconds += time.perf_counter() - started
+            psnrs.append(compare_images(reference, output)['psnr'])
+            ssims.append(ssim(reference, output))
+    return {'samples': len(samples), 'psnr_mean': sum(psnrs) / len(psnrs), 'psnr_min': min(psnrs),
+            'ssim_mean': sum(ssims) / len(ssims), 'ssim_min': min(ssims),
+            'speedup': reference_seconds / seconds if seconds else float('inf')}
+
+def _quantize_int8(model, samples):
+    """Post-training static int8 quantization of model's convolutions (FX graph mode), calibrated on samples."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).float().cpu().eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs=(samples[0],))
+    with torch.no_grad():
+        for sample in samples:
+            prepared(sample)
+        quantized = convert_fx(prepared)
+        return torch.jit.freeze(torch.jit.trace(quantized, samples[0]))
+
+def apply_precision(upsampler, model_name, precision, calibration=None):
+    """Switches a CPU upsampler to bf16 autocast or an int8-quantized model and prints how
+    its outputs compare with fp32 (PSNR/SSIM) and how much faster it is.
+
+    The int8 model is cached next to the release weights with its report, keyed by the
+    calibration crops, so a different calibration set quantizes again. On CUDA, or when
+    the CPU lacks native bf16, it stays as it is.
+    """
+    if precision == 'fp32':
+        return upsampler
+    if upsampler.device.type != 'cpu':
+        print(f"--precision {precision} is for CPU inference; {model_name} keeps running in {'fp16' if upsampler.half else 'fp32'} on {upsampler.device.type}.")
+        return upsampler
+    if precision == 'bf16' and not cpu_supports_bf16():
+        print(f"Warning: this CPU has no native bfloat16 support; running {model_name} in fp32.")
+        return upsampler
+
+    reference_model = upsampler.model
+    try:
+        if precision == 'bf16':
+            model = AutocastModel(reference_model)
+            report = precision_report(reference_model, model, calibration_samples(calibration))
+        else:
+            samples = calibration_samples(calibration)
+            path = backend_cache_dir() / (f"{model_name}-{weights_fingerprint(reference_model)}-int8-cal{calibration_digest(samples)}"
+                                          f"-torch{torch.__version__.split('+')[0]}.ts")
+            report_path = path.with_suffix('.report.json')
+            if path.exists() and report_path.exists():
+                model = torch.jit.load(str(path), map_location='cpu')
+                with open(report_path, encoding='utf-8') as f:
+                    report = json.load(f)
+            else:
+                print(f"Quantizing {model_name} to int8 (once per calibration set; cached as {path.name})...")
+                model = _quantize_int8(reference_model, samples)
+                report = precision_report(reference_model, model, samples)
+                report['calibration'] = str(calibration) if calibration else "synthetic images"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                temp_path = _temp_path_for(path)
+                model.save(str(temp_path))
+                os.replace(temp_path, path)
+                with open(report_path, 'w', encoding='utf-8') as f:
+                    json.dump(report, f, indent=2)
+    except Exception as e:
+        print(f"Warning: {precision} failed for {model_name} ({type(e).__name__}: {e}); running in fp32.")
+        traceback.print_exc()
+        return upsampler
+
+    calibrated_on = f" from {report['calibration']}" if report.get('calibration') else ""
+    print(f"Using {precision} for {model_name}: vs fp32 on {report['samples']} sample(s){calibrated_on} PSNR {report['psnr_mean']:.1f} dB "
+          f"(min {report['psnr_min']:.1f}), SSIM {report['ssim_mean']:.4f} (min {report['ssim_min']:.4f}), {report['speedup']:.2f}x speed.")
+    upsampler.model = model
+    return upsampler
+
+class ModelLease:
+    """Lazy handle on a registry model: the model is built on the first call and
+    marked in use until the lease's with-block exits."""
+
+    def __init__(self, registry, spec):
+        self.registry = registry
+        self.spec = spec
+        self.upsampler = None
+
+    def __call__(self):
+        if self.upsampler is None:
+            self.upsampler = self.registry.acquire(self.spec)
+        return self.upsampler
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.upsampler is not None:
+            self.registry.release(self.spec)
+            self.upsampler = None
+
+class ModelRegistry:
+    """Caches initialized upsamplers per (architecture, device, precision).
+
+    Models are only built when first acquired. With max_memory set, the least
+    recently used models that are not in use are evicted to stay under the cap.
+    """
+
+    def __init__(self, max_memory=None):
+        self.max_memory = max_memory
+        self._models = OrderedDict() # key -> upsampler, least recently used first
+        self._in_use = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(spec):
+        # Mirrors the device/precision choice made in create_upsampler and apply_backend
+        if torch.cuda.is_available() and spec.backend != 'onnx':
+            return (spec.name, 'cuda', 'fp16', spec.backend)
+        return (spec.name, 'cpu', spec.precision, spec.backend)
+
+    @staticmethod
+    def model_memory(key, upsampler):
+        arch = upsampler.arch
+        bytes_per_value = {'fp16': 2, 'int8': 1}.get(key[2], 4)
+        return rrdbnet_param_count(arch['num_feat'], arch['num_block'], arch['num_grow_ch']) * bytes_per_value
+
+    def lease(self, spec):
+        return ModelLease(self, spec)
+
+    def acquire(self, spec):
+        key = self.key_for(spec)
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = create_upsampler(spec.url, spec.name, spec.scale, num_blocks=spec.num_blocks, backend=spec.backend,
+                                                     precision=spec.precision, calibration=spec.calibration)
+            self._models.move_to_end(key)
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+            self._evict_idle()
+            return self._models[key]
+
+    def release(self, spec):
+        key = self.key_for(spec)
+        with self._lock:
+            if self._in_use.get(key):
+                self._in_use[key] -= 1
+            self._evict_idle()
+
+    def loaded(self):
+        with self._lock:
+            return [key[0] for key in self._models]
+
+    def _evict_idle(self):
+        if not self.max_memory:
+            return
+        total = sum(self.model_memory(key, upsampler) for key, upsampler in self._models.items())
+        for key in list(self._models):
+            if total <= self.max_memory:
+                break
+            if self._in_use.get(key):
+                continue
+            total -= self.model_memory(key, self._models[key])
+            del self._models[key]
+            print(f"Evicted idle model {key[0]} ({key[1]}, {key[2]}, {key[3]}) to stay under the model memory cap.")
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+def rrdbnet_param_count(num_feat, num_block, num_grow_ch, num_in_ch=3, num_out_ch=3):
+    """Number of weights in an RRDBNet with the given layout."""
+    def conv(in_ch, out_ch):
+        return in_ch * out_ch * 9 + out_ch
+    rdb = sum(conv(num_feat + i * num_grow_ch, num_grow_ch) for i in range(4)) + conv(num_feat + 4 * num_grow_ch, num_feat)
+    # conv_first, 3 RDBs per RRDB block, conv_body/conv_up1/conv_up2/conv_hr, conv_last
+    return conv(num_in_ch, num_feat) + 3 * num_block * rdb + 4 * conv(num_feat, num_feat) + conv(num_feat, num_out_ch)
+
+def activation_bytes_per_pixel(num_feat, num_grow_ch, scale, bytes_per_value):
+    """Rough peak activation memory of an RRDBNet forward pass, per input pixel."""
+    # Inside a ResidualDenseBlock the RRDB and RDB inputs, the dense features x1..x4
+    # and the widest concatenation are alive at the same time.
+    trunk = 3 * num_feat + 4 * num_grow_ch + (num_feat + 4 * num_grow_ch)
+    # In the upsampler the interpolated input and the conv output both sit at output resolution.
+    upsample = 2 * num_feat * scale * scale
+    return (max(trunk, upsample) + 3 * scale * scale) * bytes_per_value
+
+def tile_pad_for_model(num_block):
+    """Context pixels each tile gets on every side, growing with the model's depth."""
+    return TILE_PAD_BASE + TILE_PAD_PER_BLOCK * num_block
+
+def estimate_tile_settings(height, width, upsampler, max_memory, in_memory=True):
+    """Picks (tile_size, tile_pad) for an image so one forward pass fits in max_memory bytes.
+
+    tile_size 0 means the whole image fits and no tiling is needed. in_memory False
+    means the input and output frames are memory-mapped files (--stream) and do not
+    count against the budget.
+    """
+    arch = upsampler.arch
+    scale = upsampler.scale
+    bytes_per_value = 2 if upsampler.half else 4
+    tile_pad = tile_pad_for_model(arch['num_block'])
+
+    weights = rrdbnet_param_count(arch['num_feat'], arch['num_block'], arch['num_grow_ch']) * bytes_per_value
+    frame = height * width * 3 * (1 + scale * scale) if in_memory else 0 # uint8 input and assembled output
+    budget = max_memory / TILE_MEMORY_HEADROOM - weights - frame
+    per_pixel = activation_bytes_per_pixel(arch['num_feat'], arch['num_grow_ch'], scale, bytes_per_value)
+
+    if height * width * per_pixel <= budget:
+        return 0, tile_pad
+
+    side = int(math.sqrt(max(budget, 0) / per_pixel)) - 2 * tile_pad
+    tile_size = side // TILE_SIZE_MULTIPLE * TILE_SIZE_MULTIPLE
+    if tile_size < MIN_TILE_SIZE:
+        print(f"    Warning: memory budget too small for this image, using minimum tile size {MIN_TILE_SIZE}.")
+        tile_size = MIN_TILE_SIZE
+    return tile_size, tile_pad
+
+def _is_out_of_memory(error):
+    if isinstance(error, MemoryError):
+        return True
+    message = str(error).lower()
+    return 'out of memory' in message or "can't allocate memory" in message or 'not enough memory' in message
+
+def _to_uint8_image(tensor):
+    """CHW float tensor in [0, 1] -> HWC uint8 array, rounded the same way as RealESRGANer.enhance."""
+    return tensor.float().clamp_(0, 1).mul_(255.0).round_().byte().permute(1, 2, 0).cpu().numpy()
+
+@torch.no_grad()
+def tiled_inference(upsampler, img_np, tile_size, tile_pad, target_size=None, output=None, alpha=None, native_alpha=None):
+    """Upscales an HxWx3 uint8 RGB array tile by tile and returns the uint8 result.
+
+    Each tile is run with tile_pad pixels of surrounding context that are cropped off
+    its output, so neighbouring tiles meet without seams. tile_size 0 runs the whole
+    image in a single pass.
+
+    With target_size (width, height) different from the native output size, each
+    tile's output is Lanczos-resampled straight into a target-sized frame as soon as
+    it is produced, so the full native-scale frame is never held in memory. The tile
+    padding is widened by the filter's support on top of the model's context, which
+    makes the result match resizing the whole native-scale frame afterwards.
+
+    img_np may also be a StreamedImage, whose tiles are read from disk as they are
+    needed, and output an array (e.g. a memory map) of the output size to write into.
+
+    With alpha (the input's HxW alpha channel), tiles that are fully transparent
+    including their padding are not run through the model and stay black.
+    native_alpha, the alpha channel already scaled to the native output size, makes a
+    fused resize work on RGBA tiles: Pillow weights the colour by alpha as it does when
+    resizing the whole RGBA frame, and the output gets the resized alpha as a 4th channel.
+    """
+    scale = upsampler.scale
+    height, width, channels = img_np.shape
+    if tile_size <= 0:
+        tile_size = max(height, width)
+
+    native_width, native_height = width * scale, height * scale
+    fused = target_size is not None and tuple(target_size) != (native_width, native_height)
+    if fused and native_alpha is not None:
+        channels += 1
+    if fused:
+        target_width, target_height = target_size
+        ratio_x, ratio_y = native_width / target_width, native_height / target_height
+        support = LANCZOS_SUPPORT * max(ratio_x, ratio_y, 1.0)
+        # The filter reads native pixels up to its support past the target pixels a tile owns, and
+        # each of those needs the model's own context to match a full-frame pass, so the two add up
+        tile_pad += math.ceil((support + max(ratio_x, ratio_y)) / scale) + 1
+        if output is None:
+            output = np.zeros((target_height, target_width, channels), dtype=np.uint8)
+    elif output is None:
+        output = np.zeros((native_height, native_width, channels), dtype=np.uint8)
+    skipped = tiles = 0
+
+    def target_boundary(position, size, ratio, target):
+        # Splits target pixels between tiles; shared by neighbouring tiles so nothing is skipped or doubled
+        return target if position >= size else int(round(position * scale / ratio))
+
+    for y in range(0, height, tile_size):
+        y_end = min(y + tile_size, height)
+        pad_y, pad_y_end = max(y - tile_pad, 0), min(y_end + tile_pad, height)
+        for x in range(0, width, tile_size):
+            x_end = min(x + tile_size, width)
+            pad_x, pad_x_end = max(x - tile_pad, 0), min(x_end + tile_pad, width)
+            if fused:
+                left, right = target_boundary(x, width, ratio_x, target_width), target_boundary(x_end, width, ratio_x, target_width)
+                top, bottom = target_boundary(y, height, ratio_y, target_height), target_boundary(y_end, height, ratio_y, target_height)
+                if right <= left or bottom <= top:
+                    continue
+            tiles += 1
+            if alpha is not None and not alpha[pad_y:pad_y_end, pad_x:pad_x_end].any():
+                skipped += 1
+                continue
+
+            tile = torch.from_numpy(np.ascontiguousarray(img_np[pad_y:pad_y_end, pad_x:pad_x_end])).permute(2, 0, 1).unsqueeze(0)
+            tile = tile.to(upsampler.device).float().div_(255.0)
+            if upsampler.half:
+                tile = tile.half()
+            out_tile = upsampler.model(tile)
+
+            if fused:
+                # The box is this tile's share of the target in native-scale coordinates relative to
+                # the padded tile, so Pillow samples exactly the pixels a full-frame resize would.
+                tile_np = _to_uint8_image(out_tile[0])
+                if native_alpha is not None:
+                    tile_np = np.dstack([tile_np, native_alpha[pad_y * scale:pad_y_end * scale, pad_x * scale:pad_x_end * scale]])
+                tile_img = Image.fromarray(tile_np)
+                box = (left * ratio_x - pad_x * scale, top * ratio_y - pad_y * scale,
+                       right * ratio_x - pad_x * scale, bottom * ratio_y - pad_y * scale)
+                output[top:bottom, left:right] = np.asarray(tile_img.resize((right - left, bottom - top), Image.Resampling.LANCZOS, box=box))
+                del tile_img, tile_np
+            else:
+                crop_top, crop_left = (y - pad_y) * scale, (x - pad_x) * scale
+                out_tile = out_tile[0, :, crop_top:crop_top + (y_end - y) * scale, crop_left:crop_left + (x_end - x) * scale]
+                output[y * scale:y_end * scale, x * scale:x_end * scale] = _to_uint8_image(out_tile)
+            del tile, out_tile
+
+    if skipped:
+        print(f"    Skipped {skipped} of {tiles} tile(s) that are fully transparent.")
+    return output
+
+def enhance_image(upsampler, img_np, max_memory=None, target_size=None, output=None, alpha=None, native_alpha=None):
+    """AI upscales img_np at the model's native scale.
+
+    With max_memory set, the tile size and padding are picked for this image so the
+    forward pass fits the budget. If an allocation still fails, the tile size is
+    halved and the image retried, down to MIN_TILE_SIZE. With target_size (width,
+    height) the output is resampled to that size tile by tile (see tiled_inference).
+    With output (a memory-mapped file, see upscale_streamed) tiles are written into it.
+    With alpha, fully transparent tiles skip the model (see transparent_tile_size()),
+    and with native_alpha a fused resize is done on RGBA tiles (see tiled_inference).
+    """
+    height, width = img_np.shape[:2]
+    tile_size, tile_pad = 0, tile_pad_for_model(upsampler.arch['num_block'])
+    if max_memory:
+        tile_size, tile_pad = estimate_tile_settings(height, width, upsampler, max_memory, in_memory=output is None)
+        if tile_size:
+            print(f"    Tiling at {tile_size}px (pad {tile_pad}) to stay within the memory budget.")
+    if output is not None and tile_size == 0 and max(height, width) > STREAM_TILE_SIZE:
+        # Only tiles keep memory bounded when neither frame is held in memory
+        tile_size = STREAM_TILE_SIZE
+    if alpha is not None and tile_size == 0:
+        tile_size = transparent_tile_size(alpha, tile_pad)
+    if target_size is not None and not max_memory and tile_size == 0 and max(height, width) > FUSED_TILE_SIZE:
+        # Resampling per tile only saves memory if there is more than one tile. With a budget the
+        # estimate above already picked the largest tile that fits (0 if the whole image does).
+        tile_size = FUSED_TILE_SIZE
+
+    while True:
+        try:
+            return tiled_inference(upsampler, img_np, tile_size, tile_pad, target_size, output, alpha, native_alpha)
+        except (RuntimeError, MemoryError) as e:
+            if not _is_out_of_memory(e):
+                raise
+        # Retry outside the except block so the failed attempt's tensors are released first
+        previous_tile_size = tile_size or max(height, width)
+        tile_size = previous_tile_size // 2 // TILE_SIZE_MULTIPLE * TILE_SIZE_MULTIPLE
+        if tile_size < MIN_TILE_SIZE:
+            raise MemoryError(f"Out of memory even at the minimum tile size ({MIN_TILE_SIZE}px).")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"    Out of memory with tile size {previous_tile_size}px, retrying with {tile_size}px...")
+
+def transparent_tile_size(alpha, tile_pad):
+    """ALPHA_TILE_SIZE if skipping its fully transparent tiles is cheaper than one pass over
+    the whole image (tiles pay for their padding), else 0."""
+    height, width = alpha.shape
+    if max(height, width) <= ALPHA_TILE_SIZE:
+        return 0
+    tiles = visible = 0
+    for y in range(0, height, ALPHA_TILE_SIZE):
+        for x in range(0, width, ALPHA_TILE_SIZE):
+            tiles += 1
+            if alpha[max(y - tile_pad, 0):y + ALPHA_TILE_SIZE + tile_pad, max(x - tile_pad, 0):x + ALPHA_TILE_SIZE + tile_pad].any():
+                visible += 1
+    padded_cost = ((ALPHA_TILE_SIZE + 2 * tile_pad) / ALPHA_TILE_SIZE) ** 2
+    return ALPHA_TILE_SIZE if visible / tiles * padded_cost < 1 else 0
+
+def upscale_alpha(upsampler, alpha, size, alpha_mode, max_memory=None):
+    """Scales an HxW alpha channel to size (width, height): resampled with Lanczos or bicubic,
+    or with alpha_mode 'model' run through the model as a grey image."""
+    if alpha_mode == 'model':
+        alpha_rgb = np.repeat(alpha[:, :, None], 3, axis=2)
+        native_size = (alpha.shape[1] * upsampler.scale, alpha.shape[0] * upsampler.scale)
+        upscaled = enhance_image(upsampler, alpha_rgb, max_memory, None if size == native_size else size)
+        return upscaled.mean(axis=2).round().astype(np.uint8)
+    resample = Image.Resampling.LANCZOS if alpha_mode == 'lanczos' else Image.Resampling.BICUBIC
+    return np.asarray(Image.fromarray(alpha).resize(size, resample))
+
+def enhance_with_alpha(upsampler, img_np, options, target_size=None):
+    """enhance_image for HxWx3 RGB or HxWx4 RGBA arrays. The color goes through the model
+    (skipping fully transparent tiles) and the alpha channel takes options.alpha_mode's path.
+
+    With a fused resize the alpha is scaled to the native size first and each tile is
+    resized together with it, so the result matches resizing the whole RGBA frame.
+    """
+    if img_np.shape[2] != 4:
+        return enhance_image(upsampler, img_np, options.max_memory, target_size)
+    rgb, alpha = np.ascontiguousarray(img_np[:, :, :3]), np.ascontiguousarray(img_np[:, :, 3])
+    native_size = (alpha.shape[1] * upsampler.scale, alpha.shape[0] * upsampler.scale)
+    if target_size is not None and tuple(target_size) != native_size:
+        native_alpha = upscale_alpha(upsampler, alpha, native_size, options.alpha_mode, options.max_memory)
+        return enhance_image(upsampler, rgb, options.max_memory, target_size, alpha=alpha, native_alpha=native_alpha)
+    output = enhance_image(upsampler, rgb, options.max_memory, target_size, alpha=alpha)
+    alpha = upscale_alpha(upsampler, alpha, (output.shape[1], output.shape[0]), options.alpha_mode, options.max_memory)
+    return np.dstack([output, alpha])
+
+def target_size_for(input_size, target_output_scale_factor):
+    """(width, height) of the final output for an input of input_size (width, height)."""
+    return (int(input_size[0] * target_output_scale_factor), int(input_size[1] * target_output_scale_factor))
+
+def compare_images(reference, candidate):
+    """Difference between two same-sized uint8 images: max/mean absolute error and PSNR in dB."""
+    diff = np.abs(reference.astype(np.int16) - candidate.astype(np.int16))
+    mse = float(np.mean(np.square(diff, dtype=np.float64)))
+    psnr = float('inf') if mse == 0 else 10 * math.log10(255.0 ** 2 / mse)
+    return {'max_abs_diff': int(diff.max()), 'mean_abs_diff': float(diff.mean()), 'psnr': psnr}
+
+def _premultiplied(img_np):
+    """RGBA with the colour weighted by alpha, i.e. what is visible of each pixel."""
+    alpha = img_np[:, :, 3:].astype(np.float32) / 255.0
+    return np.dstack([(img_np[:, :, :3] * alpha).round().astype(np.uint8), img_np[:, :, 3]])
+
+def check_fused_resize(upsampler, img_np, fused_output, options):
+    """Compares a fused-resize output against upscaling the whole frame and resizing it afterwards.
+
+    RGBA outputs are compared premultiplied: the colour of a nearly transparent pixel
+    is its visible colour scaled up by 1/alpha, so tiny rounding differences there
+    would otherwise count as large ones.
+    """
+    target_size = (fused_output.shape[1], fused_output.shape[0])
+    reference = enhance_with_alpha(upsampler, img_np, options)
+    reference = np.asarray(Image.fromarray(reference).resize(target_size, Image.Resampling.LANCZOS))
+    if fused_output.shape[2] == 4:
+        reference, fused_output = _premultiplied(reference), _premultiplied(fused_output)
+    stats = compare_images(reference, fused_output)
+    verdict = "OK" if stats['psnr'] >= FUSED_MIN_PSNR else "MISMATCH"
+    print(f"    Fused resize check: {verdict} (max diff {stats['max_abs_diff']}, mean diff {stats['mean_abs_diff']:.4f}, PSNR {stats['psnr']:.1f} dB)")
+    return stats
+
+class StreamedImage:
+    """An input image that is read region by region instead of being decoded whole (--stream).
+
+    .npy arrays and uncompressed TIFFs are memory-mapped; compressed or tiled TIFFs are
+    read through zarr when it is installed. Anything else is decoded into memory.
+    Slicing returns HxWx3 uint8 regions whatever the file's bit depth or channel count.
+    """
+
+    def __init__(self, img_path):
+        self._store = None
+        suffix = img_path.suffix.lower()
+        if suffix == '.npy':
+            array = np.load(img_path, mmap_mode='r')
+        elif suffix in ('.tif', '.tiff') and tifffile is not None:
+            array = self._open_tiff(img_path)
+        else:
+            print(f"    {img_path.name} cannot be read by region; decoding it into memory.")
+            array = decode_image(img_path)
+        if array.ndim not in (2, 3):
+            raise ValueError(f"Expected a 2-D or 3-D image array, got shape {array.shape}")
+        # Planar samples (channels first), as in planar TIFFs; zarr arrays can't be transposed
+        # as a view, so regions are read across all planes and transposed in __getitem__
+        self._planar = array.ndim == 3 and array.shape[0] in (3, 4) and array.shape[2] not in (3, 4)
+        self.array = array
+        self.shape = (array.shape[1], array.shape[2], 3) if self._planar else (array.shape[0], array.shape[1], 3)
+
+    def _open_tiff(self, img_path):
+        try:
+            return tifffile.memmap(str(img_path), mode='r')
+        except ValueError:
+            pass # compressed, tiled or not stored contiguously
+        if zarr is not None:
+            self._store = tifffile.imread(str(img_path), aszarr=True)
+            array = zarr.open(self._store, mode='r')
+            return array if hasattr(array, 'shape') else array['0'] # pyramids open as a group; level 0 is full size
+        print(f"    {img_path.name} is compressed; decoding it into memory (install zarr to read it by region).")
+        return tifffile.imread(str(img_path))
+
+    def __getitem__(self, key):
+        if self._planar:
+            region = np.asarray(self.array[(slice(None),) + (key if isinstance(key, tuple) else (key,))]).transpose(1, 2, 0)
+        else:
+            region = np.asarray(self.array[key])
+        if region.ndim == 2:
+            region = region[:, :, None]
+        if region.shape[2] < 3:
+            region = np.repeat(region[:, :, :1], 3, axis=2)
+        region = region[:, :, :3]
+        if region.dtype.kind == 'u' and region.dtype.itemsize > 1:
+            region = (region >> (8 * (region.dtype.itemsize - 1))).astype(np.uint8)
+        elif region.dtype.kind == 'f':
+            region = (np.clip(region, 0, 1) * 255.0).round().astype(np.uint8)
+        elif region.dtype != np.uint8:
+            raise ValueError(f"Unsupported sample type {region.dtype}")
+        return region
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+        self.array = None
+
+def stream_output_extension():
+    return '.tif' if tifffile is not None else '.npy'
+
+def create_streamed_output(path, shape):
+    """Creates a memory-mapped uint8 output file of shape: an uncompressed BigTIFF with tifffile, else a .npy."""
+    if tifffile is not None:
+        return tifffile.memmap(str(path), shape=shape, dtype=np.uint8, photometric='rgb', bigtiff=True)
+    return np.lib.format.open_memmap(str(path), mode='w+', dtype=np.uint8, shape=shape)
+
+def upscale_streamed(upsampler, image, output_save_path, target_output_scale_factor, max_memory=None):
+    """Upscales a StreamedImage tile by tile straight into a memory-mapped output file.
+
+    Neither frame is held in memory, so peak memory follows the tile size rather than
+    the image size. A resize to the target scale is always fused into the tiles.
+    Returns the bytes written and the seconds spent, as result record fields.
+    """
+    height, width = image.shape[:2]
+    target_width, target_height = target_size_for((width, height), target_output_scale_factor)
+    native_size = (width * upsampler.scale, height * upsampler.scale)
+    target_size = None if (target_width, target_height) == native_size else (target_width, target_height)
+
+    temp_path = _temp_path_for(output_save_path)
+    started = time.perf_counter()
+    try:
+        output = create_streamed_output(temp_path, (target_height, target_width, 3))
+        enhance_image(upsampler, image, max_memory, target_size, output=output)
+        output.flush()
+        del output
+        os.replace(temp_path, output_save_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    output_bytes = output_save_path.stat().st_size
+    print(f"  Saved: {output_save_path} ({output_bytes / 1024 / 1024:.1f} MiB, streamed)")
+    return {'bytes': output_bytes, 'infer_seconds': time.perf_counter() - started}
+
+def output_filename_for(img_path, filename_suffix, target_output_scale_factor, extension='.png'):
+    """Name of the output file for img_path, e.g. 'cat-RealESRGAN_x4plus-out2x.png'."""
+    if target_output_scale_factor == int(target_output_scale_factor):
+        scale_str = f"{int(target_output_scale_factor)}x"
+    else:
+        scale_str = f"{target_output_scale_factor:.1f}x".replace(".0x","x")
+    return f"{img_path.stem}{filename_suffix}-out{scale_str}{extension}"
+
+def encoder_settings(options):
+    """(Pillow format, save() keyword arguments) for writing outputs as options.format.
+
+    compress_level is zlib's level for PNG and is scaled onto WebP's 0-6 effort
+    ("method"); TIFF is stored uncompressed at 0 and deflated otherwise, and JPEG
+    and GIF ignore it.
+    """
+    image_format = OUTPUT_FORMATS[options.format][0]
+    level = options.compress_level
+    if options.format == 'png':
+        return image_format, {'compress_level': level, 'optimize': options.optimize}
+    if options.format == 'webp':
+        return image_format, {'lossless': options.lossless, 'quality': options.quality,
+                              'method': 6 if options.optimize else round(level * 6 / 9)}
+    if options.format == 'jpeg':
+        return image_format, {'quality': options.quality, 'optimize': options.optimize}
+    if options.format == 'gif':
+        return image_format, {'optimize': options.optimize}
+    if level == 0:
+        return image_format, {'compression': 'raw'}
+    return image_format, {'compression': 'tiff_adobe_deflate'}
+
+# --- Batching ---
+BATCH_BUCKET_MULTIPLE = 16 # images whose sides round up to the same multiple share a batch
+BATCH_MAX_PIXELS = 512 * 512 # without --max-memory, only images up to this size are batched
+
+def batch_bucket(height, width):
+    """Batch group for an image: its size rounded up to BATCH_BUCKET_MULTIPLE."""
+    return (-(-height // BATCH_BUCKET_MULTIPLE) * BATCH_BUCKET_MULTIPLE,
+            -(-width // BATCH_BUCKET_MULTIPLE) * BATCH_BUCKET_MULTIPLE)
+
+def _is_batchable(img_np, batch_size, max_memory, upsampler):
+    if img_np.shape[2] != 3:
+        return False # the alpha channel takes its own path
+    height, width = batch_bucket(img_np.shape[0], img_np.shape[1])
+    if not max_memory or callable(upsampler):
+        return height * width <= BATCH_MAX_PIXELS
+    # A full batch costs about as much as one image with batch_size times the rows
+    tile_size, _ = estimate_tile_settings(height * batch_size, width, upsampler, max_memory)
+    return tile_size == 0
+
+@torch.no_grad()
+def batched_inference(upsampler, images):
+    """Upscales a list of uint8 RGB arrays in a single forward pass.
+
+    Smaller images are edge-padded to the largest height and width in the batch and
+    their outputs cropped back, so one batch can mix sizes from the same bucket.
+    """
+    scale = upsampler.scale
+    height = max(img.shape[0] for img in images)
+    width = max(img.shape[1] for img in images)
+
+    batch = np.empty((len(images), height, width, 3), dtype=np.uint8)
+    for i, img in enumerate(images):
+        batch[i] = np.pad(img, ((0, height - img.shape[0]), (0, width - img.shape[1]), (0, 0)), mode='edge')
+    batch_tensor = torch.from_numpy(batch).permute(0, 3, 1, 2).to(upsampler.device).float().div_(255.0)
+    del batch
+    if upsampler.half:
+        batch_tensor = batch_tensor.half()
+
+    output = upsampler.model(batch_tensor)
+    return [_to_uint8_image(output[i, :, :img.shape[0] * scale, :img.shape[1] * scale]) for i, img in enumerate(images)]
+
+def enhance_batch(upsampler, images, max_memory=None):
+    """Batched counterpart of enhance_image; an out-of-memory batch is split in half and retried."""
+    if len(images) == 1:
+        return [enhance_image(upsampler, images[0], max_memory)]
+    try:
+        return batched_inference(upsampler, images)
+    except (RuntimeError, MemoryError) as e:
+        if not _is_out_of_memory(e):
+            raise
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    half = len(images) // 2
+    print(f"    Out of memory with a batch of {len(images)}, splitting...")
+    return enhance_batch(upsampler, images[:half], max_memory) + enhance_batch(upsampler, images[half:], max_memory)
+
+def _image_size(img_path):
+    try:
+        with Image.open(img_path) as img:
+            return img.size
+    except Exception:
+        return (0, 0)
+
+# --- Result cache ---
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent / ".upscale_cache"
+
+FICLONE = 0x40049409 # Linux ioctl for a copy-on-write clone (btrfs, XFS, bcachefs)
+
+def _reflink(source, destination):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError("reflinks are not supported on this platform")
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+def _symlink(source, destination):
+    os.symlink(os.path.abspath(source), destination)
+
+def _link_or_copy(source, destination, symlink=False):
+    """Places source's contents at destination (replacing it) without copying them if possible.
+
+    Tries a hardlink, then a reflink, then with symlink=True a symlink; the data is
+    only copied when none of those work, e.g. across filesystems. Returns the method used.
+    """
+    destination = Path(destination)
+    temp_path = _temp_path_for(destination)
+    methods = [('hardlink', os.link), ('reflink', _reflink)]
+    if symlink:
+        methods.append(('symlink', _symlink))
+    for method, make_link in methods:
+        try:
+            make_link(source, temp_path)
+            break
+        except OSError:
+            temp_path.unlink(missing_ok=True)
+    else:
+        method = 'copy'
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+    return method
+
+def cache_settings(filename_suffix, target_output_scale_factor, options):
+    """Everything besides the input bytes that changes the output file."""
+    return {
+        'model': filename_suffix,
+        'scale': target_output_scale_factor,
+        'max_memory': options.max_memory, # tiling can shift pixel values slightly
+        'precision': 'fp16' if torch.cuda.is_available() and options.backend != 'onnx' else options.precision,
+        'backend': options.backend,
+        'fused_resize': options.fused_resize and target_output_scale_factor != MODEL_NATIVE_SCALE,
+        'alpha_mode': options.alpha_mode,
+        'encoder': 'stream' + stream_output_extension() if options.stream else encoder_settings(options),
+    }
+
+class ResultCache:
+    """Content-addressed store of finished outputs, bounded in size with LRU eviction.
+
+    Entries are keyed by the SHA-256 of the input file plus cache_settings(). Hits are
+    hardlinked (or copied) into place; every hit refreshes the entry's mtime, and the
+    oldest entries are evicted once the store grows past max_size bytes. The store's
+    size is scanned once when the cache is opened and then kept as a running total,
+    so the entries are only walked when an eviction is actually needed.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total = sum(size for _, size, _ in self._entries())
+
+    @classmethod
+    def from_options(cls, options):
+        if not options.cache_dir:
+            return None
+        return cls(options.cache_dir, options.cache_size)
+
+    def key_for(self, img_path, settings):
+        digest = hashlib.sha256()
+        with open(img_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entry_path(self, key, suffix):
+        return self.cache_dir / key[:2] / f"{key}{suffix}"
+
+    def fetch(self, key, output_save_path):
+        """Places the cached output for key at output_save_path. Returns False on a miss."""
+        entry = self._entry_path(key, output_save_path.suffix)
+        try:
+            os.utime(entry) # mark as recently used
+            _link_or_copy(entry, output_save_path)
+        except OSError:
+            return False
+        return True
+
+    def store(self, key, output_save_path):
+        entry = self._entry_path(key, output_save_path.suffix)
+        try:
+            replaced = entry.stat().st_size
+        except OSError:
+            replaced = 0
+        try:
+            entry.parent.mkdir(exist_ok=True)
+            _link_or_copy(output_save_path, entry)
+            added = entry.stat().st_size
+        except OSError as e:
+            print(f"    Warning: could not add {output_save_path.name} to the cache: {e}")
+            return
+        with self._lock:
+            self._total += added - replaced
+            if self._total > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        """(mtime, size, path) of every entry in the store."""
+        entries = []
+        for entry in self.cache_dir.glob('*/*'):
+            if entry.name.startswith('.'):
+                continue # another process's in-flight temp file
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        return entries
+
+    def _evict(self):
+        # Re-walked here rather than trusted, since other runs may share the store
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                entry.unlink()
+                total -= size
+            except OSError:
+                pass
+        self._total = total
+
+# --- Job manifest ---
+MANIFEST_FILENAME = "upscale_manifest.jsonl"
+
+class JobManifest:
+    """Append-only JSON-lines record of per-file progress for resuming interrupted runs.
+
+    Each line is one event ('start', 'done' or 'error') for an input file, with its
+    output path and timing. Completions are fsynced so they survive a crash or reboot.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self.entries = self._load() if resume else {}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Latest entry per input path. A torn last line from a killed run is ignored."""
+        entries = {}
+        if not self.path.exists():
+            return entries
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[entry.get('input')] = entry
+        return entries
+
+    def record(self, event, img_path, **fields):
+        entry = {'event': event, 'input': str(img_path), 'time': time.time()}
+        entry.update({name: str(value) if isinstance(value, Path) else value for name, value in fields.items()})
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            if event != 'start':
+                os.fsync(self._file.fileno())
+
+    def record_result(self, img_path, record):
+        if record.get('error') is not None:
+            self.record('error', img_path, error=record['error'])
+            return
+        try:
+            input_stat = img_path.stat()
+            output_bytes = record['output'].stat().st_size
+        except OSError:
+            return
+        self.record('done', img_path, output=record['output'], seconds=round(record.get('seconds', 0.0), 3),
+                    bytes=output_bytes, input_mtime=input_stat.st_mtime, input_size=input_stat.st_size,
+                    cache_hit=record.get('cache_hit', False), encode_seconds=round(record.get('encode_seconds', 0.0), 3))
+
+    def is_complete(self, img_path, output_save_path):
+        """True if a previous run already produced a valid output for img_path."""
+        entry = self.entries.get(str(img_path))
+        if entry is None or entry.get('output') != str(output_save_path) or not output_save_path.exists():
+            return False
+        if entry['event'] == 'done':
+            try:
+                input_stat = img_path.stat()
+            except OSError:
+                return False
+            return (entry.get('input_mtime') == input_stat.st_mtime and entry.get('input_size') == input_stat.st_size
+                    and entry.get('bytes') == output_save_path.stat().st_size)
+        if entry['event'] == 'start':
+            # Killed between writing the output and recording it: keep it only if it decodes
+            if _is_readable_image(output_save_path):
+                self.record_result(img_path, {'error': None, 'output': output_save_path})
+                return True
+            output_save_path.unlink(missing_ok=True)
+        return False
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# --- Up-to-date outputs ---
+SIDECAR_FILENAME = ".upscale_outputs.jsonl"
+
+def settings_digest(filename_suffix, target_output_scale_factor, options):
+    settings = cache_settings(filename_suffix, target_output_scale_factor, options)
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+class OutputSidecar:
+    """Records, next to the outputs, which input state and settings produced each output file.
+
+    One JSON line per output written (the latest line wins), keyed by the output path
+    relative to the output directory. With --incremental an output is current when it
+    exists, is not older than its input, still has the recorded size and was made from
+    an input of the recorded size and mtime with the same settings; such images are
+    skipped before any model is loaded.
+    """
+
+    def __init__(self, output_dir_path, settings):
+        self.output_dir_path = output_dir_path
+        self.path = output_dir_path / SIDECAR_FILENAME
+        self.settings = settings
+        self.entries = self._load()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def _load(self):
+        entries = {}
+        lines = 0
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries[entry.get('output')] = entry
+        except FileNotFoundError:
+            return entries
+        if lines > 2 * len(entries) + 100:
+            # Mostly superseded lines from earlier runs; rewrite it with the latest entry per output
+            temp_path = _temp_path_for(self.path)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in entries.values())
+            os.replace(temp_path, self.path)
+        return entries
+
+    def _key(self, output_save_path):
+        return output_save_path.relative_to(self.output_dir_path).as_posix()
+
+    def is_current(self, img_path, output_save_path):
+        entry = self.entries.get(self._key(output_save_path))
+        if entry is None or entry.get('settings') != self.settings:
+            return False
+        try:
+            input_stat = img_path.stat()
+            output_stat = output_save_path.stat()
+        except OSError:
+            return False
+        return (output_stat.st_mtime_ns >= input_stat.st_mtime_ns and output_stat.st_size == entry.get('bytes')
+                and input_stat.st_size == entry.get('input_size') and input_stat.st_mtime_ns == entry.get('input_mtime_ns'))
+
+    def record_result(self, img_path, record):
+        if record.get('error') is not None or record.get('output') is None:
+            return
+        try:
+            input_stat = img_path.stat()
+            output_bytes = record['output'].stat().st_size
+        except OSError:
+            return
+        entry = {'output': self._key(record['output']), 'input': str(img_path), 'settings': self.settings,
+                 'input_size': input_stat.st_size, 'input_mtime_ns': input_stat.st_mtime_ns, 'bytes': output_bytes}
+        with self._lock:
+            self.entries[entry['output']] = entry
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+# --- Metrics and profiling ---
+METRICS_FORMATS = ['jsonl', 'csv', 'prometheus']
+METRICS_STAGES = ['decode', 'infer', 'resize', 'encode']
+PROFILE_STATS_FILENAME = "upscale_profile.pstats"
+PROFILE_TRACE_FILENAME = "upscale_trace.json"
+
+def process_peak_rss():
+    """Peak resident set size of this process so far in bytes, or None where unavailable.
+
+    This is the high-water mark of the whole process (models, other images in the
+    pipeline, earlier images), not of any one image, hence the process_ field names.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # kilobytes everywhere but macOS
+
+def reset_peak_torch_memory():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+def peak_torch_memory():
+    """Peak bytes allocated by torch on the GPU since the last reset, or None on CPU."""
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated()
+    return None
+
+class MetricsWriter:
+    """Per-image stage timings and memory peaks as JSON lines, CSV or a Prometheus textfile.
+
+    JSON lines and CSV rows are appended as each image finishes. The Prometheus
+    textfile holds totals over the run and is replaced atomically on close, so a
+    node_exporter textfile collector never reads a partial file.
+    """
+
+    FIELDS = ['time', 'input', 'output', 'status', 'cache_hit'] + [f"{stage}_ms" for stage in METRICS_STAGES] + \
+             ['total_ms', 'bytes', 'process_peak_rss_bytes', 'peak_torch_bytes']
+
+    def __init__(self, path, metrics_format='jsonl'):
+        self.path = Path(path)
+        self.format = metrics_format
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._totals = {'images': {}, 'seconds': dict.fromkeys(METRICS_STAGES, 0.0), 'bytes': 0,
+                        'process_peak_rss_bytes': None, 'peak_torch_bytes': None}
+        if metrics_format == 'prometheus':
+            return
+        write_header = metrics_format == 'csv' and (not self.path.exists() or self.path.stat().st_size == 0)
+        self._file = open(self.path, 'a', encoding='utf-8', newline='')
+        if metrics_format == 'csv':
+            self._csv = csv.DictWriter(self._file, fieldnames=self.FIELDS)
+            if write_header:
+                self._csv.writeheader()
+
+    @classmethod
+    def from_options(cls, options):
+        if not options.metrics:
+            return None
+        return cls(options.metrics, options.metrics_format)
+
+    def record(self, img_path, record):
+        status = 'error' if record.get('error') is not None else 'cached' if record.get('cache_hit') else 'done'
+        row = {'time': time.time(), 'input': str(img_path), 'output': str(record.get('output', '')), 'status': status,
+               'cache_hit': bool(record.get('cache_hit'))}
+        for stage in METRICS_STAGES:
+            seconds = record.get(f"{stage}_seconds")
+            row[f"{stage}_ms"] = round(seconds * 1000, 2) if seconds is not None else None
+        row['total_ms'] = round(record['seconds'] * 1000, 2) if 'seconds' in record else None
+        for field in ('bytes', 'process_peak_rss_bytes', 'peak_torch_bytes'):
+            row[field] = record.get(field)
+
+        with self._lock:
+            totals = self._totals
+            totals['images'][status] = totals['images'].get(status, 0) + 1
+            for stage in METRICS_STAGES:
+                totals['seconds'][stage] += record.get(f"{stage}_seconds") or 0.0
+            totals['bytes'] += row['bytes'] or 0
+            for field in ('process_peak_rss_bytes', 'peak_torch_bytes'):
+                if row[field] is not None:
+                    totals[field] = max(totals[field] or 0, row[field])
+            if self.format == 'jsonl':
+                self._file.write(json.dumps(row) + "\n")
+            elif self.format == 'csv':
+                self._csv.writerow(row)
+            if self._file is not None:
+                self._file.flush()
+
+    def _prometheus_text(self):
+        totals = self._totals
+        lines = ["# HELP upscale_images_total Images finished, by status.", "# TYPE upscale_images_total counter"]
+        lines += [f'upscale_images_total{{status="{status}"}} {count}' for status, count in sorted(totals['images'].items())]
+        lines += ["# HELP upscale_stage_seconds_total Time spent in each stage.", "# TYPE upscale_stage_seconds_total counter"]
+        lines += [f'upscale_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}' for stage, seconds in totals['seconds'].items()]
+        lines += ["# HELP upscale_output_bytes_total Bytes of output written.", "# TYPE upscale_output_bytes_total counter",
+                  f"upscale_output_bytes_total {totals['bytes']}"]
+        for field, help_text in (('process_peak_rss_bytes', 'Peak resident set size of the process over the run.'),
+                                 ('peak_torch_bytes', 'Peak GPU memory allocated by torch for one image.')):
+            if totals[field] is not None:
+                lines += [f"# HELP upscale_{field} {help_text}", f"# TYPE upscale_{field} gauge", f"upscale_{field} {totals[field]}"]
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        with self._lock:
+            if self.format == 'prometheus':
+                temp_path = _temp_path_for(self.path)
+                temp_path.write_text(self._prometheus_text(), encoding='utf-8')
+                os.replace(temp_path, self.path)
+            else:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+@contextlib.contextmanager
+def profile_run(output_dir):
+    """Runs the with-block under cProfile and torch.profiler and writes both to output_dir.
+
+    cProfile only sees the thread that entered the block (where inference runs);
+    the torch trace covers operators from every thread.
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    profiler = cProfile.Profile()
+    torch_profiler = torch.profiler.profile(activities=activities)
+    try:
+        with torch_profiler:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+    finally:
+        stats_path = Path(output_dir) / PROFILE_STATS_FILENAME
+        trace_path = Path(output_dir) / PROFILE_TRACE_FILENAME
+        profiler.dump_stats(stats_path)
+        torch_profiler.export_chrome_trace(str(trace_path))
+        print(f"\nProfile written to {stats_path} (cProfile) and {trace_path} (chrome://tracing).")
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(15)
+
+# --- Progress events ---
+EVENT_PREFIX = "@@EVENT " # also parsed by gui.py
+
+class LineWriter:
+    """Wraps a stream so that only whole lines are written, each in one write under a lock.
+
+    print() writes its text and its newline separately, so output from one thread could
+    otherwise land in the middle of another thread's line (splitting '@@EVENT' lines
+    that the GUI then can't parse). Partial lines wait in a per-thread buffer.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._partial = threading.local()
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        lines, newline, rest = (getattr(self._partial, 'text', '') + text).rpartition("\n")
+        self._partial.text = rest
+        if newline:
+            with self._lock:
+                self.stream.write(lines + newline)
+                self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        text, self._partial.text = getattr(self._partial, 'text', ''), ''
+        with self._lock:
+            if text:
+                self.stream.write(text)
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class ProgressEvents:
+    """Machine-readable progress on stdout, one '@@EVENT {json}' line per event.
+
+    'start' gives the number of images in the run (null when the input folders are
+    walked as the run goes, in which case 'total' grows as images are found),
+    'progress' marks an image going into the model, 'done' and 'error' report a finished image (with its timings and
+    how many are complete so far) and 'finish' closes the run with its status. Used
+    as a context manager around the run, which emits 'start' and 'finish'.
+    """
+
+    def __init__(self, total=None, should_stop=None):
+        # Without a total up front, it counts the images as they are found (see file_found())
+        self.counting = total is None
+        self.total = 0 if total is None else total
+        self.should_stop = should_stop
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self._start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        # A whole line per write; with stdout wrapped in a LineWriter (see main()) other
+        # threads' prints can't split it either
+        line = EVENT_PREFIX + json.dumps({'event': event, **fields}, default=str) + "\n"
+        with self._lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+    def file_found(self):
+        if self.counting:
+            with self._lock:
+                self.total += 1
+
+    def file_started(self, img_path):
+        with self._lock:
+            self.started += 1
+            index = self.started
+        self.emit('progress', input=img_path, index=index, total=self.total)
+
+    def file_finished(self, img_path, record):
+        with self._lock:
+            self.completed += 1
+            if record.get('error') is not None:
+                self.failed += 1
+            completed = self.completed
+        fields = {name: value for name, value in record.items() if name != 'error'}
+        if record.get('error') is not None:
+            self.emit('error', input=img_path, error=record['error'], completed=completed, total=self.total)
+        else:
+            self.emit('done', input=img_path, completed=completed, total=self.total, **fields)
+
+    def __enter__(self):
+        self.emit('start', total=None if self.counting else self.total)
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is not None:
+            status = 'error'
+        elif self.should_stop is not None and self.should_stop():
+            status = 'cancelled'
+        else:
+            status = 'done'
+        self.emit('finish', status=status, completed=self.completed, failed=self.failed, total=self.total,
+                  seconds=round(time.perf_counter() - self._start_time, 3))
+
+# --- Per-file stages ---
+# decode_image -> enhance_image -> finish_output (resize + save). upscale_file runs them
+# back to back; the pipeline in _process_pipelined overlaps them across threads.
+# Each image ends up as a result record: {'error', 'output', 'cache_hit', 'seconds'}
+# plus per-stage '<stage>_seconds', 'bytes' and memory peaks for processed images.
+
+def _has_alpha(img):
+    return img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in img.info
+
+def decode_image(img_path, keep_alpha=False):
+    """Loads an image file as an HxWx3 uint8 RGB array.
+
+    With keep_alpha, an image with transparency is loaded as HxWx4 RGBA instead,
+    unless its alpha channel turns out to be fully opaque.
+    """
+    if img_path.suffix.lower() == '.npy':
+        return StreamedImage(img_path)[:, :]
+    with Image.open(img_path) as img:
+        if keep_alpha and _has_alpha(img):
+            rgba = np.array(img.convert("RGBA"))
+            if rgba[:, :, 3].min() < 255:
+                return rgba
+            return np.ascontiguousarray(rgba[:, :, :3])
+        return np.array(img.convert("RGB"))
+
+class Animation:
+    """The frames of an animated GIF, APNG or WebP, with each distinct frame stored once.
+
+    frames holds the distinct HxWx3 uint8 frames and order the index into frames of
+    every frame in sequence. durations are in milliseconds; plays is how many times the
+    animation plays in total, 0 for forever (GIF counts repeats instead, see decode_animation()).
+    """
+
+    def __init__(self, frames, order, durations, plays):
+        self.frames = frames
+        self.order = order
+        self.durations = durations
+        self.plays = plays
+
+    @property
+    def shape(self):
+        return self.frames[0].shape
+
+    def with_frames(self, frames):
+        """The same animation with its distinct frames replaced (e.g. by their upscaled versions)."""
+        return Animation(frames, self.order, self.durations, self.plays)
+
+def decode_animation(img_path, keep_alpha=False):
+    """Loads an input with several frames as an Animation, or returns None for a still image.
+
+    Frames are composited onto the full canvas by Pillow and deduplicated by content
+    hash, so a repeated frame is only upscaled once. With keep_alpha, frames of an
+    animation with transparency are RGBA (see decode_image()).
+    """
+    with Image.open(img_path) as img:
+        if getattr(img, 'n_frames', 1) <= 1:
+            return None
+        loop = img.info.get('loop')
+        if img.format == 'GIF':
+            # Repeats after the first play, 0 for forever; a GIF without a loop count plays once
+            plays = 1 if loop is None else 0 if loop == 0 else loop + 1
+        else:
+            plays = 1 if loop is None else loop # APNG and WebP count plays, 0 for forever
+        mode = "RGBA" if keep_alpha and _has_alpha(img) else "RGB"
+        frames, order, durations = [], [], []
+        seen = {} # frame digest -> index into frames
+        for frame_index in range(img.n_frames):
+            img.seek(frame_index)
+            durations.append(img.info.get('duration', 0))
+            frame = np.array(img.convert(mode))
+            digest = hashlib.sha256(frame.tobytes()).digest()
+            if digest not in seen:
+                seen[digest] = len(frames)
+                frames.append(frame)
+            order.append(seen[digest])
+    if mode == "RGBA" and all(frame[:, :, 3].min() == 255 for frame in frames):
+        frames = [np.ascontiguousarray(frame[:, :, :3]) for frame in frames]
+    print(f"    Animation: {len(order)} frames, {len(frames)} distinct ({len(order) - len(frames)} reused).")
+    return Animation(frames, order, durations, plays)
+
+def enhance_animation(upsampler, animation, options, target_size=None):
+    """Upscales each distinct frame of animation once, in batches when --batch-size allows."""
+    frames = animation.frames
+    batch_size = max(1, options.batch_size)
+    if batch_size > 1 and len(frames) > 1 and _is_batchable(frames[0], batch_size, options.max_memory, upsampler):
+        outputs = []
+        for start in range(0, len(frames), batch_size):
+            outputs += enhance_batch(upsampler, frames[start:start + batch_size], options.max_memory)
+    else:
+        outputs = [enhance_with_alpha(upsampler, frame, options, target_size) for frame in frames]
+    return animation.with_frames(outputs)
+
+def _save_animation(frames, animation, output_save_path, options):
+    """Saves the upscaled distinct frames in animation's order and timing. Returns the bytes written."""
+    image_format, save_params = encoder_settings(options)
+    if options.format == 'jpeg':
+        print("    Warning: JPEG can't hold an animation; saving the first frame only (use --format png, webp or gif).")
+        return _atomic_save(frames[animation.order[0]], output_save_path, image_format, **save_params)
+    if options.format != 'tiff': # TIFF keeps the frames as pages but has no timing
+        save_params['duration'] = animation.durations
+        if options.format != 'gif':
+            save_params['loop'] = animation.plays # Pillow would otherwise write 0, i.e. forever
+        elif animation.plays != 1:
+            save_params['loop'] = max(animation.plays - 1, 0) # GIF counts repeats; without one it plays once
+        if options.format == 'gif' and frames[0].mode == 'RGBA':
+            save_params['disposal'] = 2 # clear each frame so transparent areas don't show the previous one
+    sequence = [frames[index] for index in animation.order]
+    return _atomic_save(sequence[0], output_save_path, image_format, save_all=True, append_images=sequence[1:], **save_params)
+
+def finish_output(ai_upscaled_img_np, input_size, output_save_path, model_native_scale, target_output_scale_factor, options):
+    """Resizes the AI output to the target scale if needed and saves it to output_save_path.
+
+    ai_upscaled_img_np may also be an Animation of upscaled frames, which is saved with
+    its input's frame order, timing and loop count.
+    Returns the bytes written and the seconds spent resizing and encoding, as result record fields.
+    """
+    if isinstance(ai_upscaled_img_np, Animation):
+        return _finish_animation(ai_upscaled_img_np, input_size, output_save_path, target_output_scale_factor, options)
+    ai_upscaled_img_pil = Image.fromarray(ai_upscaled_img_np)
+
+    # If target_output_scale_factor is different from model_native_scale,
+    # manually resize using Pillow with Lanczos.
+    final_img_pil = ai_upscaled_img_pil
+    target_width, target_height = target_size_for(input_size, target_output_scale_factor)
+    started = time.perf_counter()
+    if target_output_scale_factor != model_native_scale and ai_upscaled_img_pil.size != (target_width, target_height):
+        print(f"    Resizing from AI x{model_native_scale} ({ai_upscaled_img_pil.width}x{ai_upscaled_img_pil.height}) to target x{target_output_scale_factor} ({target_width}x{target_height}) using Lanczos...")
+        final_img_pil = ai_upscaled_img_pil.resize((target_width, target_height), Image.Resampling.LANCZOS)
+    resize_seconds = time.perf_counter() - started
+
+    image_format, save_params = encoder_settings(options)
+    started = time.perf_counter()
+    output_bytes = _atomic_save(final_img_pil, output_save_path, image_format, **save_params)
+    encode_seconds = time.perf_counter() - started
+    print(f"  Saved: {output_save_path} ({output_bytes / 1024 / 1024:.1f} MiB, encoded in {encode_seconds:.2f}s)")
+    return {'bytes': output_bytes, 'resize_seconds': resize_seconds, 'encode_seconds': encode_seconds}
+
+def _finish_animation(animation, input_size, output_save_path, target_output_scale_factor, options):
+    target_size = target_size_for(input_size, target_output_scale_factor)
+    started = time.perf_counter()
+    frames = []
+    for frame_np in animation.frames:
+        frame = Image.fromarray(frame_np)
+        if frame.size != target_size:
+            frame = frame.resize(target_size, Image.Resampling.LANCZOS)
+        frames.append(frame)
+    resize_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    output_bytes = _save_animation(frames, animation, output_save_path, options)
+    encode_seconds = time.perf_counter() - started
+    print(f"  Saved: {output_save_path} ({len(animation.order)} frames, {output_bytes / 1024 / 1024:.1f} MiB, encoded in {encode_seconds:.2f}s)")
+    return {'bytes': output_bytes, 'resize_seconds': resize_seconds, 'encode_seconds': encode_seconds}
+
+def _temp_path_for(path):
+    return path.with_name(f".{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+
+def _process_is_running(pid):
+    """Whether a process with this id exists. A reused pid only means a temp file is kept a little longer."""
+    if os.name == 'nt':
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.GetLastError() == 5 # ERROR_ACCESS_DENIED: it exists but belongs to someone else
+        exit_code = ctypes.c_ulong()
+        try:
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        finally:
+            kernel32.CloseHandle(handle)
+        return exit_code.value == 259 # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _remove_abandoned_temp_files(paths):
+    """Deletes temp files (see _temp_path_for) whose writing process has exited.
+
+    Ones still being written by a live process, e.g. a --watch run or a server job
+    sharing the output directory, are left alone.
+    """
+    for temp_path in paths:
+        try:
+            pid = int(temp_path.name.rsplit('.', 2)[-2].split('-')[0])
+        except (IndexError, ValueError):
+            continue # not one of ours
+        if not _process_is_running(pid):
+            temp_path.unlink(missing_ok=True)
+
+def _atomic_save(img_pil, output_save_path, image_format, **save_params):
+    """Saves to a temp file, fsyncs it and renames it into place. Returns the bytes written.
+
+    A killed run never leaves a truncated image under the final name, and replacing
+    the directory entry never writes through an output hardlinked to a cache entry.
+    """
+    if image_format == 'JPEG' and img_pil.mode == 'RGBA':
+        img_pil = img_pil.convert("RGB") # JPEG has no alpha channel
+    temp_path = _temp_path_for(output_save_path)
+    try:
+        with open(temp_path, 'wb') as f:
+            img_pil.save(f, format=image_format, **save_params)
+            f.flush()
+            os.fsync(f.fileno())
+            output_bytes = f.tell()
+        os.replace(temp_path, output_save_path)
+        return output_bytes
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+_pixel_limit_lock = threading.Lock()
+
+def _is_readable_image(path):
+    """True if path holds a whole image, judged from its structure without decoding the pixels.
+
+    Outputs only get their final name once fully written, so this just has to reject
+    truncated or foreign files. Decoding would be slow for large outputs, and Pillow
+    refuses to even open ones past its decompression bomb limit, which an x4 output of
+    a 12 MP photo already is. .npy and BigTIFF outputs of --stream are checked against
+    their headers with numpy and tifffile.
+    """
+    try:
+        suffix = path.suffix.lower()
+        if suffix == '.npy':
+            np.load(path, mmap_mode='r') # fails if the file is shorter than its header says
+            return True
+        if suffix in ('.tif', '.tiff') and tifffile is not None:
+            size = path.stat().st_size
+            with tifffile.TiffFile(path) as tif:
+                return all(offset + count <= size for page in tif.pages
+                           for offset, count in zip(page.dataoffsets, page.databytecounts))
+        with _pixel_limit_lock:
+            pixel_limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+            try:
+                with Image.open(path) as img:
+                    img.verify() # chunk structure and checksums, without decompressing
+            finally:
+                Image.MAX_IMAGE_PIXELS = pixel_limit
+        return True
+    except Exception:
+        return False
+
+def read_input(img_path, options):
+    """The input as a uint8 RGB array, an Animation if it has several frames, or a StreamedImage with --stream."""
+    if options.stream:
+        return StreamedImage(img_path)
+    keep_alpha = options.alpha_mode != 'drop'
+    if img_path.suffix.lower() in ANIMATED_EXTENSIONS:
+        animation = decode_animation(img_path, keep_alpha)
+        if animation is not None:
+            return animation
+    return decode_image(img_path, keep_alpha)
+
+def _enhance_input(upsampler, img_np, target_size, options):
+    """AI upscales a decoded input (array or Animation), resizing per tile to target_size when set."""
+    if isinstance(img_np, Animation):
+        return enhance_animation(upsampler, img_np, options, target_size)
+    output = enhance_with_alpha(upsampler, img_np, options, target_size)
+    if target_size is not None and options.check_fused:
+        check_fused_resize(upsampler, img_np, output, options)
+    return output
+
+def _fused_target_size(img_np, job, options):
+    """Final output size when the resize should be fused into inference, else None."""
+    if not options.fused_resize or job['target_output_scale_factor'] == MODEL_NATIVE_SCALE:
+        return None
+    return target_size_for((img_np.shape[1], img_np.shape[0]), job['target_output_scale_factor'])
+
+def _output_path(job, img_path):
+    """Where img_path's output goes; below input_root, subdirectories are mirrored in the output directory."""
+    extension = stream_output_extension() if job['options'].stream else OUTPUT_FORMATS[job['options'].format][1]
+    output_dir_path = job['output_dir_path']
+    if job.get('input_root') is not None and img_path.parent != job['input_root']:
+        output_dir_path = output_dir_path / img_path.parent.relative_to(job['input_root'])
+        output_dir_path.mkdir(parents=True, exist_ok=True)
+    return output_dir_path / output_filename_for(img_path, job['filename_suffix'], job['target_output_scale_factor'], extension)
+
+def _fetch_cached(cache, job, img_path, output_save_path):
+    """Returns (cache_key, hit). cache_key is None when caching is off."""
+    if cache is None:
+        return None, False
+    cache_key = cache.key_for(img_path, cache_settings(job['filename_suffix'], job['target_output_scale_factor'], job['options']))
+    if cache.fetch(cache_key, output_save_path):
+        print(f"  Cached: {img_path.name} -> {output_save_path}")
+        return cache_key, True
+    return cache_key, False
+
+def upscale_file(img_path, output_dir_path, upsampler, model_native_scale, filename_suffix, target_output_scale_factor, options, cache=None, input_root=None):
+    """Upscales a single image file and returns its result record."""
+    job = {'output_dir_path': output_dir_path, 'filename_suffix': filename_suffix,
+           'target_output_scale_factor': target_output_scale_factor, 'options': options, 'input_root': input_root}
+    started = time.perf_counter()
+    output_save_path = _output_path(job, img_path)
+    cache_key, cache_hit = _fetch_cached(cache, job, img_path, output_save_path)
+    if cache_hit:
+        return {'error': None, 'output': output_save_path, 'cache_hit': True, 'seconds': time.perf_counter() - started}
+
+    print(f"  Processing: {img_path.name}...")
+    stage_started = time.perf_counter()
+    img_np = read_input(img_path, options)
+    input_size = (img_np.shape[1], img_np.shape[0])
+    decode_seconds = time.perf_counter() - stage_started
+
+    if options.stream:
+        reset_peak_torch_memory()
+        try:
+            record = upscale_streamed(upsampler, img_np, output_save_path, target_output_scale_factor, options.max_memory)
+        finally:
+            img_np.close()
+        record.update(error=None, output=output_save_path, cache_hit=False, decode_seconds=decode_seconds, peak_torch_bytes=peak_torch_memory())
+        if cache_key is not None:
+            cache.store(cache_key, output_save_path)
+        record.update(seconds=time.perf_counter() - started, process_peak_rss_bytes=process_peak_rss())
+        return record
+
+    # AI upscale at the model's native scale (e.g., 4x), resampled per tile when fusing the resize
+    stage_started = time.perf_counter()
+    reset_peak_torch_memory()
+    target_size = _fused_target_size(img_np, job, options)
+    ai_upscaled_img_np = _enhance_input(upsampler, img_np, target_size, options)
+    infer_seconds = time.perf_counter() - stage_started
+    peak_torch_bytes = peak_torch_memory()
+    del img_np
+
+    record = {'error': None, 'output': output_save_path, 'cache_hit': False,
+              'decode_seconds': decode_seconds, 'infer_seconds': infer_seconds, 'peak_torch_bytes': peak_torch_bytes}
+    record.update(finish_output(ai_upscaled_img_np, input_size, output_save_path, model_native_scale, target_output_scale_factor, options))
+    if cache_key is not None:
+        cache.store(cache_key, output_save_path)
+    record.update(seconds=time.perf_counter() - started, process_peak_rss_bytes=process_peak_rss())
+    return record
+
+# --- Pipelined processing ---
+_PIPELINE_DONE = object()
+
+class StageTimer:
+    """Accumulates the busy and idle (blocked on a queue) time of one pipeline stage."""
+
+    def __init__(self, name, threads=1):
+        self.name = name
+        self.threads = threads
+        self.busy = 0.0
+        self.idle = 0.0
+        self._lock = threading.Lock()
+
+    def add_busy(self, seconds):
+        with self._lock:
+            self.busy += seconds
+
+    def add_idle(self, seconds):
+        with self._lock:
+            self.idle += seconds
+
+    def get(self, stage_queue):
+        started = time.perf_counter()
+        item = stage_queue.get()
+        self.add_idle(time.perf_counter() - started)
+        return item
+
+    def put(self, stage_queue, item):
+        started = time.perf_counter()
+        stage_queue.put(item)
+        self.add_idle(time.perf_counter() - started)
+
+    def summary(self):
+        total = self.busy + self.idle
+        utilization = self.busy / total if total else 0.0
+        return f"    {self.name:<7} x{self.threads}: busy {self.busy:8.2f}s  idle {self.idle:8.2f}s  ({utilization:.0%} busy)"
+
+def _process_pipelined(image_files, upsampler, job, options, should_stop=None, manifest=None, metrics=None, events=None, sidecar=None):
+    """Runs decode, inference and encode as overlapping stages joined by bounded queues.
+
+    Decode threads prefetch and convert inputs (and answer cache hits without touching
+    the model), the calling thread runs the model and encode threads resize and save
+    the outputs. The queue size caps how many decoded inputs and finished outputs are
+    held in memory at once. Each finished image is logged to manifest, metrics,
+    events and sidecar as soon as it completes. Returns {index: result record}.
+    """
+    decode_threads = max(1, options.decode_threads)
+    encode_threads = max(1, options.encode_threads)
+    decode_timer = StageTimer("decode", decode_threads)
+    infer_timer = StageTimer("infer")
+    encode_timer = StageTimer("encode", encode_threads)
+
+    cache = ResultCache.from_options(options)
+    decoded_queue = queue.Queue(maxsize=options.queue_size)
+    encode_queue = queue.Queue(maxsize=options.queue_size)
+    pending = iter(enumerate(image_files))
+    pending_lock = threading.Lock()
+    results = {}
+    started_at = {}
+    stage_seconds = {} # index -> per-stage timings gathered before the image finishes
+
+    def finish(index, img_path, record):
+        if index in started_at:
+            record['seconds'] = time.perf_counter() - started_at[index]
+        record.update(stage_seconds.pop(index, {}), process_peak_rss_bytes=process_peak_rss())
+        results[index] = record
+        if manifest is not None:
+            manifest.record_result(img_path, record)
+        if sidecar is not None:
+            sidecar.record_result(img_path, record)
+        if metrics is not None:
+            metrics.record(img_path, record)
+        if events is not None:
+            events.file_finished(img_path, record)
+
+    def decode_worker():
+        try:
+            decode_items()
+        except Exception as e:
+            # Listing or skipping inputs failed; nothing more can be taken from pending
+            print(f"  Error reading the input list: {e}")
+            traceback.print_exc()
+        finally:
+            # Always, or the inference loop would wait for this thread forever
+            decode_timer.put(decoded_queue, _PIPELINE_DONE)
+
+    def decode_items():
+        while True:
+            if should_stop is not None and should_stop():
+                break
+            with pending_lock:
+                item = next(pending, None)
+            if item is None:
+                break
+            index, img_path = item
+            started = started_at[index] = time.perf_counter()
+            output_save_path, img_np, cache_key, error = None, None, None, None
+            try:
+                output_save_path = _output_path(job, img_path)
+                cache_key, cache_hit = _fetch_cached(cache, job, img_path, output_save_path)
+                if cache_hit:
+                    finish(index, img_path, {'error': None, 'output': output_save_path, 'cache_hit': True})
+                    decode_timer.add_busy(time.perf_counter() - started)
+                    # Still queued (with no image), so the inference loop can put items back in order
+                    decode_timer.put(decoded_queue, (index, img_path, output_save_path, cache_key, None, None))
+                    continue
+                decode_started = time.perf_counter()
+                img_np = read_input(img_path, options)
+                stage_seconds[index] = {'decode_seconds': time.perf_counter() - decode_started}
+            except Exception as e:
+                error = e
+            decode_timer.add_busy(time.perf_counter() - started)
+            decode_timer.put(decoded_queue, (index, img_path, output_save_path, cache_key, img_np, error))
+
+    def encode_worker():
+        while True:
+            item = encode_timer.get(encode_queue)
+            if item is _PIPELINE_DONE:
+                break
+            index, img_path, output_save_path, cache_key, ai_upscaled_img_np, input_size = item
+            started = time.perf_counter()
+            try:
+                record = {'error': None, 'output': output_save_path, 'cache_hit': False}
+                record.update(finish_output(ai_upscaled_img_np, input_size, output_save_path,
+                                            job['model_native_scale'], job['target_output_scale_factor'], options))
+                if cache_key is not None:
+                    cache.store(cache_key, output_save_path)
+                finish(index, img_path, record)
+            except Exception as e:
+                print(f"  Error saving {img_path.name}: {e}")
+                traceback.print_exc()
+                finish(index, img_path, {'error': str(e)})
+            encode_timer.add_busy(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=decode_worker, daemon=True) for _ in range(decode_threads)]
+    threads += [threading.Thread(target=encode_worker, daemon=True) for _ in range(encode_threads)]
+    for thread in threads:
+        thread.start()
+
+    model = {'upsampler': upsampler}
+
+    def infer(items):
+        """Runs the model over decoded items (one image, or a same-sized batch) and queues the outputs."""
+        for index, img_path, output_save_path, cache_key, img_np in items:
+            print(f"  Processing: {img_path.name}...")
+            if manifest is not None:
+                manifest.record('start', img_path, output=output_save_path)
+            if events is not None:
+                events.file_started(img_path)
+        started = time.perf_counter()
+        images = [item[4] for item in items]
+        streamed = None
+        try:
+            if callable(model['upsampler']):
+                # Lazily built: the model is only loaded once an image actually needs it
+                model['upsampler'] = model['upsampler']()
+            infer_started = time.perf_counter()
+            reset_peak_torch_memory()
+            if options.stream:
+                # Written straight to its output file as the tiles come out, so there is nothing to encode
+                _, _, output_save_path, cache_key, _ = items[0]
+                streamed = upscale_streamed(model['upsampler'], images[0], output_save_path, job['target_output_scale_factor'], options.max_memory)
+                streamed.update(error=None, output=output_save_path, cache_hit=False)
+                if cache_key is not None:
+                    cache.store(cache_key, output_save_path)
+                outputs = []
+            elif len(items) == 1:
+                outputs = [_enhance_input(model['upsampler'], images[0], _fused_target_size(images[0], job, options), options)]
+            else:
+                print(f"    Batching {len(items)} images of up to {max(img.shape[1] for img in images)}x{max(img.shape[0] for img in images)}...")
+                outputs = enhance_batch(model['upsampler'], images, options.max_memory)
+            # A batch's time is shared evenly between its images
+            infer_stats = {'infer_seconds': (time.perf_counter() - infer_started) / len(items), 'peak_torch_bytes': peak_torch_memory()}
+            for index, *_ in items:
+                stage_seconds.setdefault(index, {}).update(infer_stats)
+        except Exception as e:
+            outputs = None
+            for index, img_path, *_ in items:
+                print(f"  Error processing {img_path.name}: {e}")
+                finish(index, img_path, {'error': str(e)})
+            traceback.print_exc()
+        finally:
+            if options.stream:
+                images[0].close()
+        infer_timer.add_busy(time.perf_counter() - started)
+
+        if streamed is not None:
+            finish(items[0][0], items[0][1], streamed)
+        if outputs is None:
+            return
+        for (index, img_path, output_save_path, cache_key, img_np), ai_upscaled_img_np in zip(items, outputs):
+            input_size = (img_np.shape[1], img_np.shape[0])
+            infer_timer.put(encode_queue, (index, img_path, output_save_path, cache_key, ai_upscaled_img_np, input_size))
+
+    batch_size = 1 if options.stream else max(1, options.batch_size)
+    buckets = {} # batch bucket -> decoded items waiting for a full batch
+
+    def schedule(item):
+        index, img_path, output_save_path, cache_key, img_np, error = item
+        if should_stop is not None and should_stop():
+            return
+        if error is not None:
+            print(f"  Error processing {img_path.name}: {error}")
+            finish(index, img_path, {'error': str(error)})
+            return
+        if img_np is None:
+            return # answered from the cache by the decode thread
+
+        decoded = (index, img_path, output_save_path, cache_key, img_np)
+        del item, img_np
+        if batch_size == 1 or isinstance(decoded[4], Animation) or not _is_batchable(decoded[4], batch_size, options.max_memory, model['upsampler']):
+            infer([decoded])
+            return
+
+        bucket = batch_bucket(decoded[4].shape[0], decoded[4].shape[1])
+        # Inputs are scheduled sorted by size, so once a new bucket shows up the others are done growing
+        for other_bucket in [other for other in buckets if other != bucket]:
+            infer(buckets.pop(other_bucket))
+        buckets.setdefault(bucket, []).append(decoded)
+        if len(buckets[bucket]) >= batch_size:
+            infer(buckets.pop(bucket))
+
+    # With several decode threads, decodes finish out of order. For batching they are put back
+    # in input (size) order first, or each stray would flush the buckets early. At most
+    # reorder_limit items wait for a slow decode before the earliest one goes ahead anyway.
+    waiting = {} # index -> decoded item that arrived before an earlier one
+    next_index = 0
+    reorder_limit = options.queue_size + decode_threads if batch_size > 1 else 0
+    finished_decoders = 0
+    while finished_decoders < decode_threads:
+        item = infer_timer.get(decoded_queue)
+        if item is _PIPELINE_DONE:
+            finished_decoders += 1
+            continue
+        if item[0] < next_index:
+            schedule(item) # overtaken while the wait was capped
+            continue
+        waiting[item[0]] = item
+        del item
+        while waiting and (next_index in waiting or len(waiting) > reorder_limit):
+            index = next_index if next_index in waiting else min(waiting)
+            schedule(waiting.pop(index))
+            next_index = index + 1
+    for index in sorted(waiting):
+        schedule(waiting.pop(index)) # gaps left by inputs that were never decoded (stopped, or a listing error)
+
+    if not (should_stop is not None and should_stop()):
+        for items in buckets.values():
+            infer(items)
+    buckets.clear()
+
+    for _ in range(encode_threads):
+        encode_queue.put(_PIPELINE_DONE)
+    for thread in threads:
+        thread.join()
+
+    print("  Stage timings:")
+    timers = [decode_timer, infer_timer, encode_timer]
+    for timer in timers:
+        print(timer.summary())
+    bottleneck = max(timers, key=lambda timer: timer.busy / timer.threads)
+    print(f"    Bottleneck: {bottleneck.name}")
+    return results
+
+# --- Worker processes ---
+
+_WORKER_STARTED = 'started' # sent as a worker's result record when it picks up an image
+
+def _worker_main(worker_id, model_spec, num_threads, task_queue, result_queue, job):
+    """Entry point of a --workers process: builds its own upsampler and drains the task queue."""
+    # Whole lines in one write each, so they don't split the main process's lines on a shared pipe
+    sys.stdout = LineWriter(sys.stdout)
+    torch.set_num_threads(num_threads)
+    try:
+        upsampler = create_upsampler(model_spec.url, model_spec.name, model_spec.scale, num_blocks=model_spec.num_blocks, backend=model_spec.backend,
+                                     precision=model_spec.precision, calibration=model_spec.calibration)
+    except Exception as e:
+        result_queue.put((None, {'error': f"Worker {worker_id} failed to initialize: {e}"}))
+        return
+
+    cache = ResultCache.from_options(job['options'])
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            task = task_queue.get(timeout=1.0)
+        except queue.Empty:
+            # The main process can be terminated (e.g. by the GUI's Stop button) without telling us
+            if parent is not None and not parent.is_alive():
+                return
+            continue
+        if task is None:
+            return
+        index, img_path = task
+        result_queue.put((index, _WORKER_STARTED))
+        try:
+            result_queue.put((index, upscale_file(img_path, upsampler=upsampler, cache=cache, **job)))
+        except Exception as e:
+            print(f"  Error processing {img_path.name}: {e}")
+            traceback.print_exc()
+            result_queue.put((index, {'error': str(e)}))
+
+def _process_with_workers(image_files, model_spec, workers, job, should_stop=None, manifest=None, metrics=None, events=None, sidecar=None):
+    """Fans image_files (any iterable, consumed as the workers run) out to worker processes.
+    Returns {index: result record}."""
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Starting {workers} worker processes ({num_threads} torch threads each)...")
+
+    # 'spawn' so each worker gets a clean torch runtime instead of a forked copy of ours
+    ctx = multiprocessing.get_context('spawn')
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    queued = [] # index -> img_path, filled as files are handed out
+    all_queued = threading.Event()
+
+    def feed():
+        try:
+            for index, img_path in enumerate(image_files):
+                if should_stop is not None and should_stop():
+                    break
+                queued.append(img_path)
+                task_queue.put((index, img_path))
+        except Exception as e:
+            print(f"  Error reading the input list: {e}")
+            traceback.print_exc()
+        finally:
+            # Always, or the workers and the result loop below would wait forever
+            for _ in range(workers):
+                task_queue.put(None)
+            all_queued.set()
+
+    threading.Thread(target=feed, daemon=True).start()
+
+    processes = [
+        ctx.Process(target=_worker_main, args=(worker_id, model_spec, num_threads, task_queue, result_queue, job), daemon=True)
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    results = {}
+    failed_workers = 0
+    while not (all_queued.is_set() and len(results) >= len(queued)) and failed_workers < workers:
+        if should_stop is not None and should_stop():
+            break
+        try:
+            index, record = result_queue.get(timeout=1.0)
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                print("  Error: worker processes exited before all images were processed.")
+                break
+            continue
+        if index is None:
+            print(f"  Error: {record['error']}")
+            failed_workers += 1
+            continue
+        if record == _WORKER_STARTED:
+            # Recorded here like in _process_pipelined, so --resume can check the output and the GUI shows progress
+            if manifest is not None:
+                try:
+                    manifest.record('start', queued[index], output=_output_path(job, queued[index]))
+                except OSError:
+                    pass # the worker reports the same error for this image
+            if events is not None:
+                events.file_started(queued[index])
+            continue
+        results[index] = record
+        if manifest is not None:
+            manifest.record_result(queued[index], record)
+        if sidecar is not None:
+            sidecar.record_result(queued[index], record)
+        if metrics is not None:
+            metrics.record(queued[index], record)
+        if events is not None:
+            events.file_finished(queued[index], record)
+
+    for process in processes:
+        if process.is_alive() and not (all_queued.is_set() and len(results) >= len(queued)):
+            process.terminate()
+        process.join()
+    return results
+
+def _matches_any(relative_path, patterns):
+    return any(fnmatch.fnmatch(relative_path, pattern) for pattern in patterns or ())
+
+def iter_images(input_dir_path, recursive=False, include=None, exclude=None):
+    """Yields the supported image files in input_dir_path as they are found.
+
+    Directories are read one at a time with os.scandir, so processing can start on the
+    first images while the rest of the tree is still being listed. include and exclude
+    are glob patterns matched against the path relative to input_dir_path, with '/'
+    separators ('*' also matches across them); excluded directories are not entered.
+    Symlinked directories are not followed.
+    """
+    pending_dirs = [(input_dir_path, "")]
+    while pending_dirs:
+        dir_path, relative_dir = pending_dirs.pop()
+        try:
+            with os.scandir(dir_path) as scanner:
+                entries = sorted(scanner, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Warning: could not read directory {dir_path}: {e}")
+            continue
+        subdirs = []
+        for entry in entries:
+            relative_path = relative_dir + entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and not _matches_any(relative_path, exclude):
+                        subdirs.append((dir_path / entry.name, relative_path + "/"))
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if os.path.splitext(entry.name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                continue
+            if include and not _matches_any(relative_path, include):
+                continue
+            if _matches_any(relative_path, exclude):
+                continue
+            yield dir_path / entry.name
+        # Depth first, in name order
+        pending_dirs.extend(reversed(subdirs))
+
+def read_file_list(list_path):
+    """Absolute image paths from a file list: one path per line, blank lines ignored.
+
+    Missing and unsupported files are reported and left out.
+    """
+    image_files = []
+    with open(list_path, encoding='utf-8') as list_file:
+        for line in list_file:
+            line = line.strip()
+            if not line:
+                continue
+            img_path = Path(os.path.abspath(line))
+            if img_path.suffix.lower() not in SUPPORTED_EXTENSIONS:
+                print(f"Skipping unsupported file from {list_path}: {img_path}")
+            elif not img_path.is_file():
+                print(f"Skipping missing file from {list_path}: {img_path}")
+            else:
+                image_files.append(img_path)
+    return image_files
+
+def common_input_root(image_files):
+    """Deepest folder holding all of image_files, or None if there is none (e.g. different drives).
+
+    Listed files are mirrored below it in the output directory, so same-named files from
+    different folders don't overwrite each other.
+    """
+    try:
+        return Path(os.path.commonpath([str(img_path.parent) for img_path in image_files]))
+    except ValueError:
+        return None
+
+def process_images_in_directory(input_dir_path, output_dir_path, upsampler, model_native_scale, filename_suffix, target_output_scale_factor, options=None, model_spec=None, should_stop=None, manifest=None, metrics=None, events=None):
+    """Processes all images in a given directory. See process_images() for the arguments."""
     if not input_dir_path.exists() or not input_dir_path.is_dir():
         print(f"Input directory {input_dir_path} does not exist or is not a directory. Skipping.")
-        return processed_files
+        return []
+    print(f"\nProcessing images in: {input_dir_path}")
+    return process_images(iter_images(input_dir_path), output_dir_path, upsampler, model_native_scale, filename_suffix, target_output_scale_factor,
+                          options, model_spec, should_stop, manifest, metrics, events)
+
+def process_images(image_files, output_dir_path, upsampler, model_native_scale, filename_suffix, target_output_scale_factor, options=None, model_spec=None, should_stop=None, manifest=None, metrics=None, events=None, input_root=None):
+    """Processes the given image files where they are, writing outputs to output_dir_path.
+
+    image_files may be a generator (see iter_images()); it is consumed as the run goes,
+    so the first images are processed while later ones are still being found. With
+    input_root, each image's subdirectory below it is mirrored in output_dir_path.
+    options is the parsed command line (see default_options()). upsampler may also be a
+    zero-argument callable returning one (e.g. a ModelLease), so the model is only
+    loaded when an image needs it. With options.workers > 1 the images are spread over
+    that many processes, each building its own upsampler from model_spec; upsampler
+    is not used and may be None. should_stop, if given, is
+    polled between images and stops the run early when it returns True. Progress is
+    logged to manifest (a JobManifest); with options.resume, images it records as
+    complete are skipped. Each output's settings go to an OutputSidecar in
+    output_dir_path; with options.incremental, images whose output is current are
+    skipped. Per-image stage timings go to metrics (a MetricsWriter) and progress
+    to events (a ProgressEvents).
+    """
+    options = options or default_options()
+    processed_files = []
 
     output_dir_path.mkdir(parents=True, exist_ok=True)
-    print(f"\nProcessing images in: {input_dir_path}")
     print(f"Outputting to: {output_dir_path} with target upscale x{target_output_scale_factor} (AI at x{model_native_scale})")
 
-    image_files = [f for f in input_dir_path.iterdir() if f.suffix.lower() in SUPPORTED_EXTENSIONS]
-
-    if not image_files:
-        print("No supported images found.")
-        return processed_files
-
-    for img_path in image_files:
-        print(f"  Processing: {img_path.name}...")
-        try:
-            img_pil = Image.open(img_path).convert("RGB")
-            img_np = np.array(img_pil)
-
-            # Step 1: Always AI upscale to the model's native scale (e.g., 4x)
-            # The 'outscale' here should be the model's native scale
-            ai_upscaled_img_np, _ = upsampler.enhance(img_np, outscale=model_native_scale)
-            ai_upscaled_img_pil = Image.fromarray(ai_upscaled_img_np)
-
-            # Step 2: If target_output_scale_factor is different from model_native_scale,
-            #         manually resize using Pillow with Lanczos.
-            final_img_pil = ai_upscaled_img_pil
-            if target_output_scale_factor != model_native_scale:
-                original_width, original_height = img_pil.size
-                target_width = int(original_width * target_output_scale_factor)
-                target_height = int(original_height * target_output_scale_factor)
-                
-                print(f"    Resizing from AI x{model_native_scale} ({ai_upscaled_img_pil.width}x{ai_upscaled_img_pil.height}) to target x{target_output_scale_factor} ({target_width}x{target_height}) using Lanczos...")
-                final_img_pil = ai_upscaled_img_pil.resize((target_width, target_height), Image.Resampling.LANCZOS)
-
-            base_name = img_path.stem
-            if target_output_scale_factor == int(target_output_scale_factor):
-                scale_str = f"{int(target_output_scale_factor)}x"
+    job = {
+        'output_dir_path': output_dir_path,
+        'model_native_scale': model_native_scale,
+        'filename_suffix': filename_suffix,
+        'target_output_scale_factor': target_output_scale_factor,
+        'options': options,
+        'input_root': input_root,
+    }
+
+    found = [0]
+    skipped = [0] # complete according to the manifest (--resume)
+    up_to_date = [0] # current according to the sidecar (--incremental)
+    clashes = [0] # inputs left out because another input already maps to their output
+    image_files_in_order = [] # the files handed to the stages; result indexes refer to this
+    sidecar = OutputSidecar(output_dir_path, settings_digest(filename_suffix, target_output_scale_factor, options))
+
+    def discover():
+        for img_path in image_files:
+            found[0] += 1
+            if events is not None:
+                events.file_found()
+            yield img_path
+
+    def drop_clashes(pending):
+        # Inputs with one output name (e.g. a.png and a.jpg) would overwrite each other's output
+        claimed = {} # output path -> input that maps to it
+        for img_path in pending:
+            try:
+                output_save_path = _output_path(job, img_path)
+            except OSError:
+                yield img_path # the decode stage reports the error for this image
+                continue
+            other = claimed.setdefault(output_save_path, img_path)
+            if other == img_path:
+                yield img_path
+                continue
+            clashes[0] += 1
+            error = f"output {output_save_path.name} clashes with the output of {other}"
+            print(f"  Skipping {img_path}: {error}.")
+            if events is not None:
+                events.file_finished(img_path, {'error': error, 'output': None})
+
+    def skip_finished(pending):
+        # Only stat calls and lookups, so nothing (least of all a model) is loaded for skipped images
+        for img_path in pending:
+            try:
+                output_save_path = _output_path(job, img_path)
+            except OSError:
+                yield img_path # the decode stage reports the error for this image
+                continue
+            if options.incremental and sidecar.is_current(img_path, output_save_path):
+                up_to_date[0] += 1
+            elif options.resume and manifest is not None and manifest.is_complete(img_path, output_save_path):
+                skipped[0] += 1
             else:
-                scale_str = f"{target_output_scale_factor:.1f}x".replace(".0x","x")
+                yield img_path
+                continue
+            if events is not None:
+                events.file_finished(img_path, {'error': None, 'output': output_save_path, 'skipped': True})
 
-            output_filename = f"{base_name}{filename_suffix}-out{scale_str}.png"
-            output_save_path = output_dir_path / output_filename
-            final_img_pil.save(output_save_path, quality=95) # Adjust quality for PNG if needed (lossless by default)
-            print(f"  Saved: {output_save_path}")
-            processed_files.append(img_path)
-        except Exception as e:
-            print(f"  Error processing {img_path.name}: {e}")
-            import traceback
-            traceback.print_exc()
-    
+    def queue_in_order(pending):
+        for img_path in pending:
+            image_files_in_order.append(img_path)
+            yield img_path
+
+    try:
+        pending = drop_clashes(discover())
+        if options.resume:
+            # Temp files left behind by a killed run
+            _remove_abandoned_temp_files(output_dir_path.rglob(".*.tmp") if input_root is not None else output_dir_path.glob(".*.tmp"))
+        if options.incremental or (options.resume and manifest is not None):
+            pending = skip_finished(pending)
+
+        if options.batch_size > 1 and options.workers == 1 and not options.stream:
+            # Grouping same-sized images lets them share batches, which needs the whole list up front.
+            # Only headers are read here.
+            pending = list(pending)
+            sizes = {img_path: _image_size(img_path) for img_path in pending}
+            pending.sort(key=lambda img_path: batch_bucket(sizes[img_path][1], sizes[img_path][0]))
+
+        # Look ahead just far enough to know there is work, and not to start more workers than images.
+        # iter() so a sorted list's head is taken out of it rather than copied, and not run twice.
+        pending = iter(pending)
+        head = list(itertools.islice(pending, max(1, options.workers)))
+        if not head:
+            if not found[0]:
+                print("No supported images found.")
+            if up_to_date[0]:
+                print(f"All {up_to_date[0]} output(s) are up to date.")
+            if skipped[0]:
+                print(f"Resuming: all {skipped[0]} remaining image(s) were already completed.")
+            return processed_files
+        pending = queue_in_order(itertools.chain(head, pending))
+
+        if options.workers > 1:
+            results = _process_with_workers(pending, model_spec, len(head), job, should_stop, manifest, metrics, events, sidecar)
+        else:
+            results = _process_pipelined(pending, upsampler, job, options, should_stop, manifest, metrics, events, sidecar)
+    finally:
+        sidecar.close()
+
+    if up_to_date[0]:
+        print(f"Skipped {up_to_date[0]} up-to-date output(s).")
+    if clashes[0]:
+        print(f"  {clashes[0]} image(s) were skipped because their output name clashed with another input's.")
+    image_files = image_files_in_order
+    if skipped[0]:
+        print(f"Resuming: skipped {skipped[0]} already completed image(s).")
+    # Report in input order regardless of the order the stages finished in
+    processed_files = [img_path for index, img_path in enumerate(image_files) if index in results and results[index]['error'] is None]
+    not_processed = len(image_files) - len(results)
+    if not_processed:
+        print(f"  {not_processed} image(s) were not processed.")
+    if options.cache_dir:
+        hits = sum(1 for record in results.values() if record.get('cache_hit'))
+        misses = sum(1 for record in results.values() if record.get('cache_hit') is False)
+        print(f"  Cache: {hits} hit(s), {misses} miss(es).")
+    encoded = [record for record in results.values() if 'encode_seconds' in record]
+    if encoded:
+        total_bytes = sum(record['bytes'] for record in encoded)
+        total_seconds = sum(record['encode_seconds'] for record in encoded)
+        print(f"  Encoded {len(encoded)} {options.format.upper()} file(s): {total_bytes / 1024 / 1024:.1f} MiB in {total_seconds:.2f}s.")
     return processed_files
 
-def main():
+# --- Watch mode ---
+WATCH_SETTLE_SECONDS = 2.0 # a file must keep its size and mtime this long before it is picked up
+WATCH_POLL_SECONDS = 2.0 # rescan interval when polling
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, name length; the name follows
+
+class Inotify:
+    """Minimal inotify(7) binding over ctypes: reports files created, written or moved into
+    the watched directories. Raises OSError where inotify isn't available."""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.dirs = {} # watch descriptor -> directory
+
+    def add_watch(self, dir_path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dir_path), self.MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), str(dir_path))
+        self.dirs[wd] = Path(dir_path)
+
+    def read(self, timeout):
+        """Waits up to timeout seconds and returns [(path, mask)], or None if events were lost."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        overflowed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+            elif wd in self.dirs and name:
+                events.append((self.dirs[wd] / os.fsdecode(name), mask))
+        return None if overflowed else events
+
+    def close(self):
+        os.close(self.fd)
+
+class DirectoryWatcher:
+    """Reports image files that appear or change in a set of input folders.
+
+    Uses inotify where it is available and otherwise (or with poll=True, e.g. for a
+    network share whose remote writes inotify doesn't see) rescans every
+    WATCH_POLL_SECONDS. A file is reported once it has been closed after writing or
+    moved into place, or else once its size and mtime have stayed the same for
+    settle_seconds, so files that are still being copied in are not picked up half
+    written. Files passed through handed_over() (the initial pass) are only reported
+    again if they change; every other file, including ones that arrive while the
+    initial pass runs, is. Dotfiles (temporary files of most copy tools) are ignored.
+    """
+
+    def __init__(self, roots, recursive=False, include=None, exclude=None, settle_seconds=WATCH_SETTLE_SECONDS, poll=False):
+        self.roots = [Path(root) for root in roots]
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.settle_seconds = settle_seconds
+        self.known = {} # path -> (size, mtime_ns) when it was last reported or handed over
+        self.candidates = {} # path -> ((size, mtime_ns), monotonic time first seen so, complete)
+        self.inotify = None
+        if not poll:
+            try:
+                self.inotify = Inotify()
+                for root in self.roots:
+                    self._watch_tree(root)
+            except OSError as e:
+                print(f"inotify is not available ({e}), polling every {WATCH_POLL_SECONDS:g}s instead.")
+                if self.inotify is not None:
+                    self.inotify.close()
+                self.inotify = None
+        # Polling rescans straight away, so nothing that arrives before the first scan is missed
+        self._next_scan = time.monotonic()
+
+    def handed_over(self, image_files):
+        """Passes image_files through, remembering each file's state as it goes by."""
+        for img_path in image_files:
+            self.known[img_path] = self._state(img_path)
+            yield img_path
+
+    def root_for(self, path):
+        for root in self.roots:
+            if path.parent == root or (self.recursive and root in path.parents):
+                return root
+        return None
+
+    def _watch_tree(self, dir_path):
+        self.inotify.add_watch(dir_path)
+        if self.recursive:
+            for root, dirs, _ in os.walk(dir_path):
+                root_path = Path(root)
+                for name in dirs:
+                    self.inotify.add_watch(root_path / name)
+
+    @staticmethod
+    def _state(path):
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _wanted(self, path):
+        root = self.root_for(path)
+        if root is None or path.name.startswith('.') or path.suffix.lower() not in SUPPORTED_EXTENSIONS:
+            return False
+        relative_path = path.relative_to(root).as_posix()
+        if self.include and not _matches_any(relative_path, self.include):
+            return False
+        # Like iter_images(), an excluded directory excludes everything below it
+        parts = relative_path.split("/")
+        return not any(_matches_any("/".join(parts[:depth]), self.exclude) for depth in range(1, len(parts) + 1))
+
+    def _consider(self, path, complete=False):
+        if not self._wanted(path):
+            return
+        state = self._state(path)
+        if state is None or state == self.known.get(path):
+            return
+        previous = self.candidates.get(path)
+        if previous is None or previous[0] != state or complete:
+            self.candidates[path] = (state, time.monotonic(), complete)
+
+    def _rescan(self, dir_path=None):
+        for root in ([dir_path] if dir_path is not None else self.roots):
+            for img_path in iter_images(root, self.recursive, self.include, self.exclude):
+                self._consider(img_path)
+
+    def poll(self, timeout):
+        """Waits up to timeout seconds for changes and returns the files ready since the last call."""
+        if self.inotify is not None:
+            events = self.inotify.read(min(timeout, self.settle_seconds) if self.candidates else timeout)
+            if events is None:
+                print("  inotify queue overflowed, rescanning the watched folders.")
+                self._rescan()
+            for path, mask in events or []:
+                if not mask & IN_ISDIR:
+                    # Closed after writing or renamed into place means complete; a bare create has to settle
+                    self._consider(path, complete=bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+                elif self.recursive and self.root_for(path) is not None:
+                    try:
+                        self._watch_tree(path)
+                    except OSError:
+                        continue
+                    self._rescan(path) # files that arrived before the watch was in place
+        else:
+            time.sleep(max(0.0, min(timeout, self._next_scan - time.monotonic())))
+            if time.monotonic() >= self._next_scan:
+                self._rescan()
+                self._next_scan = time.monotonic() + WATCH_POLL_SECONDS
+        return self._settled()
+
+    def _settled(self):
+        now = time.monotonic()
+        ready = []
+        for path, (state, since, complete) in list(self.candidates.items()):
+            current = self._state(path)
+            if current is None:
+                del self.candidates[path]
+            elif current != state:
+                self.candidates[path] = (current, now, False)
+            elif complete or now - since >= self.settle_seconds:
+                del self.candidates[path]
+                self.known[path] = state
+                ready.append(path)
+        return sorted(ready)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+def watch_inputs(watched, watcher, args, registry, should_stop=None, manifest=None, metrics=None, events=None):
+    """Upscales images as they arrive in the watched input folders until stopped (--watch).
+
+    watched is [(input_dir, model_spec, filename_suffix, output_dir)] and watcher a
+    DirectoryWatcher on those folders, started before the initial pass. Arrivals are
+    processed in this process with the models held in registry, which stay loaded
+    between files, so each one costs little more than its inference. Returns the
+    processed input files.
+    """
+    options = argparse.Namespace(**vars(args))
+    options.workers = 1 # starting worker processes for every arrival would cost more than it saves
+    mode = "polling" if watcher.inotify is None else "inotify"
+    print(f"\nWatching {', '.join(str(input_dir) for input_dir, *_ in watched)} for new images ({mode}). Press Ctrl+C to stop.")
+    all_processed_input_files = []
+    try:
+        while not (should_stop is not None and should_stop()):
+            ready = watcher.poll(1.0)
+            for input_dir, model_spec, suffix, output_dir in watched:
+                arrivals = [img_path for img_path in ready if watcher.root_for(img_path) == input_dir]
+                if not arrivals:
+                    continue
+                print(f"\n{len(arrivals)} new image(s) in {input_dir}")
+                with registry.lease(model_spec) as upsampler:
+                    all_processed_input_files.extend(process_images(
+                        arrivals, output_dir, upsampler,
+                        MODEL_NATIVE_SCALE, suffix, args.upscale,
+                        options=options, model_spec=model_spec, should_stop=should_stop, manifest=manifest, metrics=metrics, events=events,
+                        input_root=input_dir if args.recursive else None
+                    ))
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+    return all_processed_input_files
+
+def build_arg_parser():
     parser = argparse.ArgumentParser(description="Upscale images using Real-ESRGAN and Pillow-Lanczos for final scaling.")
     parser.add_argument(
         "-o", "--output-path",
@@ -130,17 +2717,273 @@ def main():
         default=4.0,
         help=f"Target upscale factor for the output image (e.g., 2.0 for 2x). AI upscale is always x{MODEL_NATIVE_SCALE}. Default: 4.0"
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--max-memory",
+        type=parse_memory_size,
+        default=None,
+        help="Memory budget for inference (e.g. 8G, 512M). Large images are split into tiles sized to fit. Default: no limit"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="eager",
+        help="How the model is run: eager PyTorch, a frozen TorchScript trace, torch.compile, or ONNX Runtime on the CPU. "
+             "Exports are cached next to the weights and checked against eager output before use. Default: eager"
+    )
+    parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default="fp32",
+        help=f"CPU inference precision: fp32, bf16 autocast (CPUs with native bfloat16), or int8 static quantization calibrated on up to {CALIBRATION_IMAGES} input images. "
+             "Prints PSNR/SSIM against fp32 and the speedup. Only with --backend eager. Default: fp32"
+    )
+    parser.add_argument(
+        "--no-fused-resize",
+        dest="fused_resize",
+        action="store_false",
+        help="Build the full x4 image before resizing to the target scale, instead of resizing each tile as it is produced."
+    )
+    parser.add_argument(
+        "--check-fused",
+        action="store_true",
+        help=f"Also run the unfused path for every image and report how much the fused resize differs (flags PSNR below {FUSED_MIN_PSNR:g} dB)."
+    )
+    parser.add_argument(
+        "--alpha-mode",
+        choices=ALPHA_MODES,
+        default="lanczos",
+        help="How the alpha channel of transparent inputs is upscaled: lanczos or bicubic resampling (fast), "
+             "model (run it through the model as a grey image), or drop (flatten to RGB). Fully transparent "
+             "regions skip the model and fully opaque alpha is ignored. Default: lanczos"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Out-of-core mode for gigapixel images. Inputs are read by region (memory-mapped .npy or uncompressed TIFF, "
+             "or compressed TIFF with zarr installed). Each output tile is written straight into a memory-mapped BigTIFF "
+             "(.tif, needs tifffile) or .npy file, so memory is bounded by the tile size. Overrides --format and --batch-size."
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(OUTPUT_FORMATS),
+        default="png",
+        help="Output file format. Default: png"
+    )
+    parser.add_argument(
+        "--compress-level",
+        type=int,
+        default=DEFAULT_COMPRESS_LEVEL,
+        help=f"Compression effort from 0 (fastest, largest) to 9 for PNG and TIFF; scaled to WebP's 0-6 method. Default: {DEFAULT_COMPRESS_LEVEL}"
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=DEFAULT_QUALITY,
+        help=f"Quality (1-100) for JPEG and lossy WebP. Default: {DEFAULT_QUALITY}"
+    )
+    parser.add_argument(
+        "--lossless",
+        action="store_true",
+        help="Write lossless WebP."
+    )
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="Spend extra encode time for smaller PNG/JPEG files (slowest WebP method)."
+    )
+    parser.add_argument(
+        "-r", "--recursive",
+        action="store_true",
+        help="Also upscale images in subdirectories of the input folders, mirroring them in the output folders. Processing starts while the tree is still being walked."
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        metavar="GLOB",
+        help="Only upscale images whose path relative to the input folder matches this glob (e.g. '2019/*'). Can be repeated."
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        metavar="GLOB",
+        help="Skip images and subdirectories whose path relative to the input folder matches this glob (e.g. '*/thumbs'). Can be repeated."
+    )
+    parser.add_argument(
+        "--photo-dir",
+        type=str,
+        default=None,
+        help="Input folder for photos. Default: input_photo next to this script"
+    )
+    parser.add_argument(
+        "--anime-dir",
+        type=str,
+        default=None,
+        help="Input folder for illustrations. Default: input_anime next to this script"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="After processing what is there, keep the models loaded and upscale new images as they arrive in the input folders, until interrupted."
+    )
+    parser.add_argument(
+        "--watch-poll",
+        action="store_true",
+        help=f"Rescan the input folders every {WATCH_POLL_SECONDS:g}s instead of using inotify, e.g. for network shares written to from other machines."
+    )
+    parser.add_argument(
+        "--watch-settle",
+        type=float,
+        default=WATCH_SETTLE_SECONDS,
+        help=f"Seconds a new file's size and mtime must stay unchanged before it is picked up, unless it was seen being closed or renamed into place. Default: {WATCH_SETTLE_SECONDS:g}"
+    )
+    parser.add_argument(
+        "--photo-list",
+        type=str,
+        default=None,
+        help="File listing photo images to upscale in place, one path per line. With --photo-list or --anime-list the input folders are not scanned."
+    )
+    parser.add_argument(
+        "--anime-list",
+        type=str,
+        default=None,
+        help="File listing illustrations to upscale in place, one path per line."
+    )
+    parser.add_argument(
+        "--model-memory",
+        type=parse_memory_size,
+        default=None,
+        help="Cap on memory held by loaded models (e.g. 200M); idle models are evicted to stay under it. Default: no limit"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        nargs="?",
+        const=str(DEFAULT_CACHE_DIR),
+        default=None,
+        help=f"Reuse outputs for inputs that were already upscaled with the same settings. Without a value uses {DEFAULT_CACHE_DIR.name}/ next to this script. Default: off"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_memory_size,
+        default=parse_memory_size("2G"),
+        help="Maximum size of the result cache; least recently used entries are evicted. Default: 2G"
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help=f"Path of the job manifest recording per-file progress. Default: {MANIFEST_FILENAME} in the output base directory"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run: skip images the manifest records as complete and re-verify unfinished outputs."
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=f"Skip images whose output is newer than the input and was made with the same settings (recorded in {SIDECAR_FILENAME} in each output directory). Models are only loaded if something is out of date."
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default=None,
+        help="Write per-image stage timings (decode/infer/resize/encode ms) and memory peaks to this file. Default: off"
+    )
+    parser.add_argument(
+        "--metrics-format",
+        choices=METRICS_FORMATS,
+        default="jsonl",
+        help="Format of --metrics: JSON lines, CSV, or a Prometheus textfile with run totals. Default: jsonl"
+    )
+    parser.add_argument(
+        "--events",
+        action="store_true",
+        help=f"Print machine-readable progress lines ('{EVENT_PREFIX.strip()} {{json}}') alongside the log, as used by the GUI."
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"Profile the run with cProfile and torch.profiler, writing {PROFILE_STATS_FILENAME} and {PROFILE_TRACE_FILENAME} to the output base directory."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, each with its own model and a share of the CPU threads. Default: 1"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Run up to this many similarly sized small images through the model together. Default: 1 (no batching)"
+    )
+    parser.add_argument(
+        "--decode-threads",
+        type=int,
+        default=1,
+        help="Threads that prefetch and decode input images while the model runs. Default: 1"
+    )
+    parser.add_argument(
+        "--encode-threads",
+        type=int,
+        default=1,
+        help="Threads that resize and encode outputs while the model runs. Default: 1"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=2,
+        help="Images buffered between pipeline stages; bounds memory use. Default: 2"
+    )
+    return parser
 
-    if args.upscale <= 0:
-        print("Error: Upscale factor must be positive.")
-        return
-    
+def default_options(**overrides):
+    """Command line defaults as an options namespace, for callers that don't parse argv."""
+    options = build_arg_parser().parse_args([])
+    for name, value in overrides.items():
+        setattr(options, name, value)
+    return options
+
+def validate_options(options):
+    """Returns an error message for invalid option values, or None."""
+    if options.upscale <= 0:
+        return "Upscale factor must be positive."
+    if options.workers < 1:
+        return "--workers must be at least 1."
+    if options.queue_size < 1:
+        return "--queue-size must be at least 1."
+    if options.batch_size < 1:
+        return "--batch-size must be at least 1."
+    if not 0 <= options.compress_level <= 9:
+        return "--compress-level must be between 0 and 9."
+    if not 1 <= options.quality <= 100:
+        return "--quality must be between 1 and 100."
+    if options.watch and (options.photo_list or options.anime_list):
+        return "--watch watches input folders and can't be combined with --photo-list/--anime-list."
+    if options.precision != 'fp32' and options.backend != 'eager':
+        return "--precision bf16/int8 only works with --backend eager."
+    if options.watch_settle < 0:
+        return "--watch-settle can't be negative."
+    if options.stream and options.check_fused:
+        return "--check-fused needs the full frame in memory and can't be combined with --stream."
+    return None
+
+def run_upscale(args, registry=None, should_stop=None):
+    """Upscales everything in input_photo/input_anime and returns the processed input files.
+
+    With --photo-list/--anime-list the listed files are processed where they are instead,
+    and with --watch new arrivals in the input folders are processed until it is stopped.
+    Models come from registry (the upscale server passes its own so they stay loaded
+    between jobs) and are only built for a category that has images to process.
+    should_stop is polled between images so a running job can be cancelled.
+    """
     target_output_scale = args.upscale
+    if registry is None:
+        registry = ModelRegistry(max_memory=args.model_memory)
 
     script_dir = Path(__file__).resolve().parent
-    input_photo_dir = script_dir / "input_photo"
-    input_anime_dir = script_dir / "input_anime"
+    input_photo_dir = Path(args.photo_dir).resolve() if args.photo_dir else script_dir / "input_photo"
+    input_anime_dir = Path(args.anime_dir).resolve() if args.anime_dir else script_dir / "input_anime"
 
     if args.output_path:
         output_base_dir = Path(args.output_path).resolve()
@@ -153,34 +2996,92 @@ def main():
     output_photo_dir.parent.mkdir(parents=True, exist_ok=True)
     output_anime_dir.parent.mkdir(parents=True, exist_ok=True)
 
-    print("Initializing upscalers...")
-    try:
-        photo_upsampler = create_upsampler(MODEL_PHOTO_URL, MODEL_PHOTO_NAME_FOR_SUFFIX, MODEL_NATIVE_SCALE, num_blocks=23)
-        anime_upsampler = create_upsampler(MODEL_ANIME_URL, MODEL_ANIME_NAME_FOR_SUFFIX, MODEL_NATIVE_SCALE, num_blocks=6)
-    except Exception as e:
-        print(f"Fatal error initializing upscalers: {e}")
-        return
+    watcher = None
+    if args.watch:
+        # Started before the input folders are listed, so nothing that arrives during the initial pass is missed
+        watcher = DirectoryWatcher([input_dir for input_dir in (input_photo_dir, input_anime_dir) if input_dir.is_dir()],
+                                   args.recursive, args.include, args.exclude, args.watch_settle, args.watch_poll)
+
+    # (source, model, suffix, input files, output dir, input root) for each category to process
+    categories = []
+    for name, model_spec, suffix, input_dir, list_path, output_dir in [
+            ("photo", MODEL_PHOTO, SUFFIX_PHOTO, input_photo_dir, args.photo_list, output_photo_dir),
+            ("anime", MODEL_ANIME, SUFFIX_ANIME, input_anime_dir, args.anime_list, output_anime_dir)]:
+        calibration = list_path if (args.photo_list or args.anime_list) else input_dir
+        model_spec = model_spec._replace(backend=args.backend, precision=args.precision, calibration=str(calibration) if calibration else None)
+        if args.photo_list or args.anime_list:
+            # Listed files are processed where they are; the input folders are not scanned
+            if list_path:
+                image_files = read_file_list(list_path)
+                categories.append((list_path, model_spec, suffix, image_files, output_dir, common_input_root(image_files)))
+        elif input_dir.is_dir() and args.recursive:
+            # Walked as the run goes; subdirectories are mirrored below the output directory
+            image_files = iter_images(input_dir, recursive=True, include=args.include, exclude=args.exclude)
+            categories.append((input_dir, model_spec, suffix, image_files, output_dir, input_dir))
+        elif input_dir.is_dir():
+            image_files = list(iter_images(input_dir, include=args.include, exclude=args.exclude))
+            categories.append((input_dir, model_spec, suffix, image_files, output_dir, None))
+        else:
+            print(f"Input {name} directory not found: {input_dir}")
 
+    manifest_path = Path(args.manifest) if args.manifest else output_photo_dir.parent / MANIFEST_FILENAME
     all_processed_input_files = []
 
-    if input_photo_dir.exists():
-        # Pass MODEL_NATIVE_SCALE to process_images_in_directory
-        processed_photo_files = process_images_in_directory(
-            input_photo_dir, output_photo_dir, photo_upsampler, 
-            MODEL_NATIVE_SCALE, SUFFIX_PHOTO, target_output_scale
-        )
-        all_processed_input_files.extend(processed_photo_files)
-    else:
-        print(f"Input photo directory not found: {input_photo_dir}")
+    with contextlib.ExitStack() as stack:
+        if watcher is not None:
+            stack.callback(watcher.close)
+        manifest = stack.enter_context(JobManifest(manifest_path, resume=args.resume))
+        metrics = MetricsWriter.from_options(args)
+        if metrics is not None:
+            stack.enter_context(metrics)
+        if args.profile:
+            stack.enter_context(profile_run(output_photo_dir.parent))
+        events = None
+        if args.events:
+            # A recursive walk or --watch isn't counted up front; events then count images as they are found
+            image_lists = [category[3] for category in categories]
+            counted = all(isinstance(image_files, list) for image_files in image_lists) and not args.watch
+            total = sum(len(image_files) for image_files in image_lists) if counted else None
+            events = stack.enter_context(ProgressEvents(total, should_stop))
 
-    if input_anime_dir.exists():
-        processed_anime_files = process_images_in_directory(
-            input_anime_dir, output_anime_dir, anime_upsampler, 
-            MODEL_NATIVE_SCALE, SUFFIX_ANIME, target_output_scale
-        )
-        all_processed_input_files.extend(processed_anime_files)
-    else:
-        print(f"Input anime directory not found: {input_anime_dir}")
+        for source, model_spec, suffix, image_files, output_dir, input_root in categories:
+            if should_stop is not None and should_stop():
+                break
+            print(f"\nProcessing images from: {source}")
+            if watcher is not None:
+                image_files = watcher.handed_over(image_files)
+            with registry.lease(model_spec) as upsampler:
+                processed_files = process_images(
+                    image_files, output_dir, upsampler,
+                    MODEL_NATIVE_SCALE, suffix, target_output_scale,
+                    options=args, model_spec=model_spec, should_stop=should_stop, manifest=manifest, metrics=metrics, events=events,
+                    input_root=input_root
+                )
+            all_processed_input_files.extend(processed_files)
+
+        if args.watch and not (should_stop is not None and should_stop()):
+            watched = [(source, model_spec, suffix, output_dir) for source, model_spec, suffix, _, output_dir, _ in categories]
+            all_processed_input_files.extend(watch_inputs(watched, watcher, args, registry, should_stop, manifest, metrics, events))
+
+    if should_stop is not None and should_stop():
+        print("\nUpscaling cancelled.")
+    return all_processed_input_files
+
+def main():
+    sys.stdout = LineWriter(sys.stdout)
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    error = validate_options(args)
+    if error:
+        print(f"Error: {error}")
+        return
+
+    try:
+        all_processed_input_files = run_upscale(args)
+    except Exception as e:
+        print(f"Fatal error during upscaling: {e}")
+        return
 
     print("\nUpscaling complete.")
 
@@ -0,0 +1,404 @@
+"""Long-lived upscale worker that keeps the Real-ESRGAN models loaded between jobs.
+
+Models are loaded the first time a job needs them and then stay resident (subject to
+--model-memory, which evicts idle models to stay under a cap).
+
+Clients talk to it over a Unix socket in a per-user directory (see server_dir()),
+created with mode 0600 so only its owner can connect. Where there are no Unix sockets
+(Windows) it listens on localhost TCP instead, and every request must carry the
+"token" written to a file in that per-user directory. One JSON object per line:
+
+    {"cmd": "submit", "args": ["-u", "2.0"]}  -> {"event": "accepted", "job": 1}, then
+                                                 {"event": "log", "job": 1, "line": "..."} ...
+                                                 {"event": "finished", "job": 1, "status": "done"}
+    {"cmd": "cancel", "job": 1}               -> {"ok": true}
+    {"cmd": "status"}                         -> {"ok": true, "running": 1, "queued": [2], "models": [...]}
+    {"cmd": "shutdown"}                       -> {"ok": true}
+
+"args" are upscale.py command line arguments, minus the options that would write
+outside the default output directories and cache (see REJECTED_OPTIONS). Jobs run one at a time in the order they were submitted;
+their output is streamed back on the connection that submitted them. Cancelling takes
+effect between images.
+"""
+import os
+import sys
+import hmac
+import json
+import socket
+import secrets
+import time
+import queue
+import argparse
+import itertools
+import threading
+import traceback
+import socketserver
+
+import upscale
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+USE_UNIX_SOCKET = hasattr(socket, "AF_UNIX") and os.name != "nt"
+SERVER_DIR_NAME = "batch_image_upscale"
+
+# upscale.py options (argparse dest -> flag) a job may not set, so that jobs only write into
+# the default output directories and cache (--cache-dir is only allowed without a value).
+# This limits where a job writes, not what it reads: --photo-list/--anime-list, which the
+# GUI uses, may name any file the owner can read. Only the owner can connect (see
+# server_dir()), so that is no more than the owner could do directly. The input folder
+# options are rejected only because the GUI never needs them.
+REJECTED_OPTIONS = {
+    "output_path": "-o/--output-path",
+    "photo_dir": "--photo-dir",
+    "anime_dir": "--anime-dir",
+    "manifest": "--manifest",
+    "metrics": "--metrics",
+}
+
+def server_dir():
+    """Per-user directory (mode 0700) for the server's socket or token file. gui.py uses the same one."""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, SERVER_DIR_NAME)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+def default_socket_path():
+    return os.path.join(server_dir(), "server.sock")
+
+def token_path():
+    return os.path.join(server_dir(), "server.token")
+
+def check_job_options(options):
+    """Returns why a submitted job's options are not allowed, or None."""
+    for dest, flag in REJECTED_OPTIONS.items():
+        if getattr(options, dest) is not None:
+            return f"{flag} is not accepted by the upscale server."
+    if options.cache_dir is not None and os.path.abspath(options.cache_dir) != os.path.abspath(str(upscale.DEFAULT_CACHE_DIR)):
+        return "--cache-dir only accepts the default cache on the upscale server."
+    if options.watch:
+        return "--watch jobs never finish and would block the upscale server's queue."
+    return None
+
+def log(message):
+    # sys.stderr may be routed to the running job's client, so the server's own messages go to the real stderr
+    print(message, file=sys.__stderr__, flush=True)
+
+def parse_job_args(args):
+    """Parses upscale.py arguments for a job. Raises ValueError with argparse's message instead of
+    printing it and exiting, since output printed here could land in another client's running job."""
+    parser = upscale.build_arg_parser()
+    parser.prog = "upscale.py"
+
+    def fail(message):
+        raise ValueError(f"{parser.format_usage()}upscale.py: error: {message}")
+
+    def no_help(file=None):
+        raise ValueError("--help is not available through the upscale server; run upscale.py --help.")
+
+    parser.error = fail
+    parser.print_help = no_help
+    return parser.parse_args(args)
+
+class OutputRouter:
+    """Installed once as sys.stdout or sys.stderr: the running job's output (set_job_output())
+    gets what the job's threads print, and threads marked with mark_server_thread() (the client
+    handlers) always write to the server's own stream, so they never mix into a job's output."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.job_output = None
+        self._local = threading.local()
+
+    def set_job_output(self, job_output):
+        self.job_output = job_output
+
+    def mark_server_thread(self):
+        self._local.server_thread = True
+
+    def _target(self):
+        if self.job_output is None or getattr(self._local, "server_thread", False):
+            return self.stream
+        return self.job_output
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class Job:
+    def __init__(self, job_id, options, client):
+        self.id = job_id
+        self.options = options
+        self.client = client
+        self.cancel_event = threading.Event()
+
+    def send(self, message):
+        self.client.send(message)
+
+class JobOutput:
+    """File-like object that forwards each complete line a job prints to its client.
+
+    Partial lines are buffered per thread, since print() writes the text and its newline
+    separately and the job's pipeline threads print concurrently.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self._buffers = {} # thread id -> partial line
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        thread_id = threading.get_ident()
+        with self._lock:
+            *lines, self._buffers[thread_id] = (self._buffers.get(thread_id, "") + text).split("\n")
+        for line in lines:
+            self.job.send({"event": "log", "job": self.job.id, "line": line})
+        return len(text)
+
+    def flush(self):
+        # Only the calling thread's partial line; another thread's may still get its newline
+        with self._lock:
+            line = self._buffers.pop(threading.get_ident(), "")
+        if line:
+            self.job.send({"event": "log", "job": self.job.id, "line": line})
+
+class UpscaleServer(socketserver.ThreadingTCPServer):
+    """Listens on a Unix socket when address is a path, else on TCP with token authentication."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, idle_timeout=0, model_memory=None, routers=()):
+        self.routers = routers # OutputRouters installed as sys.stdout/sys.stderr, see main()
+        self.token = None
+        if isinstance(address, str):
+            self.address_family = socket.AF_UNIX
+            self._remove_stale_socket(address)
+        else:
+            self.token = secrets.token_hex(32)
+        super().__init__(address, ClientHandler)
+        if self.token is not None:
+            # O_EXCL after removing any old file, so the token is never written into a file someone else made
+            path = token_path()
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.token)
+        self.idle_timeout = idle_timeout
+        self.registry = upscale.ModelRegistry(max_memory=model_memory)
+        self.job_queue = queue.Queue()
+        self.queued_jobs = {}
+        self.running_job = None
+        self.last_activity = time.monotonic()
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _remove_stale_socket(path):
+        if not os.path.exists(path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path) # left behind by a server that didn't shut down cleanly
+            return
+        finally:
+            probe.close()
+        raise OSError(f"another upscale server is already listening on {path}")
+
+    def server_bind(self):
+        if self.address_family != socket.AF_UNIX:
+            return super().server_bind()
+        # Created owner-only from the start, so there is no window where others could connect
+        previous_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(previous_umask)
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        path = self.server_address if self.address_family == socket.AF_UNIX else (token_path() if self.token else None)
+        if path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def is_authorized(self, request):
+        return self.token is None or hmac.compare_digest(str(request.get("token", "")), self.token)
+
+    def submit(self, args, client):
+        options = parse_job_args(args)
+        error = upscale.validate_options(options) or check_job_options(options)
+        if error:
+            raise ValueError(error)
+        with self._lock:
+            job = Job(next(self._job_ids), options, client)
+            self.queued_jobs[job.id] = job
+        # Acknowledge before queueing so the client learns the job id before any output
+        job.send({"event": "accepted", "job": job.id})
+        self.job_queue.put(job)
+        return job
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self.queued_jobs.get(job_id)
+            if job is None and self.running_job is not None and self.running_job.id == job_id:
+                job = self.running_job
+        if job is None:
+            return False
+        job.cancel_event.set()
+        return True
+
+    def status(self):
+        with self._lock:
+            return {
+                "ok": True,
+                "running": self.running_job.id if self.running_job else None,
+                "queued": sorted(self.queued_jobs),
+                "models": self.registry.loaded(),
+            }
+
+    def run_jobs(self):
+        """Runs submitted jobs one after another on this thread."""
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self.queued_jobs.pop(job.id, None)
+                self.running_job = job
+
+            status = "done"
+            if job.cancel_event.is_set():
+                status = "cancelled"
+            else:
+                log(f"Running job {job.id}")
+                output = JobOutput(job)
+                # Everything the job prints (including from its pipeline threads) goes to the client
+                for router in self.routers:
+                    router.set_job_output(output)
+                try:
+                    upscale.run_upscale(job.options, registry=self.registry, should_stop=job.cancel_event.is_set)
+                    print("\nUpscaling complete.", file=output)
+                except Exception as e:
+                    print(f"Fatal error during upscaling: {e}", file=output)
+                    traceback.print_exc(file=output)
+                    status = "error"
+                finally:
+                    for router in self.routers:
+                        router.set_job_output(None)
+                output.flush()
+                if status == "done" and job.cancel_event.is_set():
+                    status = "cancelled"
+
+            job.send({"event": "finished", "job": job.id, "status": status})
+            log(f"Job {job.id} {status}")
+            with self._lock:
+                self.running_job = None
+                self.last_activity = time.monotonic()
+
+    def watch_idle(self):
+        """Shuts the server down after idle_timeout seconds without jobs."""
+        while True:
+            time.sleep(5)
+            with self._lock:
+                busy = self.running_job is not None or bool(self.queued_jobs)
+                idle_for = time.monotonic() - self.last_activity
+            if not busy and idle_for > self.idle_timeout:
+                log(f"Idle for {int(idle_for)}s, shutting down.")
+                self.shutdown()
+                return
+
+class ClientConnection:
+    """Serializes writes from the handler thread and the job thread onto one socket."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        with self._lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                pass # client went away; the job keeps running
+
+class ClientHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for router in self.server.routers:
+            router.mark_server_thread()
+        client = ClientConnection(self.wfile)
+        for raw_line in self.rfile:
+            line = raw_line.decode("utf-8", errors="replace").strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+                reply = self.dispatch(request, client)
+                if reply is not None:
+                    client.send(reply)
+            except Exception as e:
+                client.send({"ok": False, "error": f"{type(e).__name__}: {e}"})
+
+    def dispatch(self, request, client):
+        server = self.server
+        if not server.is_authorized(request):
+            return {"ok": False, "error": "Missing or wrong token."}
+        with server._lock:
+            server.last_activity = time.monotonic()
+        command = request.get("cmd")
+        if command == "submit":
+            server.submit([str(arg) for arg in request.get("args", [])], client)
+            return None # submit() already sent the "accepted" event
+        if command == "cancel":
+            return {"ok": server.cancel(request.get("job"))}
+        if command == "status":
+            return server.status()
+        if command == "shutdown":
+            threading.Thread(target=server.shutdown, daemon=True).start()
+            return {"ok": True}
+        return {"ok": False, "error": f"Unknown command: {command}"}
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the upscale models loaded and run jobs submitted over a local socket.")
+    if USE_UNIX_SOCKET:
+        parser.add_argument("--socket", default=None, help="Unix socket to listen on. Default: server.sock in the per-user server directory")
+    parser.add_argument("--host", default=DEFAULT_HOST,
+                        help=f"Address to listen on where there are no Unix sockets (requests then need the token file). Default: {DEFAULT_HOST}")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on without Unix sockets. Default: {DEFAULT_PORT}")
+    parser.add_argument("--idle-timeout", type=float, default=0, help="Exit after this many seconds without jobs. Default: 0 (never)")
+    parser.add_argument("--model-memory", type=upscale.parse_memory_size, default=None,
+                        help="Cap on memory held by loaded models; idle models are evicted to stay under it. Default: no limit")
+    args = parser.parse_args()
+
+    address = (args.socket or default_socket_path()) if USE_UNIX_SOCKET else (args.host, args.port)
+    sys.stdout, sys.stderr = routers = (OutputRouter(sys.stdout), OutputRouter(sys.stderr))
+    server = UpscaleServer(address, idle_timeout=args.idle_timeout, model_memory=args.model_memory, routers=routers)
+    log(f"Upscale server listening on {address if USE_UNIX_SOCKET else f'{args.host}:{args.port}'}")
+    threading.Thread(target=server.run_jobs, daemon=True).start()
+    if args.idle_timeout > 0:
+        threading.Thread(target=server.watch_idle, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()